@@ -0,0 +1,135 @@
+"""
+Compares the save time, load time and size on disk of the cache formats against joblib pickles,
+for a city sized set of users and a city sized street network.
+
+Run with: poetry run python -m benchmarks.cache_formats
+"""
+
+from pathlib import Path
+import shutil
+import tempfile
+import time
+import joblib
+import numpy as np
+import geopandas as gp
+from networkx import MultiDiGraph
+from rich.table import Table
+from meetup.logging import console
+from meetup.network import CompactNetwork
+
+
+def synthetic_users(noUsers: int) -> gp.GeoDataFrame:
+    rng = np.random.default_rng(0)
+    centers = rng.uniform([370000, 5800000], [410000, 5840000], (noUsers // 25, 2))
+    coords = centers[rng.integers(0, centers.shape[0], noUsers)] + rng.normal(
+        0, 400, (noUsers, 2)
+    )
+    return gp.GeoDataFrame(
+        {
+            "user_id": [f"{i:08x}" for i in range(noUsers)],
+            "latitude": rng.uniform(52.3, 52.7, noUsers),
+            "longitude": rng.uniform(13.0, 13.8, noUsers),
+            "label": rng.integers(0, noUsers // 25, noUsers),
+        },
+        geometry=gp.points_from_xy(coords[:, 0], coords[:, 1]),
+        crs="epsg:32633",
+    )
+
+
+def synthetic_network(side: int) -> MultiDiGraph:
+    """
+    A side x side grid with the node and edge attributes osmnx would attach
+    """
+    graph = MultiDiGraph(crs="epsg:32633")
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(
+                i * side + j, x=370000 + i * 80.0, y=5800000 + j * 80.0, street_count=4
+            )
+    for i in range(side):
+        for j in range(side):
+            node = i * side + j
+            for neighbour in [node + side, node + 1]:
+                if neighbour < side * side and (neighbour != node + 1 or j + 1 < side):
+                    attributes = {
+                        "osmid": node,
+                        "length": 80.0,
+                        "highway": "residential",
+                        "oneway": False,
+                        "name": f"Street {node}",
+                    }
+                    graph.add_edge(node, neighbour, **attributes)
+                    graph.add_edge(neighbour, node, **attributes)
+    return graph
+
+
+def size_of(path: Path) -> float:
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.iterdir()) / 1e6
+    return path.stat().st_size / 1e6
+
+
+def measure(save, load, path: Path, repeats: int = 3) -> tuple[float, float, float]:
+    """
+    Best of the repeats for the save and load time along with the size on disk
+    """
+    saveTimes, loadTimes = [], []
+    for _ in range(repeats):
+        if path.is_dir():
+            shutil.rmtree(path)
+        start = time.perf_counter()
+        save(path)
+        saveTimes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        load(path)
+        loadTimes.append(time.perf_counter() - start)
+    return min(saveTimes), min(loadTimes), size_of(path)
+
+
+def main():
+    workDir = Path(tempfile.mkdtemp())
+    users = synthetic_users(20000)
+    graph = synthetic_network(300)
+    compact = CompactNetwork.from_graph(graph)
+
+    results = {
+        "users joblib": measure(
+            lambda path: joblib.dump(users, path), joblib.load, workDir / "users.joblib"
+        ),
+        "users geoparquet": measure(
+            users.to_parquet,
+            lambda path: gp.read_parquet(path, memory_map=True),
+            workDir / "users.parquet",
+        ),
+        "users flatgeobuf": measure(
+            lambda path: users.to_file(path, driver="FlatGeobuf"),
+            gp.read_file,
+            workDir / "users.fgb",
+        ),
+        f"network ({graph.number_of_nodes()} nodes) joblib": measure(
+            lambda path: joblib.dump(graph, path),
+            joblib.load,
+            workDir / "network.joblib",
+        ),
+        "network compact arrays": measure(
+            compact.save, CompactNetwork.load, workDir / "network"
+        ),
+        "network compact arrays to graph": measure(
+            compact.save,
+            lambda path: CompactNetwork.load(path).to_graph(),
+            workDir / "network_graph",
+        ),
+    }
+
+    table = Table(title="Cache format benchmark")
+    for column in ["format", "save (s)", "load (s)", "size (MB)"]:
+        table.add_column(column)
+    for name, (saveTime, loadTime, size) in results.items():
+        table.add_row(name, f"{saveTime:.3f}", f"{loadTime:.3f}", f"{size:.2f}")
+    console.print(table)
+
+    shutil.rmtree(workDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Times each stage of a run, along with how far it raises the resident memory of the process, on synthetic city
+sized populations. Every stage runs against an empty cache so the numbers are for a cold run.
+
+Run with: poetry run python -m benchmarks.pipeline --sizes 1000 --sizes 100000 --output results.json
+"""
+
+from pathlib import Path
+from threading import Event, Thread
+from typing import Annotated, Callable, Optional
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import typer
+from rich.table import Table
+from meetup.clustering import (
+    InitialClusteringMethod,
+    MeetingPointMethod,
+    cluster,
+    format_results,
+    generate_group_meeting_points,
+    improve_clusters,
+    initial_clustering_algorithm,
+)
+from meetup.export import OutputFormat, export_run
+from meetup.geo import generate_cluster_convex_hull, load_user_locations
+from meetup.logging import console
+from tests.helpers import blob_cluster, use_cache_dir
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Users per neighbourhood on average, neighbourhood sizes vary around this
+USERS_PER_NEIGHBOURHOOD = 2_000
+
+# Seconds between samples of the resident memory
+MEMORY_SAMPLE_INTERVAL = 0.005
+
+# Resident memory is read from /proc, which is only available on linux
+STATM_PATH = Path("/proc/self/statm")
+
+
+def synthetic_city(noUsers: int, seed: int = 0) -> pd.DataFrame:
+    """
+    A population spread over neighbourhoods of varying size and density, denser towards the city centre, built
+    from the blob clusters used in the tests. Centred on Berlin so it projects to a realistic UTM zone.
+
+    :param int noUsers: The number of users to generate
+    :param int seed: Seed for the random number generators
+    :return DataFrame: The user_id, latitude and longitude of each user
+    """
+    rng = np.random.default_rng(seed)
+    # make_blobs draws from numpy's global generator
+    np.random.seed(seed)
+
+    noNeighbourhoods = max(noUsers // USERS_PER_NEIGHBOURHOOD, 5)
+    centers = rng.normal([13.4, 52.5], [0.1, 0.06], (noNeighbourhoods, 2))
+    distanceFromCenter = np.hypot(centers[:, 0] - 13.4, centers[:, 1] - 52.5)
+    weights = rng.lognormal(0, 0.75, noNeighbourhoods) * np.exp(
+        -distanceFromCenter / 0.1
+    )
+    sizes = rng.multinomial(noUsers, weights / weights.sum())
+    spreads = rng.uniform(0.004, 0.02, noNeighbourhoods) * (1 + distanceFromCenter * 5)
+
+    blobs = [
+        blob_cluster(x, y, size, spread, index)
+        for index, ((x, y), size, spread) in enumerate(zip(centers, sizes, spreads))
+        if size > 0
+    ]
+    coords = np.concatenate([blob.get_coordinates().to_numpy() for blob in blobs])
+    order = rng.permutation(coords.shape[0])
+    return pd.DataFrame(
+        {
+            "user_id": [f"{i:08x}" for i in range(noUsers)],
+            "latitude": coords[order, 1],
+            "longitude": coords[order, 0],
+        }
+    )
+
+
+def resident_memory() -> float:
+    """
+    The current resident memory of the process in MB
+    """
+    with open(STATM_PATH) as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+class PeakMemory:
+    """
+    Samples the resident memory in a background thread, unlike tracemalloc this sees memory allocated by native
+    libraries such as arrow and GEOS and barely slows the stage being measured
+    """
+
+    def __init__(self):
+        self.stopped = Event()
+        self.start = resident_memory()
+        self.peak = self.start
+        self.thread = Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while not self.stopped.wait(MEMORY_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, resident_memory())
+
+    def stop(self) -> float:
+        """
+        Stops sampling
+
+        :return float: How many MB the peak resident memory was above the memory at the start
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, resident_memory())
+        return self.peak - self.start
+
+
+def measure(stage: Callable, memory: bool) -> tuple[object, float, Optional[float]]:
+    """
+    Runs a stage, timing it and optionally tracking how far it raises the resident memory
+
+    :return (object, float, float): The result of the stage, the seconds it took and the peak MB added or None
+    """
+    peakMemory = PeakMemory() if memory else None
+    start = time.perf_counter()
+    result = stage()
+    elapsed = time.perf_counter() - start
+    return result, elapsed, None if peakMemory is None else peakMemory.stop()
+
+
+def benchmark_size(
+    noUsers: int,
+    workDir: Path,
+    minOccupancy: int,
+    maxOccupancy: int,
+    iterations: int,
+    memory: bool,
+) -> dict[str, tuple[float, Optional[float]]]:
+    """
+    Runs every stage of a run on a synthetic population, feeding each stage the output of the last
+    """
+    inputPath = workDir / f"users_{noUsers}.csv"
+    synthetic_city(noUsers).to_csv(inputPath, index=False)
+    outputDir = workDir / f"run_{noUsers}"
+    outputDir.mkdir()
+
+    results = {}
+
+    def run(name: str, stage: Callable):
+        result, elapsed, peak = measure(stage, memory)
+        results[name] = (elapsed, peak)
+        return result
+
+    users = run("load_user_locations", lambda: load_user_locations(str(inputPath)))
+    initial = run(
+        "initial clustering",
+        lambda: cluster(
+            initial_clustering_algorithm(
+                InitialClusteringMethod.KMEANS, noUsers, minOccupancy, maxOccupancy
+            ),
+            users,
+        ),
+    )
+    groups = run(
+        "improve_clusters",
+        lambda: improve_clusters(initial, minOccupancy, maxOccupancy, iterations),
+    )
+    meetingPoints = run(
+        "generate_group_meeting_points",
+        lambda: generate_group_meeting_points(groups, MeetingPointMethod.CENTROID),
+    )
+    regions = run(
+        "generate_cluster_convex_hull", lambda: generate_cluster_convex_hull(groups)
+    )
+    run("format_results", lambda: format_results(groups, meetingPoints))
+    for outputFormat in [OutputFormat.GEOJSON, OutputFormat.GEOPARQUET]:
+        formatDir = outputDir / outputFormat.value
+        formatDir.mkdir()
+        run(
+            f"export_run ({outputFormat.value})",
+            lambda: export_run(formatDir, groups, meetingPoints, regions, outputFormat),
+        )
+    return results
+
+
+def main(
+    sizes: Annotated[
+        Optional[list[int]],
+        typer.Option(help="Numbers of users to benchmark, defaults to 1k to 1M"),
+    ] = None,
+    min_occupancy: Annotated[int, typer.Option()] = 10,
+    max_occupancy: Annotated[int, typer.Option()] = 40,
+    iterations: Annotated[int, typer.Option()] = 10,
+    memory: Annotated[
+        bool,
+        typer.Option(help="Track the peak memory used by each stage. Linux only"),
+    ] = STATM_PATH.exists(),
+    output: Annotated[
+        Optional[str],
+        typer.Option(help="JSON file to write the results to for comparing runs"),
+    ] = None,
+):
+    workDir = Path(tempfile.mkdtemp())
+    # Point the cache at an empty directory so every stage does its full work
+    use_cache_dir(workDir / "cache", "benchmark")
+
+    allResults = {}
+    try:
+        for noUsers in sizes or DEFAULT_SIZES:
+            results = benchmark_size(
+                noUsers, workDir, min_occupancy, max_occupancy, iterations, memory
+            )
+            allResults[noUsers] = results
+
+            table = Table(title=f"Pipeline benchmark, {noUsers:,} users")
+            for column in ["stage", "time (s)", "peak memory added (MB)"]:
+                table.add_column(column)
+            for stage, (elapsed, peak) in results.items():
+                table.add_row(
+                    stage, f"{elapsed:.3f}", "-" if peak is None else f"{peak:.1f}"
+                )
+            table.add_row(
+                "total", f"{sum(elapsed for elapsed, _ in results.values()):.3f}", ""
+            )
+            console.print(table)
+    finally:
+        shutil.rmtree(workDir)
+
+    # ru_maxrss is in KB on linux
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    console.print(f"Peak resident memory {peakRss:.0f}MB")
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(
+                {
+                    "peakRssMb": peakRss,
+                    "sizes": {
+                        str(noUsers): {
+                            stage: {"seconds": elapsed, "peakMemoryAddedMb": peak}
+                            for stage, (elapsed, peak) in results.items()
+                        }
+                        for noUsers, results in allResults.items()
+                    },
+                },
+                file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    typer.run(main)
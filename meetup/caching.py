@@ -1,21 +1,48 @@
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING
+import hashlib
+import json
+import os
 import shutil
-import joblib
+import time
+import importlib.util
 from .logging import logInfo
-from networkx import MultiDiGraph
-import geopandas as gp
+from .options import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_SIZE_MB
 
-GeoCacheFormat = "flatgeobuff"
+# The cache is used by every command, including the lightweight ones, so the geospatial libraries are only
+# imported by the methods that need them
+if TYPE_CHECKING:
+    import geopandas as gp
+    import pandas as pd
+    from .network import CompactNetwork, StreetSnapIndex
+
+# GeoParquet needs pyarrow, fall back to FlatGeobuf when it is not installed
+GeoCacheFormat = (
+    "geoparquet" if importlib.util.find_spec("pyarrow") is not None else "flatgeobuf"
+)
+GeoCacheSuffixes = {"geoparquet": ".parquet", "flatgeobuf": ".fgb"}
+
+# Number of network tiles kept in memory, so a long running service only reads each from disk once
+DEFAULT_MEMORY_TILES = 64
 
 
 class Cache:
+    """
+    Content addressed cache for the expensive stages of a run. Each entry is stored under its stage name
+    and a key derived from a hash of the inputs and parameters that produced it, so changing any of them
+    results in a new entry rather than a stale one. Entries are shared between runs, each run keeps a
+    manifest of the entries it used so they can be cleared along with it. Nothing is created on disk until a
+    run name is set.
+    """
+
     def __init__(self, location: str = "./.data_cache"):
         self.baseDir = Path(location)
+        self.entriesDir = self.baseDir / "entries"
         self.runName = None
-
-        if not self.baseDir.exists():
-            logInfo(f"Generating cache folder at [bold white]{location}[/bold white]")
-            self.baseDir.mkdir()
+        # Jobs run by the service share the run manifest between threads
+        self.manifestLock = Lock()
 
     def _run_dir(self):
         if self.runName is None:
@@ -23,44 +50,291 @@ class Cache:
         return self.baseDir / self.runName
 
     def set_run_name(self, runName: str):
+        if not self.baseDir.exists():
+            logInfo(
+                f"Generating cache folder at [bold white]{self.baseDir}[/bold white]"
+            )
+            self.baseDir.mkdir(parents=True)
         self.runName = runName
         self.runDir = self.baseDir / runName
         if not self.runDir.exists():
             logInfo(f"Generating run folder at [bold white]{self.runDir}[/bold white]")
             self.runDir.mkdir()
 
-    def clear_cache(self):
-        shutil.rmtree(self._run_dir())
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Generate a cache key from the parameters that produce a cache entry
 
-    def clear_cache_all(self):
-        shutil.rmtree(self.baseDir)
+        :param parts: Any JSON serializable values, other values are converted with str
+        :return str: The hex digest of the parameters
+        """
+        serialized = json.dumps(parts, default=str, sort_keys=True)
+        return hashlib.sha256(serialized.encode("utf8")).hexdigest()
+
+    @staticmethod
+    def file_key(filePath: str) -> str:
+        """
+        Generate a cache key from the contents of a file
+
+        :param str filePath: The file to hash
+        :return str: The hex digest of the file contents
+        """
+        digest = hashlib.sha256()
+        with open(filePath, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def frame_key(df: "gp.GeoDataFrame") -> str:
+        """
+        Generate a cache key from the contents of a GeoDataFrame, including its CRS
+
+        :param GeoDataFrame df: The DataFrame to hash
+        :return str: The hex digest of the DataFrame contents
+        """
+        import numpy as np
+        import pandas as pd
+        import shapely
+
+        digest = hashlib.sha256()
+        crsName = "none" if df.crs is None else NetworkTileCache.crs_name(df.crs)
+        digest.update(crsName.encode("utf8"))
+        digest.update(",".join(map(str, df.columns)).encode("utf8"))
+        attributes = df.drop(columns=df.geometry.name)
+        if attributes.shape[1] > 0:
+            digest.update(
+                pd.util.hash_pandas_object(attributes, index=False).to_numpy()
+            )
+        coords = shapely.get_coordinates(df.geometry.values)
+        digest.update(np.ascontiguousarray(coords))
+        return digest.hexdigest()
 
-    def get_cached_geo_data_frame(self, file: str) -> gp.GeoDataFrame | None:
-        filePath = self._run_dir() / file
+    def _entry_path(self, stage: str, key: str) -> Path:
+        return self.entriesDir / stage / f"{key}{GeoCacheSuffixes[GeoCacheFormat]}"
+
+    def _record_entry(self, stage: str, key: str):
+        manifestPath = self._run_dir() / "manifest.json"
+        with self.manifestLock:
+            entries = set()
+            if manifestPath.exists():
+                with open(manifestPath, "r") as file:
+                    entries = set(json.load(file)["entries"])
+            entry = f"{stage}/{key}"
+            if entry not in entries:
+                entries.add(entry)
+                with open(manifestPath, "w") as file:
+                    json.dump({"entries": sorted(entries)}, file)
+
+    def _load(self, stage: str, key: str) -> "gp.GeoDataFrame | None":
+        import geopandas as gp
+
+        filePath = self._entry_path(stage, key)
         if filePath.exists() and filePath.is_file():
-            return joblib.load(filePath)
+            # Touch the entry so the eviction policy sees it as recently used
+            os.utime(filePath)
+            self._record_entry(stage, key)
+            if GeoCacheFormat == "geoparquet":
+                return gp.read_parquet(filePath, memory_map=True)
+            return gp.read_file(filePath)
         else:
             return None
 
-    def cache_geo_data_frame(self, file: str, df: gp.GeoDataFrame):
-        filePath = self._run_dir() / file
+    def _store(self, stage: str, key: str, df: "gp.GeoDataFrame"):
+        filePath = self._entry_path(stage, key)
+        filePath.parent.mkdir(parents=True, exist_ok=True)
         if filePath.exists():
             filePath.unlink()
-        joblib.dump(df, filePath)
+        if GeoCacheFormat == "geoparquet":
+            df.to_parquet(filePath)
+        else:
+            df.to_file(filePath, driver="FlatGeobuf")
+        self._record_entry(stage, key)
+
+    def clear_cache(self):
+        """
+        Clear the current run along with the entries it used that no other run uses
+        """
+        runDir = self._run_dir()
+        manifestPath = runDir / "manifest.json"
+        if manifestPath.exists():
+            with open(manifestPath, "r") as file:
+                entries = set(json.load(file)["entries"])
+
+            for otherManifest in self.baseDir.glob("*/manifest.json"):
+                if otherManifest != manifestPath:
+                    with open(otherManifest, "r") as file:
+                        entries -= set(json.load(file)["entries"])
+
+            for entry in entries:
+                stage, key = entry.split("/")
+                self._entry_path(stage, key).unlink(missing_ok=True)
+        shutil.rmtree(runDir)
+
+    def clear_cache_all(self):
+        shutil.rmtree(self.baseDir)
+
+    def get_cached_geo_data_frame(
+        self, stage: str, key: str
+    ) -> "gp.GeoDataFrame | None":
+        return self._load(stage, key)
+
+    def cache_geo_data_frame(self, stage: str, key: str, df: "gp.GeoDataFrame"):
+        self._store(stage, key, df)
 
-    def get_network(self, file: str) -> MultiDiGraph | None:
-        filePath = self._run_dir() / file
+    def _entries(self) -> list[tuple[str, Path, os.stat_result]]:
+        if not self.entriesDir.exists():
+            return []
+        return [
+            (path.parent.name, path, path.stat())
+            for path in self.entriesDir.glob("*/*")
+            if path.is_file()
+        ]
+
+    def stats(self) -> "pd.DataFrame":
+        """
+        Summarise the cache contents
+
+        :return DataFrame: The number of entries, total size in MB and age in days of the oldest and newest entry for each stage
+        """
+        import pandas as pd
+
+        now = time.time()
+        entries = pd.DataFrame(
+            [
+                {
+                    "stage": stage,
+                    "sizeMb": stat.st_size / 1e6,
+                    "ageDays": (now - stat.st_mtime) / 86400,
+                }
+                for stage, _, stat in self._entries()
+            ],
+            columns=["stage", "sizeMb", "ageDays"],
+        )
+        return entries.groupby("stage").agg(
+            entries=("sizeMb", "size"),
+            sizeMb=("sizeMb", "sum"),
+            oldestDays=("ageDays", "max"),
+            newestDays=("ageDays", "min"),
+        )
+
+    def prune(
+        self,
+        maxSizeMb: float = DEFAULT_MAX_SIZE_MB,
+        maxAgeDays: float = DEFAULT_MAX_AGE_DAYS,
+    ) -> tuple[int, float]:
+        """
+        Evict entries which have not been used for more than maxAgeDays, then evict the least recently used
+        entries until the cache is under maxSizeMb
+
+        :param float maxSizeMb: The maximum total size of the cache in MB
+        :param float maxAgeDays: The maximum number of days since an entry was last used
+        :return (int, float): The number of entries evicted and the MB freed
+        """
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[2].st_mtime)
+        totalSize = sum(stat.st_size for _, _, stat in entries)
+        evicted = 0
+        freed = 0
+
+        for _, path, stat in entries:
+            tooOld = (now - stat.st_mtime) / 86400 > maxAgeDays
+            tooBig = (totalSize - freed) / 1e6 > maxSizeMb
+            if not (tooOld or tooBig):
+                continue
+            # The service prunes from several threads at once
+            path.unlink(missing_ok=True)
+            evicted += 1
+            freed += stat.st_size
+
+        return evicted, freed / 1e6
+
+
+class NetworkTileCache:
+    """
+    Store of street network tiles shared between runs and regions. Each tile is keyed by the network type,
+    the CRS it is projected in and its position on a regular lat lng grid. The most recently used tiles are
+    also kept in memory.
+    """
+
+    def __init__(self, location: str, memoryTiles: int = DEFAULT_MEMORY_TILES):
+        self.baseDir = Path(location)
+        # When offline, missing tiles are an error rather than being downloaded
+        self.offline = False
+        self.memoryTiles = memoryTiles
+        self.memory: OrderedDict[Path, "CompactNetwork"] = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def crs_name(crs) -> str:
+        from pyproj import CRS
+
+        crs = CRS(crs)
+        epsg = crs.to_epsg()
+        if epsg is not None:
+            return f"epsg_{epsg}"
+        return hashlib.sha256(crs.to_wkt().encode("utf8")).hexdigest()[:16]
+
+    def _tile_path(self, mode: str, crs, tile: tuple[int, int]) -> Path:
+        return self.baseDir / mode / self.crs_name(crs) / f"{tile[0]}_{tile[1]}"
+
+    def get_tile(
+        self, mode: str, crs, tile: tuple[int, int]
+    ) -> "CompactNetwork | None":
+        from .network import CompactNetwork
+
+        tilePath = self._tile_path(mode, crs, tile)
+        with self.lock:
+            if tilePath in self.memory:
+                self.memory.move_to_end(tilePath)
+                return self.memory[tilePath]
+        if tilePath.exists() and tilePath.is_dir():
+            network = CompactNetwork.load(tilePath)
+            self._remember(tilePath, network)
+            return network
+        else:
+            return None
+
+    def _remember(self, tilePath: Path, network: "CompactNetwork"):
+        with self.lock:
+            self.memory[tilePath] = network
+            self.memory.move_to_end(tilePath)
+            while len(self.memory) > self.memoryTiles:
+                self.memory.popitem(last=False)
+
+    def set_tile(
+        self, mode: str, crs, tile: tuple[int, int], network: "CompactNetwork"
+    ):
+        tilePath = self._tile_path(mode, crs, tile)
+        with self.lock:
+            if tilePath.exists():
+                shutil.rmtree(tilePath)
+            network.save(tilePath)
+        self._remember(tilePath, network)
+
+    def _snap_index_path(self, mode: str, crs, key: str) -> Path:
+        return self.baseDir / mode / self.crs_name(crs) / "snapping" / f"{key}.npy"
+
+    def get_snap_index(self, mode: str, crs, key: str) -> "StreetSnapIndex | None":
+        from .network import StreetSnapIndex
+
+        filePath = self._snap_index_path(mode, crs, key)
         if filePath.exists() and filePath.is_file():
-            logInfo("Loading network from local cache")
-            return joblib.load(filePath)
+            return StreetSnapIndex.load(filePath)
         else:
             return None
 
-    def set_network(self, file: str, network: MultiDiGraph):
-        filePath = self._run_dir() / file
-        if filePath.exists():
-            filePath.unlink()
-        joblib.dump(network, filePath)
+    def set_snap_index(self, mode: str, crs, key: str, index: "StreetSnapIndex"):
+        index.save(self._snap_index_path(mode, crs, key))
+
+    def clear_snap_indexes(self, mode: str):
+        """
+        Remove the snapping indexes built from the tiles of a network type, used when the tiles change
+        """
+        for snappingDir in (self.baseDir / mode).glob("*/snapping"):
+            shutil.rmtree(snappingDir)
 
 
 RunCache = Cache()
+NetworkCache = NetworkTileCache(RunCache.baseDir / "networks")
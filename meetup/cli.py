@@ -1,24 +1,37 @@
 from typing import Optional
 from typing_extensions import Annotated
-from .geo import load_user_locations
-from .clustering import (
+from .options import (
+    DEFAULT_COORDINATE_PRECISION,
+    DEFAULT_JOB_WORKERS,
+    DEFAULT_MAX_AGE_DAYS,
+    DEFAULT_MAX_KEPT_JOBS,
+    DEFAULT_MAX_QUEUED_JOBS,
+    DEFAULT_MAX_SIZE_MB,
+    DEFAULT_PORT,
+    InitialClusteringMethod,
+    MailingListFormat,
     MeetingPointMethod,
-    generate_group_meeting_points,
-    run_clustering,
-    format_results,
+    OutputFormat,
+    RefinementMethod,
+    RunParameters,
 )
-from .geo import generate_cluster_convex_hull
-from .logging import logInfo
-from .caching import RunCache
-from .server import start_server
+from .logging import logInfo, console
+from .caching import RunCache, NetworkCache
+from .profiling import RunProfiler, cprofile
 from pathlib import Path
+from contextlib import nullcontext
 import typer
-import json
-import webbrowser
+
+# Commands are often run from scripts, so the modules pulling in the geospatial and machine learning libraries
+# are only imported inside the commands that use them to keep startup fast
 
 from meetup import __app_name__, __version__
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Inspect and prune the cache shared between runs")
+app.add_typer(cache_app, name="cache")
+network_app = typer.Typer(help="Manage the street network tiles shared between runs")
+app.add_typer(network_app, name="network")
 
 
 @app.command()
@@ -34,6 +47,53 @@ def clear(
     RunCache.clear_cache()
 
 
+@cache_app.command("stats")
+def cache_stats() -> None:
+    stats = RunCache.stats()
+    if stats.shape[0] == 0:
+        logInfo("The cache is empty")
+        return
+    console.print(stats.round(2))
+    logInfo(
+        f"Total: [bold white]{stats.entries.sum()}[/bold white] entries using [bold white]{stats.sizeMb.sum():.1f}MB[/bold white]"
+    )
+
+
+@cache_app.command("prune")
+def cache_prune(
+    max_size_mb: Annotated[
+        float,
+        typer.Option(
+            help="Evict the least recently used entries until the cache is under this size"
+        ),
+    ] = DEFAULT_MAX_SIZE_MB,
+    max_age_days: Annotated[
+        float,
+        typer.Option(help="Evict entries not used in this many days"),
+    ] = DEFAULT_MAX_AGE_DAYS,
+) -> None:
+    evicted, freed = RunCache.prune(max_size_mb, max_age_days)
+    logInfo(f"Evicted {evicted} cache entries freeing {freed:.1f}MB")
+
+
+@network_app.command("import")
+def network_import(
+    network_file: Annotated[
+        str,
+        typer.Argument(
+            help="An OSM XML (.osm) file or a graphml file saved by osmnx covering the region to be stored"
+        ),
+    ],
+    mode: Annotated[
+        str,
+        typer.Option(help="The network type to store the tiles as"),
+    ] = "bike",
+) -> None:
+    from .geo import import_network
+
+    import_network(network_file, mode)
+
+
 @app.command()
 def visualize(
     run_name: Annotated[
@@ -42,11 +102,55 @@ def visualize(
             help="The output name for this run. Once the script has run you will find your results in {run_name}/results.csv and if visualization is requested {run_name}/outputname.png"
         ),
     ],
+    port: Annotated[
+        int, typer.Option(help="The port to serve the visualization on")
+    ] = DEFAULT_PORT,
 ) -> None:
+    import webbrowser
+    from .server import start_server
+
     RunCache.set_run_name(run_name)
-    logInfo("Starting Server at http://localhost:8000/")
-    webbrowser.open("http://localhost:8000")
-    start_server(run_name)
+    logInfo(f"Starting Server at http://localhost:{port}/")
+    webbrowser.open(f"http://localhost:{port}")
+    start_server(run_name, port)
+
+
+@app.command()
+def serve(
+    port: Annotated[
+        int, typer.Option(help="The port to accept jobs on")
+    ] = DEFAULT_PORT,
+    workers: Annotated[
+        int,
+        typer.Option(
+            help="Number of jobs clustered at once. Each worker is a thread sharing the caches of the service"
+        ),
+    ] = DEFAULT_JOB_WORKERS,
+    queue_size: Annotated[
+        int,
+        typer.Option(
+            help="Number of jobs that can wait for a worker. Submissions beyond this are rejected with a 503 until the queue drains"
+        ),
+    ] = DEFAULT_MAX_QUEUED_JOBS,
+    keep_jobs: Annotated[
+        int,
+        typer.Option(
+            help="Number of finished jobs whose results are kept in memory to be fetched"
+        ),
+    ] = DEFAULT_MAX_KEPT_JOBS,
+    offline: Annotated[
+        bool,
+        typer.Option(
+            help="Only use street network tiles already in the local store, never download them"
+        ),
+    ] = False,
+) -> None:
+    from .server import start_service
+
+    RunCache.set_run_name("service")
+    NetworkCache.offline = offline
+    logInfo(f"Accepting jobs at http://localhost:{port}/api/jobs")
+    start_service(port, workers, queue_size, keep_jobs)
 
 
 @app.command()
@@ -54,7 +158,7 @@ def run(
     user_locations: Annotated[
         str,
         typer.Argument(
-            help="The file containing the user locations. We require that this file is a csv format and that it contains columns for userid, latitude and longitude"
+            help="The file containing the user locations. This can be a csv, parquet or arrow (.arrow/.feather) file and must contain columns for userid, latitude and longitude"
         ),
     ],
     run_name: Annotated[
@@ -97,18 +201,129 @@ def run(
             help='Name of the logitude column in the input dataset. Defaults to "logitude" '
         ),
     ] = "longitude",
+    float32: Annotated[
+        bool,
+        typer.Option(
+            help="Read the coordinates as 32 bit floats, reducing memory for very large inputs at the cost of sub meter precision"
+        ),
+    ] = False,
     meeting_point_method: Annotated[
         Optional[MeetingPointMethod],
         typer.Option(
-            help="Meeting point method, one of 'centroid', 'centroid_snapped_to_street_network or landmark"
+            help="Meeting point method, one of 'centroid', 'centroid_snapped_to_street', 'network_median' or 'network_minimax'"
         ),
     ] = MeetingPointMethod.CENTROID,
+    snap_min_street_count: Annotated[
+        int,
+        typer.Option(
+            help="With centroid_snapped_to_street, only snap to street nodes where at least this many streets meet. 3 snaps to intersections rather than dead ends or bends"
+        ),
+    ] = 1,
+    initial_method: Annotated[
+        InitialClusteringMethod,
+        typer.Option(
+            help="Algorithm used to generate the initial groups, one of 'kmeans', 'affinity_propagation' or 'network_kmeans'. affinity_propagation needs memory proportional to the square of the number of users, network_kmeans groups users by cycling distance and downloads the street network"
+        ),
+    ] = InitialClusteringMethod.KMEANS,
+    refine_method: Annotated[
+        RefinementMethod,
+        typer.Option(
+            help="How groups are brought within the occupancy bounds, one of 'iterative' (repeated split and merge, not guarenteed) or 'balanced' (capacity constrained kmeans solved in one go)"
+        ),
+    ] = RefinementMethod.ITERATIVE,
+    aggregate_resolution: Annotated[
+        Optional[float],
+        typer.Option(
+            help="Size in meters of a grid used to aggregate co-located users before clustering, e.g. 50. Each cell is clustered as a single weighted point, which makes dense inputs much faster to group"
+        ),
+    ] = None,
+    base_run: Annotated[
+        Optional[str],
+        typer.Option(
+            help="Output folder of a previous run. Users keep their groups from that run, new users join the nearest group and only groups outside the occupancy bounds are split or merged"
+        ),
+    ] = None,
+    offline: Annotated[
+        bool,
+        typer.Option(
+            help="Only use street network tiles already in the local store, never download them"
+        ),
+    ] = False,
+    workers: Annotated[
+        Optional[int],
+        typer.Option(
+            help="Number of processes to use. When more than one, the users are split in to spatial tiles which are clustered in parallel, or with --restarts the restarts run in parallel"
+        ),
+    ] = None,
+    tile_size_km: Annotated[
+        Optional[float],
+        typer.Option(
+            help="Side length in km of the spatial tiles used to partition the users. Setting this enables partitioned clustering, defaults to 10km when --workers is set"
+        ),
+    ] = None,
+    restarts: Annotated[
+        int,
+        typer.Option(
+            help="Cluster the users this many times with different seeds in parallel and keep the grouping with the fewest groups outside the occupancy bounds, then the shortest average distance of users to their group's centroid"
+        ),
+    ] = 1,
+    seed: Annotated[
+        Optional[int],
+        typer.Option(
+            help="Seed for the random steps of the clustering, the same seed and inputs always give the same groups"
+        ),
+    ] = None,
+    mailing_list_format: Annotated[
+        MailingListFormat,
+        typer.Option(
+            help="Layout of the mailing list, 'denormalized' writes mailingList.csv with every group member on each row, 'normalized' writes groups.csv and user_groups.csv instead and 'both' writes all three"
+        ),
+    ] = MailingListFormat.DENORMALIZED,
+    output_format: Annotated[
+        OutputFormat,
+        typer.Option(
+            help="Format of the geographic outputs, one of 'geojson', 'geojson_gz', 'flatgeobuf' or 'geoparquet'. The visualization reads any of them"
+        ),
+    ] = OutputFormat.GEOJSON,
+    coordinate_precision: Annotated[
+        Optional[int],
+        typer.Option(
+            help="Number of decimal places kept in the exported coordinates, 6 is roughly 10cm"
+        ),
+    ] = DEFAULT_COORDINATE_PRECISION,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            help="Run under cProfile and save the stats to {run_name}/profile.prof, for viewing with snakeviz or flameprof"
+        ),
+    ] = False,
 ) -> None:
+    from .pipeline import run_pipeline, write_run_details
+
+    parameters = RunParameters(
+        minOccupancy=min_occupancy,
+        maxOccupancy=max_occupancy,
+        maxIters=max_optomization_iterations,
+        meetingPointMethod=meeting_point_method,
+        snapMinStreetCount=snap_min_street_count,
+        initialMethod=initial_method,
+        refineMethod=refine_method,
+        aggregateResolution=aggregate_resolution,
+        baseRun=base_run,
+        workers=workers,
+        tileSizeKm=tile_size_km,
+        restarts=restarts,
+        seed=seed,
+        mailingListFormat=mailing_list_format,
+        outputFormat=output_format,
+        coordinatePrecision=coordinate_precision,
+    )
     logInfo(
         f"[bold yellow]💾[/bold yellow] Generating groups for input file [bold white]{user_locations}[/bold white]"
     )
 
     RunCache.set_run_name(run_name)
+    NetworkCache.offline = offline
     outputDir = Path(run_name)
 
     if not outputDir.exists():
@@ -122,37 +337,24 @@ def run(
     if max_occupancy is not None:
         logInfo(f"Will try to ensure that no group has more than {max_occupancy}")
 
-    locations = load_user_locations(user_locations, lat_col, lng_col, user_id_col)
-
-    groupAssignments = run_clustering(
-        locations, min_occupancy, max_occupancy, max_optomization_iterations
-    )
-    groupMeetingPoints = generate_group_meeting_points(
-        groupAssignments, meeting_point_method
-    )
-    groupRegions = generate_cluster_convex_hull(groupAssignments)
-
-    groupAssignments.to_crs("epsg:4326").to_file(
-        outputDir / "usersAssignments.geojson", driver="GeoJSON"
-    )
-    groupMeetingPoints.to_crs("epsg:4326").to_file(
-        outputDir / "groupMeetingPoints.geojson", driver="GeoJSON"
-    )
-    groupRegions.to_crs("epsg:4326").to_file(
-        outputDir / "groupRegions.geojson", driver="GeoJSON"
-    )
+    RunProfiler.reset()
+    with cprofile(outputDir / "profile.prof") if profile else nullcontext():
+        run_pipeline(
+            user_locations,
+            outputDir,
+            parameters,
+            lat_col,
+            lng_col,
+            user_id_col,
+            float32,
+        )
+    write_run_details(outputDir, run_name, parameters, RunProfiler.report())
 
-    results = format_results(groupAssignments, groupMeetingPoints)
-    results.to_csv(outputDir / "mailingList.csv", index=False)
-
-    with open(outputDir / "runDetails.json", "w") as file:
-        json.dump(
-            {
-                "minOccupancy": min_occupancy,
-                "maxOccupancy": max_occupancy,
-                "maxIters": max_optomization_iterations,
-                "meetingPointMethod": meeting_point_method,
-                "name": run_name,
-            },
-            file,
+    if profile:
+        logInfo(
+            f"Saved profile to [bold white]{outputDir / 'profile.prof'}[/bold white]"
         )
+
+    evicted, freed = RunCache.prune()
+    if evicted > 0:
+        logInfo(f"Evicted {evicted} old cache entries freeing {freed:.1f}MB")
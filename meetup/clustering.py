@@ -1,31 +1,169 @@
+import inspect
 import math
+import time
+from pathlib import Path
 import pandas as pd
 import geopandas as gp
 import numpy as np
 from typing import Optional
 from .geo import (
+    aggregate_user_locations,
     generate_group_centroids,
-    get_network_graph,
+    group_centroids,
+    point_coordinates,
+    point_weights,
+    get_compact_network,
+    get_snap_index,
+    network_knn_graph,
+    network_meeting_points,
     snap_points_to_street_network,
 )
 from .logging import logInfo, logWarning
+from .profiling import span
 from .caching import RunCache
-from enum import Enum
-from sklearn.neighbors import KDTree
+from .options import (
+    InitialClusteringMethod,
+    MailingListFormat,
+    MeetingPointMethod,
+    RefinementMethod,
+)
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from scipy.optimize import linprog
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from pyproj import Transformer
+
+from sklearn.cluster import KMeans, MiniBatchKMeans, AffinityPropagation
+
+# Group size we aim for when no occupancy bounds are given
+DEFAULT_TARGET_OCCUPANCY = 25
+
+# When users are aggregated in to grid cells, the most users a single cell can stand for as a fraction of the
+# maximum occupancy, leaving room to split and merge groups between cells
+MAX_CELL_WEIGHT_FRACTION = 0.25
+
+
+def spawn_seeds(seed: Optional[int], count: int) -> list[Optional[int]]:
+    """
+    Derive independent seeds for the random steps of a seeded run from a single seed
 
-from sklearn.cluster import KMeans, AffinityPropagation
+    param Optional[int] seed: The seed of the run, if None each step is seeded randomly
+    param int count: The number of seeds to derive
+    return [Optional[int]]: The derived seeds, all None if the seed is None
+    """
+    if seed is None:
+        return [None] * count
+    return [
+        int(child.generate_state(1)[0])
+        for child in np.random.SeedSequence(seed).spawn(count)
+    ]
 
 
-class MeetingPointMethod(str, Enum):
+class NetworkKMeans:
     """
-    Enum representing different strategies for generating a meeting point
-    CENTROID : Simply take the centroid of the group
-    CENTROID_SNAPED_TO_STREET: Calculate the centroid but then use the bike network graph to ensure that it's at a street intersection
-    LANDMARK: Try to find landmarks close the centroid to use as the meeting spot
+    KMeans where the distance between users is how far they would cycle. Users are linked to their nearest
+    neighbours in a sparse graph weighted by network distance, each group is centred on one of its members and
+    every round assigns each user to the centre it can reach with the least cycling, with a single multi-source
+    Dijkstra over the graph. The centres start from euclidean MiniBatch KMeans and each round move to the member
+    closest to their group's centroid. Follows the sklearn fit / labels_ interface so it can be passed to cluster.
     """
 
-    CENTROID = ("centroid",)
-    CENTROID_SNAPED_TO_STREET = "centroid_snapped_to_street"
+    def __init__(
+        self,
+        n_clusters: int,
+        crs,
+        neighbours: int = 10,
+        max_iter: int = 10,
+        mode: str = "bike",
+        random_state: Optional[int] = None,
+    ):
+        self.n_clusters = n_clusters
+        self.crs = crs
+        self.neighbours = neighbours
+        self.max_iter = max_iter
+        self.mode = mode
+        self.random_state = random_state
+
+    def get_params(self) -> dict:
+        return {
+            "n_clusters": self.n_clusters,
+            "crs": str(self.crs),
+            "neighbours": self.neighbours,
+            "max_iter": self.max_iter,
+            "mode": self.mode,
+            "random_state": self.random_state,
+        }
+
+    def fit(
+        self, coords: np.ndarray, sample_weight: Optional[np.ndarray] = None
+    ) -> "NetworkKMeans":
+        noUsers = coords.shape[0]
+        nClusters = max(1, min(self.n_clusters, noUsers))
+        initial = MiniBatchKMeans(
+            n_clusters=nClusters,
+            n_init=3,
+            batch_size=4096,
+            random_state=self.random_state,
+        ).fit(coords, sample_weight=sample_weight)
+
+        transformer = Transformer.from_crs(self.crs, "epsg:4326", always_xy=True)
+        lng, lat = transformer.transform(coords[:, 0], coords[:, 1])
+        network = get_compact_network(
+            (lng.min(), lat.min(), lng.max(), lat.max()), self.mode, self.crs
+        )
+        if network.number_of_nodes == 0 or noUsers < 2:
+            logWarning(
+                "No street network found for the users, falling back to straight line distances"
+            )
+            self.labels_ = initial.labels_
+            return self
+
+        with span("network_knn_graph", users=noUsers) as stage:
+            graph = network_knn_graph(coords, network, self.neighbours)
+            stage.counts["edges"] = graph.nnz
+
+        centres = np.unique(cKDTree(coords).query(initial.cluster_centers_)[1])
+        for iteration in range(self.max_iter):
+            labels = self._assign(graph, coords, centres)
+            uniqueLabels, centroids = group_centroids(coords, labels, sample_weight)
+            # Move each centre to the member nearest its group's centroid
+            distance = np.linalg.norm(
+                coords - centroids[np.searchsorted(uniqueLabels, labels)], axis=1
+            )
+            order = np.lexsort((distance, labels))
+            first = np.ones(noUsers, dtype=bool)
+            first[1:] = labels[order][1:] != labels[order][:-1]
+            newCentres = np.sort(order[first])
+            if np.array_equal(newCentres, centres):
+                break
+            centres = newCentres
+
+        self.labels_ = np.unique(
+            self._assign(graph, coords, centres), return_inverse=True
+        )[1]
+        return self
+
+    @staticmethod
+    def _assign(graph, coords: np.ndarray, centres: np.ndarray) -> np.ndarray:
+        """
+        Labels each user with the position of the centre it can reach with the least cycling. Users the graph
+        doesn't connect to any centre take the nearest centre as the crow flies.
+        """
+        _, _, sources = dijkstra(
+            graph,
+            directed=False,
+            indices=centres,
+            min_only=True,
+            return_predecessors=True,
+        )
+        centrePosition = np.full(coords.shape[0], -1)
+        centrePosition[centres] = np.arange(centres.shape[0])
+        labels = np.where(sources >= 0, centrePosition[np.maximum(sources, 0)], -1)
+        unreached = labels < 0
+        if unreached.any():
+            labels[unreached] = cKDTree(coords[centres]).query(coords[unreached])[1]
+        return labels
 
 
 def cluster(clusterAlgo, df: gp.GeoDataFrame) -> gp.GeoDataFrame:
@@ -33,7 +171,7 @@ def cluster(clusterAlgo, df: gp.GeoDataFrame) -> gp.GeoDataFrame:
     Apply the provided clustering algoritum and return a dataframe with the generated labels
 
     param clusterAlgo: The algorithum used to cluster the points. Must have a fit function (as in scipy) and expose a labels_ property after the fit
-    param GeoDataFrame df: The DataFrame to cluster
+    param GeoDataFrame df: The DataFrame to cluster. If it has a weight column the points are weighted by it when the algorithum supports sample weights
     return GeoDataFrame: The input DataFrame with the clustering labels attached
     """
 
@@ -44,191 +182,626 @@ def cluster(clusterAlgo, df: gp.GeoDataFrame) -> gp.GeoDataFrame:
         getattr(clusterAlgo, "fit", None)
     ), "clusterAlgo should be a valid clustering algoritum like KMeans or AffinityPropagation"
 
-    clusters = clusterAlgo.fit(np.array(list(zip(df.geometry.x, df.geometry.y))))
+    weights = point_weights(df)
+    if weights is None:
+        clusters = clusterAlgo.fit(point_coordinates(df))
+    elif "sample_weight" in inspect.signature(clusterAlgo.fit).parameters:
+        clusters = clusterAlgo.fit(point_coordinates(df), sample_weight=weights)
+    else:
+        logWarning(
+            f"{type(clusterAlgo).__name__} can't weight points, so aggregated cells count as single users when generating the initial groups"
+        )
+        clusters = clusterAlgo.fit(point_coordinates(df))
     return gp.GeoDataFrame(df.assign(label=clusters.labels_))
 
 
-def merge_clusters(df: gp.GeoDataFrame, minOccupancy: int):
+def target_group_count(
+    noUsers: int, minOccupancy: Optional[int], maxOccupancy: Optional[int]
+) -> int:
     """
-    Identifies clusters which are bellow the minimum occupancy threshold and tries to merge
-    them with neighboring clusters.
+    Estimate how many groups we should generate to get groups within the occupancy bounds.
+    We aim for the middle of the range, or just inside it when only one bound is given
 
-    param GeoDataFrame df: The DataFrame to perform meges on
-    return GeoDataFrame: The resulting DataFrame with the clusters merged
+    param int noUsers: The number of users to be grouped
+    param Optional[int] minOccupancy: The minimum group occupancy if specified
+    param Optional[int] maxOccupancy: The maximum group occupancy if specified
+    return int: The number of groups to generate
     """
+    if minOccupancy is not None and maxOccupancy is not None:
+        targetOccupancy = (minOccupancy + maxOccupancy) / 2
+    elif maxOccupancy is not None:
+        targetOccupancy = min(DEFAULT_TARGET_OCCUPANCY, maxOccupancy * 0.75)
+    elif minOccupancy is not None:
+        targetOccupancy = max(DEFAULT_TARGET_OCCUPANCY, minOccupancy * 1.5)
+    else:
+        targetOccupancy = DEFAULT_TARGET_OCCUPANCY
 
-    # Get a list of clusters that dont meet our min occupancy limit
-    clusterValueCounts = df.label.value_counts()
-    clustersToMerge = clusterValueCounts[clusterValueCounts < minOccupancy].index
-
-    # Generate the centroids for the clusters
-    clusterCentroids = generate_group_centroids(df).set_index("label")
-    centroidCoords = [[geom.x, geom.y] for geom in clusterCentroids.geometry]
+    return int(max(1, min(noUsers, round(noUsers / max(targetOccupancy, 1)))))
 
-    # Build a KDTree using the cluster centroids
-    tree = KDTree(centroidCoords)
 
-    # Build a lookup to easily map between the tree indexes and the labels
-    treeToFrameLookup = dict(
-        zip(range(len(centroidCoords)), list(clusterCentroids.index))
-    )
+def initial_clustering_algorithm(
+    method: InitialClusteringMethod,
+    noUsers: int,
+    minOccupancy: Optional[int] = None,
+    maxOccupancy: Optional[int] = None,
+    crs=None,
+    seed: Optional[int] = None,
+    noPoints: Optional[int] = None,
+):
+    """
+    Build the clustering algorithum used to generate the inital proposal clusters
+
+    param InitialClusteringMethod method: Which algorithum to use
+    param int noUsers: The number of users that will be clustered
+    param Optional[int] minOccupancy: The minimum group occupancy, used to size the number of clusters
+    param Optional[int] maxOccupancy: The maximum group occupancy, used to size the number of clusters
+    param crs: The projected CRS of the users, needed by NETWORK_KMEANS to fetch the street network
+    param Optional[int] seed: If specified, the random state of the algorithum so the clusters can be reproduced
+    param Optional[int] noPoints: The number of points fitted when the users are aggregated in to cells. There can't be more clusters than points
+    return: An unfitted clustering algorithum which can be passed to cluster
+    """
+    noClusters = target_group_count(noUsers, minOccupancy, maxOccupancy)
+    if noPoints is not None:
+        noClusters = max(1, min(noClusters, noPoints))
+    match method:
+        case InitialClusteringMethod.KMEANS:
+            return MiniBatchKMeans(
+                n_clusters=noClusters,
+                n_init=3,
+                batch_size=4096,
+                random_state=seed,
+            )
+        case InitialClusteringMethod.AFFINITY_PROPAGATION:
+            return AffinityPropagation(damping=0.95, verbose=True, random_state=seed)
+        case InitialClusteringMethod.NETWORK_KMEANS:
+            if crs is None:
+                raise Exception("Network clustering needs the CRS of the users")
+            return NetworkKMeans(
+                n_clusters=noClusters,
+                crs=crs,
+                random_state=seed,
+            )
+        case _:
+            raise ValueError(f"Unknown initial clustering method {method}")
 
-    # Keep track of the clusters we have merged already this iteration so we can exclude them from
-    # future merge attempts
 
-    clustersNotToConsider = []
+def merge_labels(
+    coords: np.ndarray,
+    labels: np.ndarray,
+    minOccupancy: int,
+    maxPasses: int = 10,
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Array based merge engine. Clusters bellow the minimum occupancy are merged in to the smallest of their
+    nearest neighboring clusters. Each pass merges every undersized cluster at most once and clusters that
+    have taken part in a merge are not considered again in that pass. Cluster centroids and sizes are updated
+    as the merges happen so later passes see the merged clusters.
+
+    param ndarray coords: (n, 2) array of the point coordinates
+    param ndarray labels: The cluster label of each point
+    param int minOccupancy: The minimum number of points each cluster should contain
+    param int maxPasses: The maximum number of merge passes to make
+    param ndarray weights: The number of users each point stands for, if None every point is one user
+    return ndarray: The new label of each point. Merged clusters take the label of the cluster they merged in to
+    """
+    uniqueLabels, codes = np.unique(labels, return_inverse=True)
+    noClusters = uniqueLabels.shape[0]
+    if weights is None:
+        weights = np.ones(codes.shape[0])
+
+    sizes = np.bincount(codes, weights=weights, minlength=noClusters)
+    sums = np.stack(
+        [
+            np.bincount(codes, weights=coords[:, 0] * weights, minlength=noClusters),
+            np.bincount(codes, weights=coords[:, 1] * weights, minlength=noClusters),
+        ],
+        axis=1,
+    )
+    centroids = sums / sizes[:, None]
 
-    # Keep track of the mappings of mergers
-    mergers = {}
+    # Lookup table from each cluster to the cluster it was merged in to
+    mergedInto = np.arange(noClusters)
+    alive = np.ones(noClusters, dtype=bool)
 
-    for clusterLabelToMerge in clustersToMerge:
-        if clusterLabelToMerge in clustersNotToConsider:
-            continue
+    for _ in range(maxPasses):
+        aliveClusters = np.flatnonzero(alive)
+        clustersToMerge = aliveClusters[sizes[aliveClusters] < minOccupancy]
+        if clustersToMerge.shape[0] == 0 or aliveClusters.shape[0] < 2:
+            break
 
-        clusterCentroid = centroidCoords[
-            list(clusterCentroids.index).index(clusterLabelToMerge)
+        # Consider the largest of the undersized clusters first
+        clustersToMerge = clustersToMerge[
+            np.argsort(-sizes[clustersToMerge], kind="stable")
         ]
-        _, potentialMerges = tree.query(
-            [clusterCentroid], min(4, clusterCentroids.shape[0])
+
+        # Build a KDTree of the current centroids and find the 4 nearest neighbours of each cluster to merge
+        tree = cKDTree(centroids[aliveClusters])
+        _, neighbours = tree.query(
+            centroids[clustersToMerge], min(4, aliveClusters.shape[0])
         )
-        potentialMergerLabels = [
-            treeToFrameLookup[index] for index in potentialMerges[0]
-        ]
+        neighbours = aliveClusters[neighbours.reshape(clustersToMerge.shape[0], -1)]
 
-        # Filter the poetnital mergers to exclude self and things that have already been merged this turn
-        potentialMergerLabels = [
-            label
-            for label in potentialMergerLabels
-            if label != clusterLabelToMerge and not label in clustersNotToConsider
-        ]
+        # Keep track of the clusters we have merged already this pass so we can exclude them from
+        # future merge attempts
+        merged = np.zeros(noClusters, dtype=bool)
+        noMerges = 0
+
+        for clusterToMerge, potentialMergers in zip(clustersToMerge, neighbours):
+            if merged[clusterToMerge]:
+                continue
+
+            potentialMergers = potentialMergers[
+                (potentialMergers != clusterToMerge) & ~merged[potentialMergers]
+            ]
+            if potentialMergers.shape[0] == 0:
+                continue
+
+            # Merge in to the smallest avaliable neighbour and update its centroid
+            target = potentialMergers[np.argmin(sizes[potentialMergers])]
+            sizes[target] += sizes[clusterToMerge]
+            sums[target] += sums[clusterToMerge]
+            centroids[target] = sums[target] / sizes[target]
 
-        if len(potentialMergerLabels) == 0:
-            continue
+            mergedInto[clusterToMerge] = target
+            alive[clusterToMerge] = False
+            merged[clusterToMerge] = True
+            merged[target] = True
+            noMerges += 1
 
-        # Get the sizes of the potental mergers
-        potentialMergerSizes = clusterValueCounts.loc[potentialMergerLabels]
-        # Select the smallest
-        smallestAvaliableCluster = potentialMergerSizes.idxmin()
+        if noMerges == 0:
+            break
 
-        # Use this as the merge target
-        mergers[clusterLabelToMerge] = smallestAvaliableCluster
+    # Follow chains of merges from earlier passes through to the surviving cluster
+    while True:
+        resolved = mergedInto[mergedInto]
+        if np.array_equal(resolved, mergedInto):
+            break
+        mergedInto = resolved
 
-        # Record both the current cluster and the merge in the exclusing list
-        clustersNotToConsider.append(clusterLabelToMerge)
-        clustersNotToConsider.append(smallestAvaliableCluster)
+    return uniqueLabels[mergedInto[codes]]
 
-    # Perform the merges
-    df["label"] = df["label"].apply(
-        lambda label: mergers[label] if label in mergers else label
+
+def merge_clusters(df: gp.GeoDataFrame, minOccupancy: int):
+    """
+    Identifies clusters which are bellow the minimum occupancy threshold and tries to merge
+    them with neighboring clusters.
+
+    param GeoDataFrame df: The DataFrame to perform meges on. If it has a weight column, each point counts as that many users
+    return GeoDataFrame: The resulting DataFrame with the clusters merged
+    """
+    coords = point_coordinates(df)
+    df["label"] = merge_labels(
+        coords, df.label.to_numpy(), minOccupancy, weights=point_weights(df)
     )
     return df
 
 
 def improve_clusters(
-    df, minOccupancy: Optional[int], maxOccupancy: Optional[int], maxIters: int = 10
+    df,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int = 10,
+    verbose: bool = True,
+    workers: Optional[int] = None,
+    seed: Optional[int] = None,
+    stableLabels: bool = False,
 ) -> gp.GeoDataFrame:
     """
     Itteratively try to get the clusters between the specified min and max Occupancy. Gives up after maxIters
 
-    param GeoDataFrame df: The DataFrame of clusters to attempt to improve
+    param GeoDataFrame df: The DataFrame of clusters to attempt to improve. If it has a weight column, each point counts as that many users
     param Optional[int] minOccupancy: If specified, the minimum occupancy that each cluster should attempt to reach
     param Optional[int] maxOccupancy: If specified, the maximm occupancy that each cluster should attempt to reach
     param int maxIters: The maximum merge, split iterations to attempt before giving up
+    param bool verbose: Log the progress of each iteration
+    param Optional[int] workers: If specified, the number of threads used to split clusters in parallel
+    param Optional[int] seed: If specified, seeds the splits so the clusters can be reproduced
+    param bool stableLabels: Keep the labels of the clusters which aren't split, rather than renumbering them sequentially
 
     return GeoDataFrame: The resulting DataFrame with the hopefully improved clusters
 
     """
-    improvedClusters = df.copy()
+    # Work on the coordinates and labels as arrays, only building the DataFrame once at the end
+    coords = point_coordinates(df)
+    weights = point_weights(df)
+    labels = df.label.to_numpy()
+    iterationSeeds = spawn_seeds(seed, maxIters)
     for iteration in range(0, maxIters):
-        if maxOccupancy is not None:
-            improvedClusters = split_clusters(improvedClusters, maxOccupancy)
-
-        if minOccupancy is not None:
-            improvedClusters = merge_clusters(improvedClusters, minOccupancy)
+        with span("improve_clusters_iteration", iteration=iteration + 1) as stage:
+            if maxOccupancy is not None:
+                labels = split_labels(
+                    coords,
+                    labels,
+                    maxOccupancy,
+                    workers,
+                    weights,
+                    iterationSeeds[iteration],
+                    stableLabels,
+                )
+
+            if minOccupancy is not None:
+                labels = merge_labels(coords, labels, minOccupancy, weights=weights)
+
+            cluster_counts = np.bincount(
+                np.unique(labels, return_inverse=True)[1], weights=weights
+            )
 
-        cluster_counts = improvedClusters.label.value_counts()
+            numberUnderThreshold = (
+                0
+                if minOccupancy is None
+                else int((cluster_counts < minOccupancy).sum())
+            )
+            numberOverThreshold = (
+                0
+                if maxOccupancy is None
+                else int((cluster_counts > maxOccupancy).sum())
+            )
+            stage.counts.update(
+                groups=cluster_counts.shape[0],
+                underMin=numberUnderThreshold,
+                overMax=numberOverThreshold,
+            )
 
-        allClustersOverMinOccupancy = (
-            True if minOccupancy is None else (cluster_counts >= minOccupancy).all()
-        )
-        allClustersUndexMaxOccupancy = (
-            True if maxOccupancy is None else (cluster_counts <= maxOccupancy).all()
-        )
+        if verbose:
+            logInfo(
+                f"After {iteration+1} iterations, we have {numberUnderThreshold} clusters smaller min and {numberOverThreshold} larger than max"
+            )
 
-        numberUnderThreshold = (cluster_counts < minOccupancy).sum()
-        numberOverThreshold = (cluster_counts > maxOccupancy).sum()
+        if numberUnderThreshold == 0 and numberOverThreshold == 0:
+            if verbose:
+                logInfo("🎉 We succesfully managed to tame the groups!")
+            return gp.GeoDataFrame(df.assign(label=labels))
 
-        logInfo(
-            f"After {iteration+1} iterations, we have {numberUnderThreshold} clusters smaller min and {numberOverThreshold} larger than max"
+    if verbose:
+        logWarning(
+            f"😭 After {maxIters} tries, we where unable to get all groups within the given ranges. Either increase the number of iterations or relax parameters"
         )
+    # After maxIters reached, give up and return the clusters as is
+    return gp.GeoDataFrame(df.assign(label=labels))
 
-        if allClustersOverMinOccupancy and allClustersUndexMaxOccupancy:
-            logInfo("🎉 We succesfully managed to tame the groups!")
-            return improvedClusters
 
-    logWarning(
-        f"😭 After {maxIters} tries, we where unable to get all groups within the given ranges. Either increase the number of iterations or relax parameters"
+def _split_cluster(
+    coords: np.ndarray,
+    maxOccupancy: int,
+    weights: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Split a single cluster in to n sub clusters using KMeans, where n is the ceiling of the cluster size
+    divided by the maximum occupancy
+
+    param ndarray coords: (n, 2) array of the coordinates of the points in the cluster
+    param int maxOccupancy: The maximum occupancy of each group
+    param ndarray weights: The number of users each point stands for, if None every point is one user
+    param Optional[int] seed: If specified, the random state of KMeans
+    return ndarray: The sub cluster label of each point, starting at 0
+    """
+    if weights is None:
+        targetNoSplits = math.ceil(coords.shape[0] / maxOccupancy)
+    else:
+        # A cluster of a few heavy points can't be split in to more parts than it has points
+        targetNoSplits = min(math.ceil(weights.sum() / maxOccupancy), coords.shape[0])
+    return (
+        KMeans(n_clusters=targetNoSplits, n_init="auto", random_state=seed)
+        .fit(coords, sample_weight=weights)
+        .labels_
     )
-    # After maxIters reached, give up and return the clusters as is
-    return improvedClusters
 
 
-def split_clusters(df, maxOccupancy: int = 40):
+def split_labels(
+    coords: np.ndarray,
+    labels: np.ndarray,
+    maxOccupancy: int = 40,
+    workers: Optional[int] = None,
+    weights: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+    stableLabels: bool = False,
+) -> np.ndarray:
     """
-    Split clusters which are above the occpancy threshold in to smaller clusters by internally clustering using KMeans
-    We generate n new clusters where n is the ceiling of the current cluster count divided by the maximum occupancy
+    Array based split engine. Every cluster above the maximum occupancy is split in one pass by running
+    KMeans on its members, optionally spread across a pool of threads.
 
-    param GeoDataFrame df: The input dataframe, it should have the following fields "label", "geometry"
+    param ndarray coords: (n, 2) array of the point coordinates
+    param ndarray labels: The cluster label of each point
     param int maxOccupancy: The maximum occupancy of each group. Defaults to 40
+    param Optional[int] workers: If specified, the number of threads used to split clusters in parallel
+    param ndarray weights: The number of users each point stands for, if None every point is one user
+    param Optional[int] seed: If specified, seeds the split of each cluster so the result doesn't depend on the order the threads run in
+    param bool stableLabels: Keep the labels of the clusters which aren't split. The largest part of a split cluster keeps its label and the other parts get new labels above the largest existing one
+    return ndarray: The new label of each point, sequential unless stableLabels is set
     """
+    uniqueLabels, codes = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(codes)
+    occupancy = sizes if weights is None else np.bincount(codes, weights=weights)
+    clustersToSplit = np.flatnonzero(occupancy > maxOccupancy)
+
+    # Group the point indexes by cluster so each cluster's members are a contiguous slice
+    order = np.argsort(codes, kind="stable")
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    members = [order[starts[c] : ends[c]] for c in clustersToSplit]
+    splitSeeds = spawn_seeds(seed, len(members))
+
+    if workers is not None and workers > 1 and len(members) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            subLabels = list(
+                pool.map(
+                    lambda m, s: _split_cluster(
+                        coords[m],
+                        maxOccupancy,
+                        None if weights is None else weights[m],
+                        s,
+                    ),
+                    members,
+                    splitSeeds,
+                )
+            )
+    else:
+        subLabels = [
+            _split_cluster(
+                coords[m], maxOccupancy, None if weights is None else weights[m], s
+            )
+            for m, s in zip(members, splitSeeds)
+        ]
 
-    # Identify the clusters which are above the occupancy threshold
-    cluster_value_counts = df.label.value_counts()
-    clusters_to_split = cluster_value_counts[cluster_value_counts > 40].index
-    split_clusters = df.copy()
+    if stableLabels:
+        newLabels = labels.copy()
+        nextLabel = labels.max() + 1
+        for clusterMembers, clusterSubLabels in zip(members, subLabels):
+            largest = np.argmax(np.bincount(clusterSubLabels))
+            others = clusterSubLabels != largest
+            # Number the other parts in order, skipping the part that keeps the label
+            otherLabels = clusterSubLabels[others]
+            otherLabels = otherLabels - (otherLabels > largest)
+            newLabels[clusterMembers[others]] = otherLabels + nextLabel
+            nextLabel += clusterSubLabels.max()
+        return newLabels
+
+    # New sub clusters get codes starting with 1 greater than the largest existing one
+    newCodes = codes.copy()
+    nextCode = uniqueLabels.shape[0]
+    for clusterMembers, clusterSubLabels in zip(members, subLabels):
+        newCodes[clusterMembers] = clusterSubLabels + nextCode
+        nextCode += clusterSubLabels.max() + 1
+
+    # Finally we reindex the labels so that they are sequential
+    _, sequentialLabels = np.unique(newCodes, return_inverse=True)
+    return sequentialLabels
 
-    for cluster_label_to_split in clusters_to_split:
-        target_cluster = df[df.label == cluster_label_to_split]
-        # Calculate the number of clusters we will attempt to splut this cluster into. We try to
-        # split the current cluster into n sub clusters close to the maxOccupancy
-        target_no_splits = math.ceil(target_cluster.shape[0] / maxOccupancy)
 
-        # Run the KMeans clustering on the target cluster
-        sub_cluster = cluster(
-            KMeans(n_clusters=target_no_splits, n_init="auto"), target_cluster
+def _capacity_constrained_assignment(
+    coords: np.ndarray,
+    centers: np.ndarray,
+    minOccupancy: int,
+    maxOccupancy: int,
+    noCandidates: int,
+) -> Optional[np.ndarray]:
+    """
+    Assign each point to one of its nearest centers minimizing the total squared distance while keeping the
+    number of points assigned to each center between the min and max occupancy. This is a min cost flow
+    (transportation) problem on a sparse graph linking each point to its candidate centers. Its constraint
+    matrix is totally unimodular so the optimal vertex solution found by the simplex solver is integral.
+
+    param ndarray coords: (n, 2) array of the point coordinates
+    param ndarray centers: (k, 2) array of the center coordinates
+    param int minOccupancy: The minimum number of points assigned to each center
+    param int maxOccupancy: The maximum number of points assigned to each center
+    param int noCandidates: The number of nearest centers each point can be assigned to
+    return Optional[ndarray]: The center assigned to each point or None if there is no feasible assignment
+    """
+    noPoints = coords.shape[0]
+    noCenters = centers.shape[0]
+    distances, candidates = cKDTree(centers).query(coords, noCandidates)
+    distances = distances.reshape(noPoints, -1)
+    candidates = candidates.reshape(noPoints, -1)
+
+    # One variable per (point, candidate center) edge
+    edges = np.arange(distances.size)
+    pointOfEdge = np.repeat(np.arange(noPoints), candidates.shape[1])
+    centerOfEdge = candidates.ravel()
+
+    # Each point is assigned exactly once
+    assignOnce = sparse.csr_matrix(
+        (np.ones(edges.shape[0]), (pointOfEdge, edges)),
+        shape=(noPoints, edges.shape[0]),
+    )
+    # min <= occupancy <= max, written as occupancy <= max and -occupancy <= -min
+    occupancy = sparse.csr_matrix(
+        (np.ones(edges.shape[0]), (centerOfEdge, edges)),
+        shape=(noCenters, edges.shape[0]),
+    )
+
+    result = linprog(
+        (distances**2).ravel(),
+        A_ub=sparse.vstack([occupancy, -occupancy]),
+        b_ub=np.concatenate(
+            [np.full(noCenters, maxOccupancy), np.full(noCenters, -minOccupancy)]
+        ),
+        A_eq=assignOnce,
+        b_eq=np.ones(noPoints),
+        bounds=(0, 1),
+        method="highs-ds",
+    )
+    if result.status != 0:
+        return None
+
+    chosen = result.x.reshape(noPoints, -1).argmax(axis=1)
+    return candidates[np.arange(noPoints), chosen]
+
+
+def balance_labels(
+    coords: np.ndarray,
+    labels: np.ndarray,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int = 10,
+    noCandidates: int = 8,
+    tolerance: float = 0.02,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Capacity constrained KMeans. The number of clusters is chosen to land in the middle of the occupancy range.
+    Starting from the centroids of the supplied clusters when there are that many of them, or from KMeans
+    centers otherwise, alternate between assigning points to centers under the occupancy constraints and
+    moving each center to the centroid of its points. Stops when less than the tolerance fraction of points change cluster or after maxIters rounds.
+
+    param ndarray coords: (n, 2) array of the point coordinates
+    param ndarray labels: The initial cluster label of each point, used to seed the centers
+    param Optional[int] minOccupancy: If specified, the minimum occupancy of each cluster
+    param Optional[int] maxOccupancy: If specified, the maximum occupancy of each cluster
+    param int maxIters: The maximum number of assignment rounds
+    param int noCandidates: The number of nearest centers each point can initially be assigned to
+    param float tolerance: Stop once the fraction of points changing cluster in a round drops bellow this
+    param Optional[int] seed: If specified, the random state of the KMeans used to seed the centers
+    return ndarray: The sequential cluster label of each point
+    """
+    noPoints = coords.shape[0]
+    targetClusters = target_group_count(noPoints, minOccupancy, maxOccupancy)
+    minOccupancy = 0 if minOccupancy is None else minOccupancy
+    maxOccupancy = noPoints if maxOccupancy is None else maxOccupancy
+
+    # Pick a number of clusters for which the occupancy bounds can be met
+    fewestClusters = math.ceil(noPoints / maxOccupancy)
+    mostClusters = noPoints // minOccupancy if minOccupancy > 0 else noPoints
+    if fewestClusters > mostClusters:
+        logWarning(
+            f"No number of groups can keep all {noPoints} users between {minOccupancy} and {maxOccupancy}. Relaxing the minimum occupancy"
+        )
+        minOccupancy = noPoints // fewestClusters
+        mostClusters = fewestClusters
+
+    _, codes = np.unique(labels, return_inverse=True)
+    noClusters = int(np.clip(targetClusters, fewestClusters, mostClusters))
+    if noClusters == codes.max() + 1:
+        sizes = np.bincount(codes)
+        centers = np.stack(
+            [
+                np.bincount(codes, weights=coords[:, 0]) / sizes,
+                np.bincount(codes, weights=coords[:, 1]) / sizes,
+            ],
+            axis=1,
+        )
+    else:
+        centers = (
+            MiniBatchKMeans(
+                n_clusters=noClusters, n_init=3, batch_size=4096, random_state=seed
+            )
+            .fit(coords)
+            .cluster_centers_
         )
 
-        # We reasign the cluster labels starting with 1 greater than the maximun existing label number
-        max_existing_label = split_clusters.label.max()
-        sub_cluster.label = sub_cluster.label + max_existing_label + 1
-        split_clusters = gp.GeoDataFrame(
-            pd.concat(
-                [
-                    split_clusters[split_clusters.label != cluster_label_to_split],
-                    sub_cluster,
-                ],
-                axis=0,
+    assignment = None
+    for _ in range(maxIters):
+        candidates = min(noCandidates, noClusters)
+        newAssignment = _capacity_constrained_assignment(
+            coords, centers, minOccupancy, maxOccupancy, candidates
+        )
+        # If the sparse candidate graph has no feasible assignment, widen it until it does
+        while newAssignment is None and candidates < noClusters:
+            candidates = min(candidates * 2, noClusters)
+            newAssignment = _capacity_constrained_assignment(
+                coords, centers, minOccupancy, maxOccupancy, candidates
             )
+
+        if newAssignment is None:
+            logWarning("Unable to find a feasible balanced assignment")
+            break
+        converged = (
+            assignment is not None and (newAssignment != assignment).mean() < tolerance
+        )
+        assignment = newAssignment
+        if converged:
+            break
+
+        sizes = np.bincount(assignment, minlength=noClusters)
+        occupied = sizes > 0
+        centers[occupied, 0] = (
+            np.bincount(assignment, weights=coords[:, 0], minlength=noClusters)[
+                occupied
+            ]
+            / sizes[occupied]
+        )
+        centers[occupied, 1] = (
+            np.bincount(assignment, weights=coords[:, 1], minlength=noClusters)[
+                occupied
+            ]
+            / sizes[occupied]
         )
 
-    # Finally we reindex the labels so that they are sequential
-    unique_labels = split_clusters.label.drop_duplicates().sort_values().values
-    label_remap = dict(zip(unique_labels, range(0, unique_labels.shape[0])))
-    split_clusters.label = split_clusters.label.apply(
-        lambda old_label: label_remap[old_label]
+    if assignment is None:
+        return codes
+
+    _, sequentialLabels = np.unique(assignment, return_inverse=True)
+    return sequentialLabels
+
+
+def balance_clusters(
+    df: gp.GeoDataFrame,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int = 10,
+    seed: Optional[int] = None,
+    verbose: bool = True,
+) -> gp.GeoDataFrame:
+    """
+    Reassigns users to groups so that every group is within the occupancy bounds in a single capacity
+    constrained KMeans solve, as an alternative to improve_clusters
+
+    param GeoDataFrame df: The DataFrame of initial clusters, it should have the following fields "label", "geometry"
+    param Optional[int] minOccupancy: If specified, the minimum occupancy of each cluster
+    param Optional[int] maxOccupancy: If specified, the maximum occupancy of each cluster
+    param int maxIters: The maximum number of assignment rounds
+    param Optional[int] seed: If specified, seeds the centers when they can't start from the initial clusters
+    param bool verbose: Log the sizes of the balanced groups
+
+    return GeoDataFrame: The input DataFrame with the balanced labels
+    """
+    coords = point_coordinates(df)
+    labels = balance_labels(
+        coords, df.label.to_numpy(), minOccupancy, maxOccupancy, maxIters, seed=seed
     )
+    balanced = gp.GeoDataFrame(df.assign(label=labels))
 
-    # Return the resulting clusters
-    return split_clusters
+    if verbose:
+        clusterCounts = balanced.label.value_counts()
+        logInfo(
+            f"Balanced users in to {clusterCounts.shape[0]} groups of between {clusterCounts.min()} and {clusterCounts.max()} users"
+        )
+    return balanced
+
+
+def split_clusters(df, maxOccupancy: int = 40, workers: Optional[int] = None):
+    """
+    Split clusters which are above the occpancy threshold in to smaller clusters by internally clustering using KMeans
+    We generate n new clusters where n is the ceiling of the current cluster count divided by the maximum occupancy
+
+    param GeoDataFrame df: The input dataframe, it should have the following fields "label", "geometry" and optionally "weight", the number of users each point stands for
+    param int maxOccupancy: The maximum occupancy of each group. Defaults to 40
+    param Optional[int] workers: If specified, the number of threads used to split clusters in parallel
+    """
+    coords = point_coordinates(df)
+    return gp.GeoDataFrame(
+        df.assign(
+            label=split_labels(
+                coords, df.label.to_numpy(), maxOccupancy, workers, point_weights(df)
+            )
+        )
+    )
 
 
 def generate_group_meeting_points(
-    df: gp.GeoDataFrame, method: Optional[MeetingPointMethod]
+    df: gp.GeoDataFrame,
+    method: Optional[MeetingPointMethod],
+    workers: Optional[int] = None,
+    snapMinStreetCount: int = 1,
 ) -> gp.GeoDataFrame:
     """
     Generates the meeting point for each group.
     param: GeoDataFrame df: A DataFrame with each users location and group assignment
     param: MeetingPointMethod method: Specify the method used to calculate the meeting point
+    param: Optional[int] workers: The number of processes used by the network distance methods, defaults to the number of cores
+    param: int snapMinStreetCount: The minimum number of streets meeting at a node for centroids to be snapped to it, 3 snaps to intersections only
 
     returns: A GeoDataFrame with the centroids for each label and any additional info (depends on method)
     """
@@ -243,12 +816,124 @@ def generate_group_meeting_points(
             logInfo("Generating meeting points for each group using their centroids")
             return group_centroids
         case MeetingPointMethod.CENTROID_SNAPED_TO_STREET:
+            meetingPointsKey = RunCache.key(
+                RunCache.frame_key(df), method, snapMinStreetCount
+            )
+            meetingPoints = RunCache.get_cached_geo_data_frame(
+                "meeting_points", meetingPointsKey
+            )
+            if meetingPoints is not None:
+                logInfo("Loaded meeting points from cache")
+                return meetingPoints
+
             logInfo(
                 "Generating meeting points for each group by snapping their centroids to the street network"
             )
             bounds = df.to_crs("epsg:4326").total_bounds
-            network = get_network_graph(tuple(bounds), crs=df.crs)
-            return snap_points_to_street_network(group_centroids, network)
+            snapIndex = get_snap_index(
+                tuple(bounds), crs=df.crs, minStreetCount=snapMinStreetCount
+            )
+            meetingPoints = snap_points_to_street_network(group_centroids, snapIndex)
+            RunCache.cache_geo_data_frame(
+                "meeting_points", meetingPointsKey, meetingPoints
+            )
+            return meetingPoints
+        case MeetingPointMethod.NETWORK_MEDIAN | MeetingPointMethod.NETWORK_MINIMAX:
+            meetingPointsKey = RunCache.key(RunCache.frame_key(df), method)
+            meetingPoints = RunCache.get_cached_geo_data_frame(
+                "meeting_points", meetingPointsKey
+            )
+            if meetingPoints is not None:
+                logInfo("Loaded meeting points from cache")
+                return meetingPoints
+
+            logInfo(
+                "Generating meeting points for each group by finding the intersection closest to its members by bike"
+            )
+            start = time.perf_counter()
+            bounds = df.to_crs("epsg:4326").total_bounds
+            network = get_compact_network(tuple(bounds), crs=df.crs)
+            meetingPoints = network_meeting_points(
+                df,
+                network,
+                minimax=method == MeetingPointMethod.NETWORK_MINIMAX,
+                workers=workers,
+            )
+            logInfo(
+                f"Found meeting points for {meetingPoints.shape[0]} groups in {time.perf_counter() - start:.2f}s"
+            )
+            RunCache.cache_geo_data_frame(
+                "meeting_points", meetingPointsKey, meetingPoints
+            )
+            return meetingPoints
+
+
+def _group_details(
+    users: gp.GeoDataFrame, meetingPoints: gp.GeoDataFrame
+) -> tuple[np.ndarray, np.ndarray, pd.DataFrame]:
+    """
+    Works out the details shared by the members of each group once per group
+
+    returns (ndarray, ndarray, DataFrame): The group labels, the position of each user's group in them and the
+        meeting point latitude, longitude, members and member count of each group
+    """
+    groupLabels, userGroup = np.unique(users.label.to_numpy(), return_inverse=True)
+    order = np.argsort(userGroup, kind="stable")
+    groupSizes = np.bincount(userGroup)
+    starts = np.concatenate([[0], np.cumsum(groupSizes)[:-1]])
+
+    # Concatenate the ids of each group in one pass over the users sorted by group
+    memberIds = users.user_id.astype(str).to_numpy(dtype=object)[order] + ","
+    members = pd.Series(np.add.reduceat(memberIds, starts)).str[:-1]
+
+    # Meeting points already exported in lat lng are used as they are
+    latLngMeetingPoints = (
+        meetingPoints
+        if meetingPoints.crs == "epsg:4326"
+        else meetingPoints.to_crs("epsg:4326")
+    )
+    pointLabels = latLngMeetingPoints.label.to_numpy()
+    pointOrder = np.argsort(pointLabels, kind="stable")
+    matched = pointOrder[
+        np.searchsorted(pointLabels, groupLabels, sorter=pointOrder).clip(
+            0, pointLabels.shape[0] - 1
+        )
+    ]
+    found = pointLabels[matched] == groupLabels
+    groups = pd.DataFrame(
+        {
+            "start_point_latitude": np.where(
+                found, latLngMeetingPoints.geometry.y.to_numpy()[matched], np.nan
+            ),
+            "start_point_longitude": np.where(
+                found, latLngMeetingPoints.geometry.x.to_numpy()[matched], np.nan
+            ),
+            "potential_group_members": members.to_numpy(),
+            "member_count": groupSizes,
+        }
+    )
+    return groupLabels, userGroup, groups
+
+
+def _mailing_list_rows(
+    users: gp.GeoDataFrame,
+    groupLabels: np.ndarray,
+    userGroup: np.ndarray,
+    groups: pd.DataFrame,
+    rows: slice = slice(None),
+) -> pd.DataFrame:
+    userRows = userGroup[rows]
+    return pd.DataFrame(
+        {
+            "user_id": users.user_id.to_numpy()[rows],
+            "start_point_id": groupLabels[userRows],
+            "start_point_latitude": groups.start_point_latitude.to_numpy()[userRows],
+            "start_point_longitude": groups.start_point_longitude.to_numpy()[userRows],
+            "potential_group_members": groups.potential_group_members.to_numpy()[
+                userRows
+            ],
+        }
+    )
 
 
 def format_results(
@@ -261,31 +946,289 @@ def format_results(
 
     returns: A pandas DataFrame with the required columns
     """
+    groupLabels, userGroup, groups = _group_details(users, meetingPoints)
+    return _mailing_list_rows(users, groupLabels, userGroup, groups)
 
-    latLngMeetingPoints = meetingPoints.to_crs("epsg:4326")
-    latLngMeetingPoints = latLngMeetingPoints.assign(
-        start_point_latitude=latLngMeetingPoints.geometry.y,
-        start_point_longitude=latLngMeetingPoints.geometry.x,
-    )
 
-    groupAssignments = (
-        users.groupby("label")
-        .user_id.apply(
-            lambda user_ids: ",".join([str(user_id) for user_id in user_ids])
+def group_summaries(
+    users: gp.GeoDataFrame, meetingPoints: gp.GeoDataFrame
+) -> list[dict]:
+    """
+    The meeting point and members of each group as plain values, as returned by the job API
+
+    param: GeoDataFrame users: The list of users with their group assigments in the label column
+    param: GeoDataFrame meetingPoints: A dataframe with each meeting point for each label
+
+    returns: [dict] The label, meeting point, member count and member ids of each group
+    """
+    groupLabels, userGroup, groups = _group_details(users, meetingPoints)
+    order = np.argsort(userGroup, kind="stable")
+    memberIds = np.split(
+        users.user_id.astype(str).to_numpy()[order],
+        np.cumsum(groups.member_count.to_numpy())[:-1],
+    )
+    return [
+        {
+            "label": label,
+            "meetingPoint": (
+                None
+                if np.isnan(latitude)
+                else {"latitude": latitude, "longitude": longitude}
+            ),
+            "memberCount": len(members),
+            "members": members.tolist(),
+        }
+        for label, latitude, longitude, members in zip(
+            groupLabels.tolist(),
+            groups.start_point_latitude.tolist(),
+            groups.start_point_longitude.tolist(),
+            memberIds,
         )
-        .reset_index()
+    ]
+
+
+def write_mailing_list(
+    users: gp.GeoDataFrame,
+    meetingPoints: gp.GeoDataFrame,
+    outputDir: Path,
+    outputFormat: MailingListFormat = MailingListFormat.DENORMALIZED,
+    chunkSize: int = 50_000,
+):
+    """
+    Writes the mailing list to the output directory. The denormalized mailingList.csv repeats the members of
+    each group on every member's row, so it is streamed to disk in chunks of users rather than built in memory.
+    The normalized groups.csv and user_groups.csv hold the same information with each group written once.
+
+    param: GeoDataFrame users: The list of users with their group assigments in the label column
+    param: GeoDataFrame meetingPoints: A dataframe with each meeting point for each label
+    param: Path outputDir: The directory to write the files to
+    param: MailingListFormat outputFormat: Which layout to write
+    param: int chunkSize: The number of users written to mailingList.csv at a time
+    """
+    groupLabels, userGroup, groups = _group_details(users, meetingPoints)
+
+    if outputFormat in (MailingListFormat.DENORMALIZED, MailingListFormat.BOTH):
+        with open(outputDir / "mailingList.csv", "w", newline="") as file:
+            for start in range(0, max(users.shape[0], 1), chunkSize):
+                _mailing_list_rows(
+                    users,
+                    groupLabels,
+                    userGroup,
+                    groups,
+                    slice(start, start + chunkSize),
+                ).to_csv(file, index=False, header=start == 0)
+
+    if outputFormat in (MailingListFormat.NORMALIZED, MailingListFormat.BOTH):
+        groups.insert(0, "start_point_id", groupLabels)
+        groups.to_csv(outputDir / "groups.csv", index=False)
+        pd.DataFrame(
+            {
+                "user_id": users.user_id.to_numpy(),
+                "start_point_id": groupLabels[userGroup],
+            }
+        ).to_csv(outputDir / "user_groups.csv", index=False)
+
+
+def update_clusters(
+    df: gp.GeoDataFrame,
+    baseAssignments: gp.GeoDataFrame,
+    minGroupOccupancy: Optional[int],
+    maxGroupOccupancy: Optional[int],
+    maxIters: Optional[int],
+) -> gp.GeoDataFrame:
+    """
+    Incrementally updates the groups from a previous run to match a new set of users. Users present in the
+    previous run keep their group, users who are no longer present are dropped and new users join the group
+    with the nearest centroid. Only groups whose occupancy now falls outside the bounds are then split or merged.
+
+    param GeoDataFrame df: The cleaned users for this run
+    param GeoDataFrame baseAssignments: The user assignments of the previous run, it should have the following fields "user_id", "label"
+    param Optional[int] minGroupOccupancy: The minimum group occupancy to target
+    param Optional[int] maxGroupOccupancy: The maximum group occupancy to target
+    param Optional[int] maxIters: The maximum number of split and merge iterations
+
+    return GeoDataFrame: The input DataFrame with the clustering labels attached
+    """
+    previousLabels = pd.Series(
+        baseAssignments.label.to_numpy(),
+        index=baseAssignments.user_id.astype(str).to_numpy(),
     )
-    groupAssignments = groupAssignments.rename(
-        columns={"user_id": "potential_group_members"}
+    labels = df.user_id.astype(str).map(previousLabels).to_numpy(dtype=np.float64)
+    existing = ~np.isnan(labels)
+
+    noDeparted = previousLabels.shape[0] - existing.sum()
+    noNew = (~existing).sum()
+    logInfo(
+        f"Updating groups from the previous run: [bold white]{existing.sum()}[/bold white] users kept, [bold white]{noNew}[/bold white] new and [bold white]{noDeparted}[/bold white] departed"
     )
+    if not existing.any():
+        raise Exception("None of the users from the previous run are in the input file")
 
-    result = (
-        users[["user_id", "label"]]
-        .merge(latLngMeetingPoints, on="label", how="left")
-        .merge(groupAssignments, on="label", how="left")
+    # Assign new users to the group with the nearest centroid
+    coords = point_coordinates(df)
+    if noNew > 0:
+        groupLabels, centroids = group_centroids(coords[existing], labels[existing])
+        _, nearest = cKDTree(centroids).query(coords[~existing])
+        labels[~existing] = groupLabels[nearest]
+
+    updatedClusters = gp.GeoDataFrame(df.assign(label=labels.astype(np.int64)))
+
+    # Split and merge only touch the groups which are outside the bounds, the rest keep their labels
+    if minGroupOccupancy is not None or maxGroupOccupancy is not None:
+        iterations = maxIters if maxIters is not None else 10
+        return improve_clusters(
+            updatedClusters,
+            minGroupOccupancy,
+            maxGroupOccupancy,
+            iterations,
+            stableLabels=True,
+        )
+    return updatedClusters
+
+
+def max_cell_weight(maxOccupancy: Optional[int]) -> int:
+    """
+    The most users a single aggregated cell can stand for, a fraction of the maximum occupancy so that groups
+    can still be split and merged between cells
+
+    param Optional[int] maxOccupancy: The maximum group occupancy if specified
+    return int: The largest weight of a cell
+    """
+    occupancy = DEFAULT_TARGET_OCCUPANCY if maxOccupancy is None else maxOccupancy
+    return max(1, int(occupancy * MAX_CELL_WEIGHT_FRACTION))
+
+
+def aggregate_users(
+    df: gp.GeoDataFrame,
+    resolution: float,
+    maxOccupancy: Optional[int],
+    verbose: bool = True,
+) -> tuple[gp.GeoDataFrame, np.ndarray]:
+    """
+    Aggregates co-located users in to weighted grid cells which are clustered in their place
+
+    param GeoDataFrame df: The cleaned users
+    param float resolution: The side length of the grid cells in meters
+    param Optional[int] maxOccupancy: The maximum group occupancy, caps how many users a cell can stand for
+    param bool verbose: Log how many cells the users were aggregated in to
+    return (GeoDataFrame, ndarray): The weighted cells and the position of each user's cell
+    """
+    with span("aggregate_users", resolution=resolution) as stage:
+        cells, cellOfUser = aggregate_user_locations(
+            df, resolution, max_cell_weight(maxOccupancy)
+        )
+        stage.counts.update(users=df.shape[0], cells=cells.shape[0])
+    if verbose:
+        logInfo(
+            f"Aggregated [bold white]{df.shape[0]}[/bold white] users in to [bold white]{cells.shape[0]}[/bold white] cells of {resolution:g}m"
+        )
+    return cells, cellOfUser
+
+
+def expand_cell_labels(
+    df: gp.GeoDataFrame, cells: gp.GeoDataFrame, cellOfUser: np.ndarray
+) -> gp.GeoDataFrame:
+    """
+    Gives each user the label of the aggregated cell they fell in to
+
+    param GeoDataFrame df: The users that were aggregated
+    param GeoDataFrame cells: The labeled cells
+    param ndarray cellOfUser: The position of each user's cell
+    return GeoDataFrame: The users with the clustering labels attached
+    """
+    return gp.GeoDataFrame(df.assign(label=cells.label.to_numpy()[cellOfUser]))
+
+
+def cluster_users(
+    df: gp.GeoDataFrame,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int,
+    initialMethod: InitialClusteringMethod = InitialClusteringMethod.KMEANS,
+    refineMethod: RefinementMethod = RefinementMethod.ITERATIVE,
+    aggregateResolution: Optional[float] = None,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Generates the initial clusters and refines them without caching or logging the progress, for clustering
+    many sets of users in worker processes
+
+    param GeoDataFrame df: The users in a projected CRS with units of meters
+    param Optional[int] minOccupancy: The minimum group occupancy to target
+    param Optional[int] maxOccupancy: The maximum group occupancy to target
+    param int maxIters: The maximum number of refinement iterations
+    param InitialClusteringMethod initialMethod: The method used to generate the initial clusters
+    param RefinementMethod refineMethod: The method used to bring the groups within the occupancy bounds
+    param Optional[float] aggregateResolution: If specified, the users are aggregated in to weighted grid cells of this size in meters before clustering
+    param Optional[int] seed: If specified, seeds every random step so the clusters can be reproduced
+    return ndarray: The label of each user
+    """
+    initialSeed, refineSeed = spawn_seeds(seed, 2)
+    points, cellOfUser = df, None
+    if aggregateResolution is not None:
+        points, cellOfUser = aggregate_users(
+            df, aggregateResolution, maxOccupancy, verbose=False
+        )
+    algorithm = initial_clustering_algorithm(
+        initialMethod,
+        df.shape[0],
+        minOccupancy,
+        maxOccupancy,
+        df.crs,
+        initialSeed,
+        points.shape[0],
     )
-    result = result.rename(columns={"label": "start_point_id"}).drop("geometry", axis=1)
-    return result
+    clusters = cluster(algorithm, points)
+    if refineMethod == RefinementMethod.BALANCED and df.shape[0] > 1:
+        # Balancing works on the users themselves
+        if cellOfUser is not None:
+            clusters = expand_cell_labels(df, clusters, cellOfUser)
+            cellOfUser = None
+        clusters = balance_clusters(
+            clusters, minOccupancy, maxOccupancy, maxIters, refineSeed, verbose=False
+        )
+    elif minOccupancy is not None or maxOccupancy is not None:
+        clusters = improve_clusters(
+            clusters,
+            minOccupancy,
+            maxOccupancy,
+            maxIters,
+            verbose=False,
+            seed=refineSeed,
+        )
+    labels = clusters.label.to_numpy()
+    if cellOfUser is not None:
+        labels = labels[cellOfUser]
+    return labels
+
+
+def score_labels(
+    coords: np.ndarray,
+    labels: np.ndarray,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+) -> tuple[int, float]:
+    """
+    Scores a grouping of users so different groupings can be compared, lower is better. The number of groups
+    outside the occupancy bounds counts first, ties are broken by how far users are on average from the centroid
+    of their group, which is where the centroid meeting points go.
+
+    param ndarray coords: (n, 2) array of the projected user coordinates
+    param ndarray labels: The group label of each user
+    param Optional[int] minOccupancy: If specified, the minimum occupancy of each group
+    param Optional[int] maxOccupancy: If specified, the maximum occupancy of each group
+    return (int, float): The number of groups outside the bounds and the mean distance of users to their group's centroid
+    """
+    _, codes = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(codes)
+    violations = 0
+    if minOccupancy is not None:
+        violations += int((sizes < minOccupancy).sum())
+    if maxOccupancy is not None:
+        violations += int((sizes > maxOccupancy).sum())
+    _, centroids = group_centroids(coords, codes)
+    meanDistance = float(np.linalg.norm(coords - centroids[codes], axis=1).mean())
+    return violations, meanDistance
 
 
 def run_clustering(
@@ -293,39 +1236,117 @@ def run_clustering(
     minGroupOccupancy: Optional[int],
     maxGroupOccupancy: Optional[int],
     maxIters: Optional[int],
+    initialMethod: InitialClusteringMethod = InitialClusteringMethod.KMEANS,
+    refineMethod: RefinementMethod = RefinementMethod.ITERATIVE,
+    aggregateResolution: Optional[float] = None,
+    seed: Optional[int] = None,
 ) -> gp.GeoDataFrame:
     """
-    Runs the clustering algorithum on the cleaned data. This uses AffinityPropogation to produce a set of
-    inital clusters and then iteratively tried to join and merge them to meet the minimum and maximum
-    cluster criteria
+    Runs the clustering algorithum on the cleaned data. This uses the selected initial clustering method to
+    produce a set of inital clusters and then either iteratively tries to join and merge them or balances them
+    with capacity constrained KMeans to meet the minimum and maximum cluster criteria.
+    When an aggregate resolution is given, users are first aggregated in to weighted grid cells of that size
+    which are clustered in their place and the labels are expanded back to the users at the end. Balancing
+    works on the users themselves. When a seed is given every random step is seeded from it so the same users
+    always get the same groups.
     """
+    cells, cellOfUser = df, None
+    if aggregateResolution is not None:
+        cells, cellOfUser = aggregate_users(df, aggregateResolution, maxGroupOccupancy)
+
+    # Step 1 : Generate inital proposal clusters, load from cache if possible
+    initialSeed, refineSeed = spawn_seeds(seed, 2)
+    algorithm = initial_clustering_algorithm(
+        initialMethod,
+        df.shape[0],
+        minGroupOccupancy,
+        maxGroupOccupancy,
+        df.crs,
+        initialSeed,
+        cells.shape[0],
+    )
+    initialKey = RunCache.key(
+        RunCache.frame_key(cells), initialMethod, algorithm.get_params()
+    )
 
-    # Step 1 : Use AffinityPropogation to generate inital proposal clusters, load from cache if possible
-
-    inital_clusters = RunCache.get_cached_geo_data_frame("inital_clusters")
+    with span("initial_clustering", method=initialMethod.value) as stage:
+        inital_clusters = RunCache.get_cached_geo_data_frame(
+            "inital_clusters", initialKey
+        )
+        stage.counts["cached"] = inital_clusters is not None
 
-    if inital_clusters is None:
-        logInfo(
-            f"[bold yellow]🔬[/bold yellow] Attempting to generate groups. Depending on the number of users this might take a few mins"
+        if inital_clusters is None:
+            logInfo(
+                f"[bold yellow]🔬[/bold yellow] Attempting to generate groups using {initialMethod.value}. Depending on the number of users this might take a few mins"
+            )
+            inital_clusters = cluster(algorithm, cells)
+            RunCache.cache_geo_data_frame(
+                "inital_clusters", initialKey, inital_clusters
+            )
+        else:
+            logInfo("Loaded inital clusters from cache")
+        stage.counts.update(
+            users=df.shape[0], groups=int(inital_clusters.label.max() + 1)
         )
-        inital_clusters = cluster(AffinityPropagation(damping=0.95, verbose=True), df)
-        RunCache.cache_geo_data_frame("inital_clusters", inital_clusters)
-    else:
-        logInfo("Loaded inital clusters from cache")
 
     logInfo(
         f"Got inital groups. We found [bold white]{inital_clusters.label.max() +1 }[/bold white] of them."
     )
 
     # Step 2 : If bounds for the cluster sizes specified, iteratively try to improve the clusters based on min and max group occupancy
-    if minGroupOccupancy is not None or maxGroupOccupancy is not None:
-        iterations = maxIters if maxIters is not None else 10
-        logInfo(
-            f"Refining groups to try and get them within the specified range. Will run {iterations} times"
-        )
-        reduced_clusters = improve_clusters(
-            inital_clusters, minGroupOccupancy, maxGroupOccupancy, iterations
-        )
-        return reduced_clusters
+    if cellOfUser is not None and (
+        refineMethod == RefinementMethod.BALANCED
+        or (minGroupOccupancy is None and maxGroupOccupancy is None)
+    ):
+        inital_clusters = expand_cell_labels(df, inital_clusters, cellOfUser)
+        cellOfUser = None
+
+    if minGroupOccupancy is None and maxGroupOccupancy is None:
+        return inital_clusters
+
+    iterations = maxIters if maxIters is not None else 10
+    refinedKey = RunCache.key(
+        initialKey,
+        minGroupOccupancy,
+        maxGroupOccupancy,
+        iterations,
+        refineMethod,
+        refineSeed,
+    )
+    refined_clusters = RunCache.get_cached_geo_data_frame(
+        "refined_clusters", refinedKey
+    )
+    if refined_clusters is not None:
+        logInfo("Loaded refined clusters from cache")
+        if cellOfUser is not None:
+            return expand_cell_labels(df, refined_clusters, cellOfUser)
+        return refined_clusters
+
+    with span("refine_clusters", method=refineMethod.value):
+        if refineMethod == RefinementMethod.BALANCED:
+            logInfo(
+                f"Balancing groups to get them within the specified range. Will run at most {iterations} assignment rounds"
+            )
+            refined_clusters = balance_clusters(
+                inital_clusters,
+                minGroupOccupancy,
+                maxGroupOccupancy,
+                iterations,
+                refineSeed,
+            )
+        else:
+            logInfo(
+                f"Refining groups to try and get them within the specified range. Will run {iterations} times"
+            )
+            refined_clusters = improve_clusters(
+                inital_clusters,
+                minGroupOccupancy,
+                maxGroupOccupancy,
+                iterations,
+                seed=refineSeed,
+            )
 
-    return inital_clusters
+    RunCache.cache_geo_data_frame("refined_clusters", refinedKey, refined_clusters)
+    if cellOfUser is not None:
+        return expand_cell_labels(df, refined_clusters, cellOfUser)
+    return refined_clusters
@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, TextIO
+import gzip
+import numpy as np
+import geopandas as gp
+import shapely
+from pyproj import Transformer
+from .options import DEFAULT_COORDINATE_PRECISION, MailingListFormat, OutputFormat
+from .logging import logInfo
+
+# Number of features written to a GeoJSON file at a time
+GEOJSON_CHUNK_SIZE = 50_000
+
+
+OUTPUT_SUFFIXES = {
+    OutputFormat.GEOJSON: ".geojson",
+    OutputFormat.GEOJSON_GZ: ".geojson.gz",
+    OutputFormat.FLATGEOBUF: ".fgb",
+    OutputFormat.GEOPARQUET: ".parquet",
+}
+
+
+def output_path(outputDir: Path, name: str, outputFormat: OutputFormat) -> Path:
+    return outputDir / f"{name}{OUTPUT_SUFFIXES[outputFormat]}"
+
+
+def find_output(outputDir: Path, name: str) -> tuple[Path, OutputFormat] | None:
+    """
+    Finds a geographic output of a run in whichever format it was written in
+
+    :param Path outputDir: The run directory
+    :param str name: The name of the output without a suffix, eg usersAssignments
+    :return (Path, OutputFormat): The file and its format, or None if the run has no such output
+    """
+    for outputFormat in OutputFormat:
+        filePath = output_path(outputDir, name, outputFormat)
+        if filePath.exists():
+            return filePath, outputFormat
+    return None
+
+
+def read_output(outputDir: Path, name: str) -> gp.GeoDataFrame:
+    """
+    Reads a geographic output of a run in whichever format it was written in
+    """
+    found = find_output(outputDir, name)
+    if found is None:
+        raise Exception(f"Could not find {name} in {outputDir}")
+    filePath, outputFormat = found
+    match outputFormat:
+        case OutputFormat.GEOPARQUET:
+            return gp.read_parquet(filePath)
+        case OutputFormat.GEOJSON_GZ:
+            with gzip.open(filePath, "rb") as file:
+                return gp.read_file(file)
+        case _:
+            return gp.read_file(filePath)
+
+
+def to_lat_lng(
+    frames: list[gp.GeoDataFrame], precision: Optional[int]
+) -> list[gp.GeoDataFrame]:
+    """
+    Reprojects DataFrames in the same CRS to lat lng. The coordinates of every geometry are transformed and rounded
+    as a single array rather than one DataFrame at a time.
+
+    :param [GeoDataFrame] frames: The DataFrames to reproject
+    :param Optional[int] precision: The number of decimal places to round the coordinates to, if given
+    :return [GeoDataFrame]: The reprojected DataFrames
+    """
+    transformer = Transformer.from_crs(frames[0].crs, "epsg:4326", always_xy=True)
+
+    def project(coords: np.ndarray) -> np.ndarray:
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        projected = np.stack([x, y], axis=1)
+        return projected if precision is None else np.round(projected, precision)
+
+    geometries = shapely.transform(
+        np.concatenate([np.asarray(frame.geometry.values) for frame in frames]),
+        project,
+    )
+    splits = np.cumsum([frame.shape[0] for frame in frames])[:-1]
+    return [
+        gp.GeoDataFrame(frame, geometry=frameGeometries, crs="epsg:4326")
+        for frame, frameGeometries in zip(frames, np.split(geometries, splits))
+    ]
+
+
+def write_geojson(df: gp.GeoDataFrame, file: TextIO):
+    """
+    Writes a DataFrame as a GeoJSON FeatureCollection. The properties are serialized by pandas and the geometries by
+    shapely, each in a single vectorized call per chunk, which is much faster than writing through fiona.
+    """
+    attributes = df.drop(columns=df.geometry.name)
+    file.write('{"type":"FeatureCollection","features":[\n')
+    for start in range(0, df.shape[0], GEOJSON_CHUNK_SIZE):
+        chunk = slice(start, start + GEOJSON_CHUNK_SIZE)
+        properties = (
+            attributes.iloc[chunk]
+            .to_json(orient="records", lines=True, double_precision=15)
+            .splitlines()
+            if attributes.shape[1] > 0
+            else ["{}"] * len(range(df.shape[0])[chunk])
+        )
+        geometries = shapely.to_geojson(np.asarray(df.geometry.values[chunk]))
+        features = ",\n".join(
+            f'{{"type":"Feature","properties":{featureProperties},"geometry":{"null" if geometry is None else geometry}}}'
+            for featureProperties, geometry in zip(properties, geometries)
+        )
+        file.write(("," if start > 0 else "") + features + "\n")
+    file.write("]}\n")
+
+
+def write_layer(df: gp.GeoDataFrame, filePath: Path, outputFormat: OutputFormat):
+    """
+    Writes a geographic output of a run in the requested format
+    """
+    if df.index.name is not None:
+        df = df.reset_index()
+
+    match outputFormat:
+        case OutputFormat.GEOJSON:
+            with open(filePath, "w") as file:
+                write_geojson(df, file)
+        case OutputFormat.GEOJSON_GZ:
+            with gzip.open(filePath, "wt", compresslevel=6) as file:
+                write_geojson(df, file)
+        case OutputFormat.FLATGEOBUF:
+            df.to_file(filePath, driver="FlatGeobuf")
+        case OutputFormat.GEOPARQUET:
+            df.to_parquet(filePath)
+
+
+def export_run(
+    outputDir: Path,
+    groupAssignments: gp.GeoDataFrame,
+    groupMeetingPoints: gp.GeoDataFrame,
+    groupRegions: gp.GeoDataFrame,
+    outputFormat: OutputFormat = OutputFormat.GEOJSON,
+    precision: Optional[int] = DEFAULT_COORDINATE_PRECISION,
+    mailingListFormat: MailingListFormat = MailingListFormat.DENORMALIZED,
+):
+    """
+    Writes the outputs of a run. The geographic outputs are reprojected to lat lng together and every output,
+    including the mailing list, is written concurrently in a pool of threads. The mailing list takes its
+    coordinates from the exported meeting points so the two always agree.
+
+    :param Path outputDir: The run directory
+    :param GeoDataFrame groupAssignments: The users with their group labels
+    :param GeoDataFrame groupMeetingPoints: The meeting point of each group
+    :param GeoDataFrame groupRegions: The convex hull of each group
+    :param OutputFormat outputFormat: The format to write the geographic outputs in
+    :param Optional[int] precision: The number of decimal places to round the exported coordinates to, if given
+    :param MailingListFormat mailingListFormat: The layout of the mailing list
+    """
+    # Imported here so reading the outputs, as the visualization does, doesn't load the clustering libraries
+    from .clustering import write_mailing_list
+
+    layers = {
+        "usersAssignments": groupAssignments,
+        "groupMeetingPoints": groupMeetingPoints,
+        "groupRegions": groupRegions,
+    }
+    latLngLayers = to_lat_lng(list(layers.values()), precision)
+
+    with ThreadPoolExecutor(max_workers=len(layers) + 1) as pool:
+        futures = [
+            pool.submit(
+                write_layer,
+                layer,
+                output_path(outputDir, name, outputFormat),
+                outputFormat,
+            )
+            for name, layer in zip(layers, latLngLayers)
+        ]
+        futures.append(
+            pool.submit(
+                write_mailing_list,
+                groupAssignments,
+                latLngLayers[1],
+                outputDir,
+                mailingListFormat,
+            )
+        )
+        for future in futures:
+            future.result()
+
+    logInfo(f"Wrote results to [bold white]{outputDir}[/bold white]")
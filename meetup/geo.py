@@ -3,12 +3,103 @@ import pandas as pd
 import osmnx as ox
 from networkx import MultiDiGraph
 from typing import Optional
+import importlib.util
 from geopandas import GeoDataFrame
 from networkx import MultiDiGraph
-from shapely import MultiPoint
 from .logging import logInfo, logWarning
-from collections.abc import Iterable
-from .caching import RunCache
+from .profiling import span
+from .caching import RunCache, NetworkCache
+from pathlib import Path
+import math
+import numpy as np
+from .network import CompactNetwork, StreetSnapIndex
+import shapely
+from pyproj import CRS, Transformer
+from pyproj.aoi import AreaOfInterest
+from pyproj.database import query_utm_crs_info
+from collections import OrderedDict
+from itertools import repeat
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+
+# Size of the tiles the street network is stored in, roughly 7km x 11km at Berlin's latitude
+NETWORK_TILE_DEGREES = 0.1
+
+# Number of rows of the input file read at a time
+DEFAULT_CHUNK_SIZE = 500_000
+
+# Input file suffixes read with pyarrow and their dataset format
+ARROW_FORMATS = {".parquet": "parquet", ".arrow": "ipc", ".feather": "ipc"}
+
+# Margin in meters around each group's convex hull within which the network is searched for its meeting point
+MEETING_POINT_MARGIN = 500
+
+# Network distances between neighbouring users are only searched up to this multiple of the straight line distance,
+# neighbours further than that by bike are treated as not connected
+NETWORK_DETOUR_LIMIT = 3
+
+# Shortest network search distance in meters, so very close neighbours still find paths around a block
+MIN_NETWORK_SEARCH = 250
+
+# Side in meters of the cells users are batched in when computing network distances between neighbours
+NETWORK_BATCH_CELL = 2000
+
+# Largest distance matrix, in entries, computed by a single Dijkstra call
+MAX_DIJKSTRA_ENTRIES = 4_000_000
+
+# Number of snapping indexes kept in memory, so a long running service doesn't hold every region it has seen
+MAX_SNAP_INDEXES = 16
+
+# Snapping indexes already loaded in this process, keyed by network type and index key, least recently used first
+SNAP_INDEXES: OrderedDict[tuple[str, str], StreetSnapIndex] = OrderedDict()
+SNAP_INDEXES_LOCK = Lock()
+
+
+def _median_locations(
+    userIds, codes: np.ndarray, latitude: np.ndarray, longitude: np.ndarray
+) -> pd.DataFrame:
+    """
+    Takes the median location of each user. The median of one or two entries is their mean, so only users with
+    more entries than that need their locations sorting.
+
+    :param userIds: Array of the distinct user ids, sorted
+    :param ndarray codes: The position in userIds of the user of each entry
+    :param ndarray latitude: The latitude of each entry
+    :param ndarray longitude: The longitude of each entry
+
+    :return DataFrame: The user_id, latitude and longitude of each user sorted by user_id
+    """
+    counts = np.bincount(codes, minlength=userIds.shape[0])
+    manyEntries = counts[codes] > 2
+    manyCodes = codes[manyEntries]
+    manyCounts = counts[np.unique(manyCodes)]
+    starts = np.cumsum(manyCounts) - manyCounts
+    lower = starts + (manyCounts - 1) // 2
+    upper = starts + manyCounts // 2
+
+    medians = {}
+    for name, values in (("latitude", latitude), ("longitude", longitude)):
+        median = np.bincount(codes, weights=values, minlength=counts.shape[0]) / counts
+        # Sort by user then value with a single argsort of a combined integer key, much faster than lexsort
+        manyValues = values[manyEntries]
+        sortKey = manyCodes.astype(np.int64)
+        sortKey *= manyValues.shape[0]
+        sortKey[np.argsort(manyValues)] += np.arange(manyValues.shape[0])
+        sortedValues = manyValues[np.argsort(sortKey)]
+        median[counts > 2] = (sortedValues[lower] + sortedValues[upper]) / 2
+        medians[name] = median.astype(values.dtype)
+
+    users_with_duplicates = int((counts > 1).sum())
+    if users_with_duplicates > 0:
+        logWarning(
+            f"""Found [bold white]{users_with_duplicates}[/bold white] users who had multiple entries in the input file. 
+        Taking their starting location to be the centroid of their reported locations"""
+        )
+
+    return pd.DataFrame({"user_id": userIds, **medians})
 
 
 def clean_user_locations(userLocations: pd.DataFrame) -> pd.DataFrame:
@@ -18,86 +109,353 @@ def clean_user_locations(userLocations: pd.DataFrame) -> pd.DataFrame:
 
     :param DataFrame userLocations: the DataFrame of user locations to clearn
     """
-    users_with_duplicates = (
-        (userLocations.groupby("user_id").count() > 1).sum().latitude
+    codes, userIds = pd.factorize(userLocations.user_id, sort=True)
+    hasId = codes >= 0
+    return _median_locations(
+        np.asarray(userIds),
+        codes[hasId],
+        userLocations.latitude.to_numpy()[hasId],
+        userLocations.longitude.to_numpy()[hasId],
     )
-    if users_with_duplicates > 0:
-        logWarning(
-            f"""Found [bold white]{users_with_duplicates}[/bold white] users who had multiple entries in the input file. 
-        Taking their starting location to be the centroid of their reported locations"""
+
+
+def _arrow_batches(filePath: str, columns: list[str], idCol: str, chunkSize: int):
+    """
+    Streams the projected columns of a CSV, Parquet or Arrow IPC file as pyarrow record batches
+    """
+    suffix = Path(filePath).suffix.lower()
+    if suffix in ARROW_FORMATS:
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(filePath, format=ARROW_FORMATS[suffix])
+        yield from dataset.to_batches(columns=columns, batch_size=chunkSize)
+    else:
+        import pyarrow as pa
+        from pyarrow import csv
+
+        yield from csv.open_csv(
+            filePath,
+            read_options=csv.ReadOptions(block_size=chunkSize * 64),
+            convert_options=csv.ConvertOptions(
+                include_columns=columns,
+                column_types={column: pa.float64() for column in columns}
+                | {idCol: pa.string()},
+                strings_can_be_null=True,
+            ),
         )
-    return userLocations.groupby("user_id").median().reset_index()
 
 
-def load_user_locations(
+def _pandas_chunks(filePath: str, columns: list[str], idCol: str, chunkSize: int):
+    """
+    Streams the projected columns of a CSV file with explicit dtypes, used when pyarrow is not installed
+    """
+    if Path(filePath).suffix.lower() in ARROW_FORMATS:
+        raise Exception(
+            f"Reading {Path(filePath).suffix} files requires pyarrow, install it or convert the input to CSV"
+        )
+    yield from pd.read_csv(
+        filePath,
+        usecols=columns,
+        dtype={column: np.float64 for column in columns} | {idCol: str},
+        chunksize=chunkSize,
+    )
+
+
+def _input_columns(filePath: str) -> list[str]:
+    suffix = Path(filePath).suffix.lower()
+    if suffix in ARROW_FORMATS and importlib.util.find_spec("pyarrow") is not None:
+        import pyarrow.dataset as ds
+
+        return ds.dataset(filePath, format=ARROW_FORMATS[suffix]).schema.names
+    return pd.read_csv(filePath, nrows=0).columns.to_list()
+
+
+def read_user_locations(
     filePath: str,
-    latCol: Optional[str] = "latitude",
-    lngCol: Optional[str] = "longitude",
-    userIdCol: Optional[str] = "user_id",
-) -> gp.GeoDataFrame:
+    latCol: str = "latitude",
+    lngCol: str = "longitude",
+    userIdCol: str = "user_id",
+    chunkSize: int = DEFAULT_CHUNK_SIZE,
+    float32: bool = False,
+) -> pd.DataFrame:
     """
-    Loads the user location file, checks to see that it contains the required columns and standardizes column names.
-    Also transforms the dataframe to a local CRS
+    Streams the user locations from a CSV, Parquet or Arrow IPC file, reading only the needed columns. Each chunk is
+    validated as it is read and reduced to its ids and coordinate arrays, then users with multiple entries are
+    deduplicated by taking their median location. Uses pyarrow when it is installed, which keeps the ids as compact
+    arrow strings rather than python objects, and falls back to pandas for CSV files.
 
     :param str filePath: The path to the input file
     :param str latCol: The column in the file that represents the latitude
     :param str lngCol: The column in the file that represents the longitude
     :param str userIdCol: The column in the file that represents the unique user id
+    :param int chunkSize: The approximate number of rows to read at a time
+    :param bool float32: Hold the coordinates as float32, halving their memory at the cost of sub meter precision
 
-    :return GeoDataFrame: The loaded and standardized dataframe.
+    :return DataFrame: The user_id, latitude and longitude of each user sorted by user_id
     """
-    userLocations = pd.read_csv(filePath)
+    columns = _input_columns(filePath)
     assert (
-        userIdCol in userLocations.columns
+        userIdCol in columns
     ), f"The supplied user_id column: {userIdCol} is not present in the supplied input file"
     assert (
-        latCol in userLocations.columns
+        latCol in columns
     ), f"The supplied latitude column: {latCol} is not present in the supplied input file"
     assert (
-        lngCol in userLocations.columns
+        lngCol in columns
     ), f"The supplied longitude column: {lngCol} is not present in the supplied input file"
-    userLocations.rename(
-        columns={lngCol: "longitude", latCol: "latitude", userIdCol: "user_id"},
-        inplace=True,
+
+    useArrow = importlib.util.find_spec("pyarrow") is not None
+    if useArrow:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    chunks = (_arrow_batches if useArrow else _pandas_chunks)(
+        filePath, [userIdCol, latCol, lngCol], userIdCol, chunkSize
     )
 
-    userLocations = clean_user_locations(userLocations)
+    coordDtype = np.float32 if float32 else np.float64
+    userIds, latitudes, longitudes = [], [], []
+    invalidRows = 0
+    for chunk in chunks:
+        if useArrow:
+            ids = chunk.column(userIdCol).cast("string")
+            idMissing = ids.is_null().to_numpy(zero_copy_only=False)
+        else:
+            ids = chunk[userIdCol].to_numpy()
+            idMissing = chunk[userIdCol].isna().to_numpy()
+        latitude = np.asarray(chunk[latCol], dtype=coordDtype)
+        longitude = np.asarray(chunk[lngCol], dtype=coordDtype)
+        # Comparisons with NaN are false so missing coordinates are invalid too
+        valid = ~idMissing & (np.abs(latitude) <= 90) & (np.abs(longitude) <= 180)
+        invalidRows += int((~valid).sum())
+        userIds.append(ids.filter(pa.array(valid)) if useArrow else ids[valid])
+        latitudes.append(latitude[valid])
+        longitudes.append(longitude[valid])
 
-    userLocations = gp.GeoDataFrame(
-        userLocations,
-        geometry=gp.points_from_xy(userLocations[lngCol], userLocations[latCol]),
-        crs="epsg:4326",
+    if invalidRows > 0:
+        logWarning(
+            f"Dropped [bold white]{invalidRows}[/bold white] rows with a missing user id or an invalid location"
+        )
+
+    if useArrow:
+        encoded = pa.concat_arrays(userIds or [pa.array([], pa.string())])
+        encoded = encoded.dictionary_encode()
+        # Sort the distinct ids in arrow and renumber the entries to match
+        order = pc.sort_indices(encoded.dictionary).to_numpy().astype(np.int64)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0])
+        codes = rank[encoded.indices.to_numpy(zero_copy_only=False)]
+        distinctIds = pd.array(encoded.dictionary.take(order), dtype="string[pyarrow]")
+    else:
+        codes, distinctIds = pd.factorize(
+            np.concatenate(userIds) if userIds else np.empty(0, dtype=object),
+            sort=True,
+        )
+        distinctIds = np.asarray(distinctIds)
+
+    return _median_locations(
+        distinctIds,
+        codes,
+        np.concatenate(latitudes) if latitudes else np.empty(0, dtype=coordDtype),
+        np.concatenate(longitudes) if longitudes else np.empty(0, dtype=coordDtype),
+    )
+
+
+def estimate_utm_crs(longitude: np.ndarray, latitude: np.ndarray) -> CRS:
+    """
+    Picks the UTM zone at the center of the bounds of a set of lat lng coordinates, as GeoDataFrame.estimate_utm_crs
+    does but without building the points first
+
+    :param ndarray longitude: The longitude of each point
+    :param ndarray latitude: The latitude of each point
+    :return CRS: The UTM CRS
+    """
+    center = AreaOfInterest(
+        west_lon_degree=(longitude.min() + longitude.max()) / 2,
+        south_lat_degree=(latitude.min() + latitude.max()) / 2,
+        east_lon_degree=(longitude.min() + longitude.max()) / 2,
+        north_lat_degree=(latitude.min() + latitude.max()) / 2,
+    )
+    utmCrsList = query_utm_crs_info(datum_name="WGS 84", area_of_interest=center)
+    if len(utmCrsList) == 0:
+        raise Exception("Unable to determine a UTM CRS for the user locations")
+    return CRS.from_epsg(utmCrsList[0].code)
+
+
+def load_user_locations(
+    filePath: str,
+    latCol: Optional[str] = "latitude",
+    lngCol: Optional[str] = "longitude",
+    userIdCol: Optional[str] = "user_id",
+    float32: bool = False,
+) -> gp.GeoDataFrame:
+    """
+    Loads the user location file, checks to see that it contains the required columns and standardizes column names.
+    Also transforms the dataframe to a local CRS
+
+    :param str filePath: The path to the input file, either a CSV, Parquet or Arrow IPC file
+    :param str latCol: The column in the file that represents the latitude
+    :param str lngCol: The column in the file that represents the longitude
+    :param str userIdCol: The column in the file that represents the unique user id
+    :param bool float32: Read the coordinates as float32 to reduce peak memory
+
+    :return GeoDataFrame: The loaded and standardized dataframe.
+    """
+    locationsKey = RunCache.key(
+        RunCache.file_key(filePath), latCol, lngCol, userIdCol, float32
     )
+    cachedLocations = RunCache.get_cached_geo_data_frame("user_locations", locationsKey)
+    if cachedLocations is not None:
+        logInfo(f"Loaded {cachedLocations.shape[0]} users from cache")
+        return cachedLocations
 
+    userLocations = read_user_locations(
+        filePath, latCol, lngCol, userIdCol, float32=float32
+    )
     logInfo(f"Found {userLocations.shape[0]} users!")
 
-    # Guess the local crs and transfrorm to it
-    crs = userLocations.estimate_utm_crs()
-    userLocations.to_crs(crs, inplace=True)
+    userLocations = project_user_locations(userLocations)
+    RunCache.cache_geo_data_frame("user_locations", locationsKey, userLocations)
     return userLocations
 
 
+def project_user_locations(userLocations: pd.DataFrame) -> gp.GeoDataFrame:
+    """
+    Projects cleaned user locations to the UTM zone they fall in
+
+    :param DataFrame userLocations: The user_id, latitude and longitude of each user
+    :return GeoDataFrame: The users with their projected locations as the geometry
+    """
+    # Guess the local crs and project the coordinate arrays to it before building the points
+    longitude = userLocations.longitude.to_numpy(dtype=np.float64)
+    latitude = userLocations.latitude.to_numpy(dtype=np.float64)
+    crs = estimate_utm_crs(longitude, latitude)
+    x, y = Transformer.from_crs("epsg:4326", crs, always_xy=True).transform(
+        longitude, latitude
+    )
+    return gp.GeoDataFrame(userLocations, geometry=gp.points_from_xy(x, y), crs=crs)
+
+
 def snap_points_to_street_network(
-    points: gp.GeoDataFrame, network: MultiDiGraph
+    points: gp.GeoDataFrame, snapIndex: StreetSnapIndex
 ) -> gp.GeoDataFrame:
     """
-    Takes a GeoSeries of points and snaps then to the provided network
+    Takes a GeoSeries of points and snaps then to the nearest street intersection
 
     :param GeoDataFrame points: The GeoSeries to be snapped
-    :param MultiDiGraph network: The network to snap them to
+    :param StreetSnapIndex snapIndex: The intersections of the network to snap them to
 
     :return GeoSeries: The snapped points.
     """
-    nodeIds = ox.nearest_nodes(network, points.geometry.x, points.geometry.y)
+    snapped, _ = snapIndex.snap(point_coordinates(points))
+    snappedPoints = gp.points_from_xy(snapped[:, 0], snapped[:, 1])
+    return gp.GeoDataFrame(points[["label"]], geometry=snappedPoints, crs=points.crs)
+
+
+def point_coordinates(df: gp.GeoDataFrame) -> np.ndarray:
+    """
+    Extracts the coordinates of a DataFrame of points as a contiguous (n, 2) float64 array, which the clustering
+    stages work on instead of the shapely geometries
+
+    :param GeoDataFrame df: The DataFrame of points
+    :return ndarray: The x and y of each point
+    """
+    return np.ascontiguousarray(shapely.get_coordinates(df.geometry.values))
 
-    if not isinstance(nodeIds, Iterable):
-        raise Exception("osmx returned wrong type for nearest nodes")
 
-    nodes = [network.nodes[nodeId] for nodeId in nodeIds]
-    snappedPoints = gp.points_from_xy(
-        [node["x"] for node in nodes], [node["y"] for node in nodes]
+def point_weights(df: gp.GeoDataFrame) -> Optional[np.ndarray]:
+    """
+    The number of users each point stands for, when the points are cells from aggregate_user_locations
+
+    :param GeoDataFrame df: The DataFrame of points
+    :return ndarray: The weight of each point, or None if every point is a single user
+    """
+    if "weight" not in df.columns:
+        return None
+    return df["weight"].to_numpy(dtype=np.float64)
+
+
+def aggregate_user_locations(
+    df: gp.GeoDataFrame, resolution: float, maxWeight: Optional[int] = None
+) -> tuple[gp.GeoDataFrame, np.ndarray]:
+    """
+    Snaps users to a square grid and replaces the users in each cell with a single point at their centroid,
+    weighted by how many users it stands for. Cells holding more than maxWeight users are broken up in to
+    several points so a group can still be split between them.
+
+    :param GeoDataFrame df: The users in a projected CRS with units of meters
+    :param float resolution: The side length of the grid cells in meters
+    :param int maxWeight: The most users a single point can stand for
+    :return (GeoDataFrame, ndarray): The weighted points and the position of each user's point
+    """
+    coords = point_coordinates(df)
+    cells = np.floor(coords / resolution).astype(np.int64)
+    cells -= cells.min(axis=0)
+    _, cellOfUser, cellSizes = np.unique(
+        cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1],
+        return_inverse=True,
+        return_counts=True,
     )
-    return gp.GeoDataFrame(points[["label"]], geometry=snappedPoints, crs=points.crs)
+
+    if maxWeight is not None and cellSizes.max() > maxWeight:
+        # Number the users within each cell and start a new point every maxWeight users
+        order = np.argsort(cellOfUser, kind="stable")
+        starts = np.cumsum(cellSizes) - cellSizes
+        rank = np.empty_like(cellOfUser)
+        rank[order] = np.arange(cellOfUser.shape[0]) - starts[cellOfUser[order]]
+        chunksPerCell = cellSizes.max() // maxWeight + 1
+        _, cellOfUser = np.unique(
+            cellOfUser * chunksPerCell + rank // maxWeight, return_inverse=True
+        )
+
+    weights = np.bincount(cellOfUser)
+    _, centroids = group_centroids(coords, cellOfUser)
+    cellPoints = gp.GeoDataFrame(
+        {"weight": weights},
+        geometry=gp.points_from_xy(centroids[:, 0], centroids[:, 1]),
+        crs=df.crs,
+    )
+    return cellPoints, cellOfUser
+
+
+def group_centroids(
+    coords: np.ndarray, labels: np.ndarray, weights: Optional[np.ndarray] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the centroid of each group of points from grouped sums of their coordinates
+
+    :param ndarray coords: (n, 2) array of the point coordinates
+    :param ndarray labels: The group label of each point
+    :param ndarray weights: The weight of each point, if None every point counts once
+    :return (ndarray, ndarray): The sorted group labels and the (k, 2) centroid of each group
+    """
+    groupLabels, codes = np.unique(labels, return_inverse=True)
+    if weights is None:
+        weights = np.ones(codes.shape[0])
+    sizes = np.bincount(codes, weights=weights)
+    centroids = np.stack(
+        [
+            np.bincount(codes, weights=coords[:, 0] * weights) / sizes,
+            np.bincount(codes, weights=coords[:, 1] * weights) / sizes,
+        ],
+        axis=1,
+    )
+    return groupLabels, centroids
+
+
+def group_convex_hulls(
+    coords: np.ndarray, labels: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the convex hull of each group of points in a single batched shapely call
+
+    :param ndarray coords: (n, 2) array of the point coordinates
+    :param ndarray labels: The group label of each point
+    :return (ndarray, ndarray): The sorted group labels and the convex hull geometry of each group
+    """
+    groupLabels, codes = np.unique(labels, return_inverse=True)
+    order = np.argsort(codes, kind="stable")
+    points = shapely.multipoints(coords[order], indices=codes[order])
+    return groupLabels, shapely.convex_hull(points)
 
 
 def generate_group_centroids(clusteredUsers: gp.GeoDataFrame) -> gp.GeoDataFrame:
@@ -108,33 +466,188 @@ def generate_group_centroids(clusteredUsers: gp.GeoDataFrame) -> gp.GeoDataFrame
 
     :return GeoSeries: The centroids of each group.
     """
-    centroids = GeoDataFrame(
-        clusteredUsers.groupby("label")
-        .geometry.apply(lambda points: MultiPoint(points.values).centroid)
-        .reset_index()
+    labels, centroids = group_centroids(
+        point_coordinates(clusteredUsers), clusteredUsers.label.to_numpy()
+    )
+    return GeoDataFrame(
+        {"label": labels},
+        geometry=gp.points_from_xy(centroids[:, 0], centroids[:, 1]),
+        crs=clusteredUsers.crs,
     )
-    return centroids.set_crs(clusteredUsers.crs)
 
 
-def get_network_graph(
+def network_tiles(bounds: tuple[float, float, float, float]) -> list[tuple[int, int]]:
+    """
+    Lists the network tiles needed to cover a bounding box
+
+    :param [number] bounds: the bounds in lat lng in the format [min lng, min lat, max lng, max lat]
+    :return [(int, int)]: The grid position of each tile
+    """
+    minX, minY, maxX, maxY = [
+        math.floor(bound / NETWORK_TILE_DEGREES) for bound in bounds
+    ]
+    return [(x, y) for x in range(minX, maxX + 1) for y in range(minY, maxY + 1)]
+
+
+def _download_network_tile(tile: tuple[int, int], mode: str) -> CompactNetwork:
+    """
+    Downloads the unprojected network for a single tile. Edges crossing the tile boundary are kept
+    so that neighbouring tiles join up when assembled.
+    """
+    west, south = tile[0] * NETWORK_TILE_DEGREES, tile[1] * NETWORK_TILE_DEGREES
+    try:
+        network = ox.graph_from_bbox(
+            south + NETWORK_TILE_DEGREES,
+            south,
+            west + NETWORK_TILE_DEGREES,
+            west,
+            network_type=mode,
+            retain_all=True,
+            truncate_by_edge=True,
+        )
+    except ValueError:
+        # osmnx raises a subclass of ValueError when a tile contains no network
+        return CompactNetwork.empty("epsg:4326")
+    return CompactNetwork.from_graph(network)
+
+
+def get_network_tile(tile: tuple[int, int], mode: str, crs) -> CompactNetwork:
+    """
+    Gets a single network tile in the requested CRS. Tries the tile store first, then projects the stored
+    lat lng tile and finally downloads it.
+    """
+    network = NetworkCache.get_tile(mode, crs, tile)
+    if network is not None:
+        return network
+
+    network = NetworkCache.get_tile(mode, "epsg:4326", tile)
+    if network is None:
+        if NetworkCache.offline:
+            raise Exception(
+                f"Network tile {tile} is not in the local store. Import a network covering the region with meetup network import"
+            )
+        network = _download_network_tile(tile, mode)
+        NetworkCache.set_tile(mode, "epsg:4326", tile, network)
+
+    network = network.to_crs(crs)
+    NetworkCache.set_tile(mode, crs, tile, network)
+    return network
+
+
+def get_compact_network(
     bounds: tuple[float, float, float, float], mode="bike", crs="epsg:4326"
-) -> MultiDiGraph:
+) -> CompactNetwork:
     """
-    dowloads and caches the network graph for a bounded region
+    Assembles the compact network for a bounded region from the shared tile store, downloading
+    and caching any tiles which are missing
 
-    :param [number] bounds: the bounds in format []
+    :param [number] bounds: the bounds in lat lng in the format [min lng, min lat, max lng, max lat]
+    :param str mode: The osmnx network type
+    :param crs: The CRS to project the network to
     """
     logInfo(f"Getting bike network for region {bounds}")
-    network = RunCache.get_network("cycle_network")
-    if network is None:
-        network = ox.graph_from_bbox(
-            bounds[3], bounds[1], bounds[2], bounds[0], network_type=mode
+    tiles = network_tiles(bounds)
+    with span("network_fetch", tiles=len(tiles)) as stage:
+        network = CompactNetwork.concat(
+            [get_network_tile(tile, mode, crs) for tile in tiles]
         )
-        network = ox.project_graph(network, crs)
-        RunCache.set_network("cycle_network", network)
+        stage.counts["nodes"] = network.number_of_nodes
+    logInfo(
+        f"Assembled network with {network.number_of_nodes} nodes from {len(tiles)} tiles"
+    )
     return network
 
 
+def get_network_graph(
+    bounds: tuple[float, float, float, float], mode="bike", crs="epsg:4326"
+) -> MultiDiGraph:
+    """
+    Assembles the network graph for a bounded region from the shared tile store. The graph carries the node
+    coordinates and street counts and the edge lengths.
+
+    :param [number] bounds: the bounds in lat lng in the format [min lng, min lat, max lng, max lat]
+    :param str mode: The osmnx network type
+    :param crs: The CRS to project the network to
+    """
+    network = get_compact_network(bounds, mode, crs).to_graph()
+    network.graph["crs"] = crs
+    return network
+
+
+def get_snap_index(
+    bounds: tuple[float, float, float, float],
+    mode="bike",
+    crs="epsg:4326",
+    minStreetCount: int = 1,
+) -> StreetSnapIndex:
+    """
+    Gets the index of street nodes for a bounded region. The index is kept in memory and stored
+    alongside the network tiles so the network itself only needs assembling the first time.
+
+    :param [number] bounds: the bounds in lat lng in the format [min lng, min lat, max lng, max lat]
+    :param str mode: The osmnx network type
+    :param crs: The CRS to project the intersections to
+    :param int minStreetCount: The minimum number of streets meeting at a node for it to be a snapping target
+    """
+    tiles = network_tiles(bounds)
+    key = RunCache.key(tiles, NetworkCache.crs_name(crs), minStreetCount)
+    with SNAP_INDEXES_LOCK:
+        if (mode, key) in SNAP_INDEXES:
+            SNAP_INDEXES.move_to_end((mode, key))
+            return SNAP_INDEXES[(mode, key)]
+
+    snapIndex = NetworkCache.get_snap_index(mode, crs, key)
+    if snapIndex is None:
+        network = get_compact_network(bounds, mode, crs)
+        snapIndex = StreetSnapIndex.from_network(network, minStreetCount)
+        NetworkCache.set_snap_index(mode, crs, key, snapIndex)
+    else:
+        logInfo("Loaded street intersections from the network store")
+
+    with SNAP_INDEXES_LOCK:
+        SNAP_INDEXES[(mode, key)] = snapIndex
+        SNAP_INDEXES.move_to_end((mode, key))
+        while len(SNAP_INDEXES) > MAX_SNAP_INDEXES:
+            SNAP_INDEXES.popitem(last=False)
+    return snapIndex
+
+
+def import_network(filePath: str, mode="bike") -> int:
+    """
+    Pre-populates the tile store from a local .osm or .graphml file so runs covering it can work offline
+
+    :param str filePath: The network file, either OSM XML (.osm/.xml) or a graphml file saved by osmnx
+    :param str mode: The network type to store the tiles under
+    :return int: The number of tiles stored
+    """
+    if Path(filePath).suffix == ".graphml":
+        network = ox.load_graphml(filePath)
+    else:
+        network = ox.graph_from_xml(filePath, retain_all=True)
+    network = CompactNetwork.from_graph(network).to_crs("epsg:4326")
+
+    nodeTiles = np.stack(
+        [
+            np.floor(network.x / NETWORK_TILE_DEGREES),
+            np.floor(network.y / NETWORK_TILE_DEGREES),
+        ],
+        axis=1,
+    ).astype(np.int64)
+    tiles = np.unique(nodeTiles, axis=0)
+
+    for tileX, tileY in tiles:
+        inTile = (nodeTiles[:, 0] == tileX) & (nodeTiles[:, 1] == tileY)
+        NetworkCache.set_tile(
+            mode, "epsg:4326", (int(tileX), int(tileY)), network.select(inTile)
+        )
+
+    NetworkCache.clear_snap_indexes(mode)
+    with SNAP_INDEXES_LOCK:
+        SNAP_INDEXES.clear()
+    logInfo(f"Imported {tiles.shape[0]} network tiles from {filePath}")
+    return tiles.shape[0]
+
+
 def generate_cluster_convex_hull(
     df: GeoDataFrame, groupBy: str = "label", geometryCol: str = "geometry"
 ):
@@ -145,8 +658,191 @@ def generate_cluster_convex_hull(
     :param str groupBy: The key to use in the groupby query
     :param str geometryCol: The geometry column to use
     """
-    hulls = df.groupby(groupBy).apply(
-        lambda group: gp.GeoSeries(MultiPoint(list(group[geometryCol])).convex_hull)
+    labels, hulls = group_convex_hulls(
+        np.ascontiguousarray(shapely.get_coordinates(df[geometryCol].values)),
+        df[groupBy].to_numpy(),
+    )
+    return gp.GeoDataFrame(
+        {geometryCol: hulls},
+        index=pd.Index(labels, name=groupBy),
+        geometry=geometryCol,
+        crs=df.crs,
+    )
+
+
+def _best_meeting_node(
+    graph, nodeCoords: np.ndarray, memberCoords: np.ndarray, minimax: bool
+) -> int:
+    """
+    Finds the node of a group's part of the network with the lowest total (or with minimax the lowest maximum)
+    network distance from the members. Members join the network at their nearest node. Runs in a worker
+    process so takes and returns plain arrays.
+
+    param csr_matrix graph: The adjacency matrix of the group's part of the network
+    param ndarray nodeCoords: (k, 2) array of the coordinates of its nodes
+    param ndarray memberCoords: (m, 2) array of the coordinates of the members
+    param bool minimax: Minimize the longest distance rather than the total distance
+
+    return int: The position of the best node in nodeCoords
+    """
+    snapDistance, memberNodes = cKDTree(nodeCoords).query(memberCoords)
+    sources, inverse = np.unique(memberNodes, return_inverse=True)
+    distances = (
+        dijkstra(graph, directed=True, indices=sources)[inverse] + snapDistance[:, None]
+    )
+    unreachable = np.isinf(distances)
+    distances[unreachable] = 0
+    score = distances.max(axis=0) if minimax else distances.sum(axis=0)
+    # Prefer the nodes reachable by the most members, then the best score
+    return int(np.lexsort((score, unreachable.sum(axis=0)))[0])
+
+
+def network_meeting_points(
+    clusteredUsers: gp.GeoDataFrame,
+    network: CompactNetwork,
+    minimax: bool = False,
+    margin: float = MEETING_POINT_MARGIN,
+    workers: Optional[int] = None,
+) -> gp.GeoDataFrame:
+    """
+    Picks the network node each group can reach with the least cycling. The search for each group is restricted to
+    the part of the network within its convex hull plus a margin and the groups are solved in a pool of processes,
+    each running a single multi-source Dijkstra from the nodes its members join the network at.
+
+    :param GeoDataFrame clusteredUsers: The labeled users, in the same projected CRS as the network
+    :param CompactNetwork network: The street network covering the users
+    :param bool minimax: Minimize the longest distance any member travels rather than the total distance
+    :param float margin: The distance in meters around each group's convex hull to search
+    :param Optional[int] workers: The number of processes to use, defaults to the number of cores
+
+    :return GeoDataFrame: The meeting point of each label
+    """
+    coords = point_coordinates(clusteredUsers)
+    labels, inverse = np.unique(clusteredUsers.label.to_numpy(), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    groupCoords = np.split(coords[order], np.cumsum(np.bincount(inverse))[:-1])
+    regions = shapely.buffer(
+        shapely.convex_hull(shapely.multipoints(coords[order], indices=inverse[order])),
+        margin,
+    )
+
+    shapely.prepare(regions)
+
+    nodeCoords = np.stack([network.x, network.y], axis=1)
+    nodeTree = cKDTree(nodeCoords)
+    graph = network.to_csr()
+
+    groupNodes = []
+    for members, region in zip(groupCoords, regions):
+        # The buffered hull lies within this circle so the tree narrows down the nodes to test against it
+        center = members.mean(axis=0)
+        radius = np.linalg.norm(members - center, axis=1).max() + margin
+        candidates = np.asarray(
+            nodeTree.query_ball_point(center, radius), dtype=np.int64
+        )
+        candidates = candidates[
+            shapely.contains_xy(
+                region, nodeCoords[candidates, 0], nodeCoords[candidates, 1]
+            )
+        ]
+        if candidates.shape[0] == 0:
+            candidates = np.array([nodeTree.query(center)[1]])
+        groupNodes.append(candidates)
+
+    tasks = (
+        [graph[nodes][:, nodes] for nodes in groupNodes],
+        [nodeCoords[nodes] for nodes in groupNodes],
+        groupCoords,
+        repeat(minimax),
+    )
+    if workers == 1:
+        best = list(map(_best_meeting_node, *tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            best = list(pool.map(_best_meeting_node, *tasks, chunksize=64))
+
+    meetingNodes = np.array([nodes[index] for nodes, index in zip(groupNodes, best)])
+    return GeoDataFrame(
+        {"label": labels},
+        geometry=gp.points_from_xy(
+            nodeCoords[meetingNodes, 0], nodeCoords[meetingNodes, 1]
+        ),
+        crs=clusteredUsers.crs,
+    )
+
+
+def network_knn_graph(
+    coords: np.ndarray, network: CompactNetwork, neighbours: int = 10
+) -> sparse.csr_matrix:
+    """
+    Builds a sparse graph linking each user to its nearest neighbours as the crow flies, weighted by the cycling
+    distance between them. Users join the network at their nearest node. The users are batched in to square cells
+    and the distances from each cell are found with a multi-source Dijkstra over just the part of the network the
+    searches can reach, so no dense user or node distance matrix is ever built. Neighbours more than
+    NETWORK_DETOUR_LIMIT times further by bike than in a straight line, such as across a river, are left unlinked.
+
+    :param ndarray coords: (n, 2) array of the user coordinates, in the same projected CRS as the network
+    :param CompactNetwork network: The street network covering the users
+    :param int neighbours: The number of nearest neighbours to link each user to
+    :return csr_matrix: Symmetric (n, n) matrix of the network distance between linked users
+    """
+    noUsers = coords.shape[0]
+    neighbours = min(neighbours, noUsers - 1)
+    if neighbours < 1:
+        return sparse.csr_matrix((noUsers, noUsers))
+
+    nodeCoords = np.stack([network.x, network.y], axis=1)
+    snapDistance, userNodes = cKDTree(nodeCoords).query(coords)
+    straightLine, nearest = cKDTree(coords).query(coords, neighbours + 1)
+
+    source = np.repeat(np.arange(noUsers), neighbours)
+    target = nearest[:, 1:].ravel()
+    straightLine = straightLine[:, 1:].ravel()
+    networkDistance = np.full(source.shape[0], np.inf)
+
+    graph = network.to_csr()
+    cells = np.floor(coords[source] / NETWORK_BATCH_CELL).astype(np.int64)
+    _, cellIds = np.unique(cells, axis=0, return_inverse=True)
+    cellIds = cellIds.ravel()
+    order = np.argsort(cellIds, kind="stable")
+    for pairs in np.split(order, np.cumsum(np.bincount(cellIds))[:-1]):
+        limit = max(
+            MIN_NETWORK_SEARCH, NETWORK_DETOUR_LIMIT * straightLine[pairs].max()
+        )
+        # Any node a search can reach lies within the limit of the node it started from, and the nodes the users
+        # snapped to must be in the window even when the users are set back from the street
+        batchUsers = np.concatenate([source[pairs], target[pairs]])
+        endpoints = np.concatenate(
+            [coords[batchUsers], nodeCoords[userNodes[batchUsers]]]
+        )
+        low = endpoints.min(axis=0) - limit
+        high = endpoints.max(axis=0) + limit
+        inCell = np.all((nodeCoords >= low) & (nodeCoords <= high), axis=1)
+        subgraph = graph[inCell][:, inCell]
+        localNodes = np.cumsum(inCell) - 1
+
+        sourceNodes, sourcePosition = np.unique(
+            localNodes[userNodes[source[pairs]]], return_inverse=True
+        )
+        targetNodes = localNodes[userNodes[target[pairs]]]
+        batchSize = max(1, MAX_DIJKSTRA_ENTRIES // max(subgraph.shape[0], 1))
+        for start in range(0, sourceNodes.shape[0], batchSize):
+            batch = (sourcePosition >= start) & (sourcePosition < start + batchSize)
+            distances = dijkstra(
+                subgraph,
+                directed=True,
+                indices=sourceNodes[start : start + batchSize],
+                limit=limit,
+            )
+            networkDistance[pairs[batch]] = distances[
+                sourcePosition[batch] - start, targetNodes[batch]
+            ]
+
+    weights = snapDistance[source] + networkDistance + snapDistance[target]
+    # Users joining the network at the same node are still as far apart as the crow flies
+    weights = np.maximum(weights, np.maximum(straightLine, 1e-6))
+    linked = np.isfinite(weights) & (source != target)
+    knnGraph = sparse.csr_matrix(
+        (weights[linked], (source[linked], target[linked])), shape=(noUsers, noUsers)
     )
-    hulls = hulls.rename(columns={0: geometryCol})
-    return gp.GeoDataFrame(hulls, crs=df.crs)
+    return knnGraph.maximum(knnGraph.T).tocsr()
@@ -0,0 +1,322 @@
+"""
+Runs clustering jobs submitted to the service on a pool of worker threads. Workers live as long as the service so
+the libraries, network tiles and snapping indexes they load stay warm between jobs.
+"""
+
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from enum import Enum
+from queue import Full, Queue
+from threading import Condition, Thread
+from typing import Optional
+import io
+import json
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from .caching import RunCache
+from .clustering import group_summaries
+from .geo import clean_user_locations, project_user_locations
+from .logging import logError, logInfo
+from .options import (
+    DEFAULT_JOB_WORKERS,
+    InitialClusteringMethod,
+    DEFAULT_MAX_KEPT_JOBS,
+    DEFAULT_MAX_QUEUED_JOBS,
+    RunParameters,
+)
+from .pipeline import group_users
+from .profiling import RunProfiler, span
+
+# Parameters a job can set. The rest read or write files on the server or control its resources, tileSizeKm among
+# them as partitioning starts a pool of processes
+JOB_PARAMETERS = [
+    "minOccupancy",
+    "maxOccupancy",
+    "maxIters",
+    "meetingPointMethod",
+    "snapMinStreetCount",
+    "initialMethod",
+    "refineMethod",
+    "aggregateResolution",
+    "seed",
+]
+
+# AffinityPropagation builds a dense n x n matrix, so jobs using it are limited to this many users to keep one
+# submission from exhausting the memory shared by every job of the service
+MAX_AFFINITY_PROPAGATION_USERS = 2_000
+
+
+class JobStatus(str, Enum):
+    """
+    Enum representing the stages of a job
+    QUEUED: Waiting for a worker
+    RUNNING: Being clustered
+    DONE: Finished, the groups can be fetched
+    FAILED: Stopped with an error
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    @property
+    def finished(self) -> bool:
+        return self in (JobStatus.DONE, JobStatus.FAILED)
+
+
+@dataclass
+class Job:
+    id: str
+    users: Optional[pd.DataFrame]
+    parameters: RunParameters
+    noUsers: int
+    status: JobStatus = JobStatus.QUEUED
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    result: Optional[list[dict]] = None
+    profile: list[dict] = field(default_factory=list)
+
+    def summary(self) -> dict:
+        """
+        The state of the job as returned by the job API
+        """
+        now = time.time()
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "users": self.noUsers,
+            "parameters": {
+                name: value
+                for name, value in asdict(self.parameters).items()
+                if name in JOB_PARAMETERS
+            },
+            "submitted": self.submitted,
+            "queuedSeconds": round((self.started or now) - self.submitted, 3),
+            "runSeconds": (
+                None
+                if self.started is None
+                else round((self.finished or now) - self.started, 3)
+            ),
+            "groups": None if self.result is None else len(self.result),
+            "error": self.error,
+            "profile": self.profile,
+        }
+
+
+def read_job_users(users: pd.DataFrame) -> pd.DataFrame:
+    """
+    Checks the users of a submission have an id and a valid location
+
+    :param DataFrame users: The submitted users
+    :return DataFrame: The user_id, latitude and longitude of each user
+    :raises ValueError: If a column is missing or any user is invalid
+    """
+    missing = [
+        column
+        for column in ["user_id", "latitude", "longitude"]
+        if column not in users.columns
+    ]
+    if missing:
+        raise ValueError(f"Users are missing the {', '.join(missing)} columns")
+    if users.shape[0] == 0:
+        raise ValueError("No users were submitted")
+
+    latitude = pd.to_numeric(users.latitude, errors="coerce").to_numpy(np.float64)
+    longitude = pd.to_numeric(users.longitude, errors="coerce").to_numpy(np.float64)
+    # Comparisons with NaN are false so missing coordinates are invalid too
+    valid = (
+        users.user_id.notna().to_numpy()
+        & (np.abs(latitude) <= 90)
+        & (np.abs(longitude) <= 180)
+    )
+    if not valid.all():
+        raise ValueError(
+            f"{int((~valid).sum())} users have a missing user_id or an invalid location"
+        )
+    return pd.DataFrame(
+        {
+            "user_id": users.user_id.astype(str).to_numpy(),
+            "latitude": latitude,
+            "longitude": longitude,
+        }
+    )
+
+
+def parse_job(
+    body: bytes, contentType: str, query: dict[str, str]
+) -> tuple[pd.DataFrame, RunParameters]:
+    """
+    Reads a job submission. Either a JSON object with a list of users and an object of parameters, or a CSV of
+    users with the parameters in the query string.
+
+    :param bytes body: The request body
+    :param str contentType: The Content-Type of the request
+    :param dict query: The query string parameters
+    :return (DataFrame, RunParameters): The users and the parameters of the job
+    :raises ValueError: If the submission is malformed
+    """
+    if contentType.startswith("application/json"):
+        try:
+            submission = json.loads(body)
+        except json.JSONDecodeError as error:
+            raise ValueError(f"Invalid JSON: {error}")
+        if not isinstance(submission, dict) or not isinstance(
+            submission.get("users"), list
+        ):
+            raise ValueError("Expected an object with a list of users")
+        users = pd.DataFrame(submission["users"])
+        values = submission.get("parameters", {})
+        if not isinstance(values, dict):
+            raise ValueError("Parameters should be an object")
+    elif contentType.startswith("text/csv"):
+        # Parser errors are ValueErrors
+        users = pd.read_csv(io.BytesIO(body))
+        values = query
+    else:
+        raise ValueError("Submit the users as application/json or text/csv")
+
+    unsupported = set(values) - set(JOB_PARAMETERS)
+    if unsupported:
+        raise ValueError(
+            f"Jobs can't set {', '.join(sorted(unsupported))}. They can set {', '.join(JOB_PARAMETERS)}"
+        )
+    parameters = RunParameters.from_dict(values)
+    # Jobs run on the service's threads, where forking a pool of processes for the network meeting points could
+    # copy locks held by other threads, so they are solved in the worker thread
+    parameters.workers = 1
+    if (
+        parameters.initialMethod == InitialClusteringMethod.AFFINITY_PROPAGATION
+        and users.shape[0] > MAX_AFFINITY_PROPAGATION_USERS
+    ):
+        raise ValueError(
+            f"Jobs using affinity_propagation are limited to {MAX_AFFINITY_PROPAGATION_USERS} users, use kmeans for larger submissions"
+        )
+    return read_job_users(users), parameters
+
+
+class JobQueue:
+    """
+    A bounded queue of clustering jobs worked through by a fixed pool of threads. Jobs are kept in memory, along
+    with their results once they finish, until enough newer jobs have finished.
+    """
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_JOB_WORKERS,
+        maxQueued: int = DEFAULT_MAX_QUEUED_JOBS,
+        maxKeptJobs: int = DEFAULT_MAX_KEPT_JOBS,
+    ):
+        self.queue: Queue[Optional[Job]] = Queue(maxQueued)
+        self.maxKeptJobs = maxKeptJobs
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        # Notified whenever a job changes status
+        self.changed = Condition()
+        self.workers = [
+            Thread(target=self._work, name=f"meetup-job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, users: pd.DataFrame, parameters: RunParameters) -> Optional[Job]:
+        """
+        Queues a job
+
+        :param DataFrame users: The user_id, latitude and longitude of each user
+        :param RunParameters parameters: The parameters of the job
+        :return Job: The queued job, or None if the queue is full
+        """
+        job = Job(uuid.uuid4().hex, users, parameters, users.shape[0])
+        with self.changed:
+            self.jobs[job.id] = job
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            with self.changed:
+                del self.jobs[job.id]
+            return None
+        logInfo(f"Queued job {job.id} with {job.noUsers} users")
+        return job
+
+    def get(self, jobId: str) -> Optional[Job]:
+        with self.changed:
+            return self.jobs.get(jobId)
+
+    def summaries(self) -> list[dict]:
+        with self.changed:
+            jobs = list(self.jobs.values())
+        return [job.summary() for job in jobs]
+
+    def wait_until_finished(self, job: Job, timeout: float) -> bool:
+        """
+        Blocks until the job finishes or the timeout passes
+
+        :return bool: Whether the job has finished
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: job.status.finished, timeout)
+
+    def wait_for_change(self, job: Job, status: JobStatus, timeout: float) -> bool:
+        """
+        Blocks until the job moves on from a status or the timeout passes
+
+        :return bool: Whether the status changed
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: job.status != status, timeout)
+
+    def shutdown(self):
+        """
+        Stops the workers once they finish the jobs already queued
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _set_status(self, job: Job, status: JobStatus):
+        with self.changed:
+            job.status = status
+            if status == JobStatus.RUNNING:
+                job.started = time.time()
+            elif status.finished:
+                job.finished = time.time()
+                self._forget_old_jobs()
+            self.changed.notify_all()
+
+    def _forget_old_jobs(self):
+        finished = [job.id for job in self.jobs.values() if job.status.finished]
+        for jobId in finished[: max(0, len(finished) - self.maxKeptJobs)]:
+            del self.jobs[jobId]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self._run(job)
+
+    def _run(self, job: Job):
+        self._set_status(job, JobStatus.RUNNING)
+        status = JobStatus.DONE
+        with RunProfiler.collect() as spans:
+            try:
+                with span("job", users=job.noUsers):
+                    locations = project_user_locations(clean_user_locations(job.users))
+                    groupAssignments, groupMeetingPoints, _ = group_users(
+                        locations, job.parameters
+                    )
+                    job.result = group_summaries(groupAssignments, groupMeetingPoints)
+            except Exception as error:
+                logError(f"Job {job.id} failed: {error}")
+                job.error = str(error)
+                status = JobStatus.FAILED
+        job.profile = [stage.to_dict() for stage in spans]
+        job.users = None
+        self._set_status(job, status)
+        RunCache.prune()
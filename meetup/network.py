@@ -0,0 +1,286 @@
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import numpy as np
+from networkx import MultiDiGraph
+from pyproj import CRS, Transformer
+from scipy.spatial import cKDTree
+from scipy import sparse
+
+# Arrays making up a CompactNetwork, each saved as its own .npy file so they can be memory mapped
+NETWORK_ARRAYS = [
+    "nodeIds",
+    "x",
+    "y",
+    "streetCount",
+    "edgeSource",
+    "edgeTarget",
+    "edgeLength",
+]
+
+
+@dataclass
+class CompactNetwork:
+    """
+    A street network held as flat node and edge arrays rather than networkx objects. Only keeps what we
+    need for snapping and routing: the node coordinates and street counts and the edge lengths.
+    Edges reference nodes by their position in the node arrays.
+    """
+
+    nodeIds: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    streetCount: np.ndarray
+    edgeSource: np.ndarray
+    edgeTarget: np.ndarray
+    edgeLength: np.ndarray
+    crs: str
+
+    @property
+    def number_of_nodes(self) -> int:
+        return self.nodeIds.shape[0]
+
+    @classmethod
+    def empty(cls, crs) -> "CompactNetwork":
+        return cls(
+            np.empty(0, dtype=np.int64),
+            np.empty(0),
+            np.empty(0),
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0),
+            CRS(crs).to_string(),
+        )
+
+    @classmethod
+    def from_graph(cls, graph: MultiDiGraph) -> "CompactNetwork":
+        """
+        Builds the compact network from an osmnx graph
+        """
+        nodeIds = np.fromiter(graph.nodes, dtype=np.int64, count=len(graph))
+        nodes = graph.nodes
+        x = np.array([nodes[node]["x"] for node in nodeIds], dtype=np.float64)
+        y = np.array([nodes[node]["y"] for node in nodeIds], dtype=np.float64)
+        streetCount = np.array(
+            [nodes[node].get("street_count", graph.degree(node)) for node in nodeIds],
+            dtype=np.int32,
+        )
+
+        edges = list(graph.edges(data="length", default=np.nan))
+        position = {node: index for index, node in enumerate(nodeIds)}
+        edgeSource = np.array([position[u] for u, _, _ in edges], dtype=np.int64)
+        edgeTarget = np.array([position[v] for _, v, _ in edges], dtype=np.int64)
+        edgeLength = np.array([length for _, _, length in edges], dtype=np.float64)
+
+        return cls(
+            nodeIds,
+            x,
+            y,
+            streetCount,
+            edgeSource,
+            edgeTarget,
+            edgeLength,
+            CRS(graph.graph["crs"]).to_string(),
+        )
+
+    def to_graph(self) -> MultiDiGraph:
+        """
+        Builds an osmnx compatible graph with x, y and street_count on the nodes and length on the edges
+        """
+        graph = MultiDiGraph(crs=self.crs)
+        graph.add_nodes_from(
+            (int(node), {"x": x, "y": y, "street_count": int(count)})
+            for node, x, y, count in zip(self.nodeIds, self.x, self.y, self.streetCount)
+        )
+        graph.add_edges_from(
+            (int(self.nodeIds[u]), int(self.nodeIds[v]), {"length": length})
+            for u, v, length in zip(self.edgeSource, self.edgeTarget, self.edgeLength)
+        )
+        return graph
+
+    def to_crs(self, crs) -> "CompactNetwork":
+        """
+        Reprojects the node coordinates. Edge lengths are in meters and do not change
+        """
+        transformer = Transformer.from_crs(self.crs, crs, always_xy=True)
+        x, y = transformer.transform(np.asarray(self.x), np.asarray(self.y))
+        return CompactNetwork(
+            self.nodeIds,
+            np.asarray(x, dtype=np.float64),
+            np.asarray(y, dtype=np.float64),
+            self.streetCount,
+            self.edgeSource,
+            self.edgeTarget,
+            self.edgeLength,
+            CRS(crs).to_string(),
+        )
+
+    def select(self, nodeMask: np.ndarray) -> "CompactNetwork":
+        """
+        Selects the nodes in the mask along with every edge touching them. The far end of edges leaving the
+        selection is kept too, so selections of neighbouring regions join back up when concatenated.
+
+        param ndarray nodeMask: Boolean mask of the nodes to select
+        return CompactNetwork: The selected part of the network
+        """
+        edgeMask = nodeMask[self.edgeSource] | nodeMask[self.edgeTarget]
+        keepNodes = nodeMask.copy()
+        keepNodes[self.edgeSource[edgeMask]] = True
+        keepNodes[self.edgeTarget[edgeMask]] = True
+
+        newPosition = np.cumsum(keepNodes) - 1
+        return CompactNetwork(
+            self.nodeIds[keepNodes],
+            self.x[keepNodes],
+            self.y[keepNodes],
+            self.streetCount[keepNodes],
+            newPosition[self.edgeSource[edgeMask]],
+            newPosition[self.edgeTarget[edgeMask]],
+            self.edgeLength[edgeMask],
+            self.crs,
+        )
+
+    @classmethod
+    def concat(cls, networks: list["CompactNetwork"]) -> "CompactNetwork":
+        """
+        Joins networks in the same CRS, such as neighbouring tiles. Nodes are matched on their id and
+        edges present in more than one network are kept once.
+        """
+        crs = networks[0].crs
+        networks = [network for network in networks if network.number_of_nodes > 0]
+        if len(networks) == 0:
+            return cls.empty(crs)
+
+        nodeIds = np.concatenate([network.nodeIds for network in networks])
+        uniqueIds, first, position = np.unique(
+            nodeIds, return_index=True, return_inverse=True
+        )
+
+        # Shift each network's edge indexes to the concatenated node arrays, then map to the unique nodes
+        offsets = np.cumsum([0] + [network.number_of_nodes for network in networks])
+        edgeSource = np.concatenate(
+            [
+                position[network.edgeSource + offset]
+                for network, offset in zip(networks, offsets)
+            ]
+        )
+        edgeTarget = np.concatenate(
+            [
+                position[network.edgeTarget + offset]
+                for network, offset in zip(networks, offsets)
+            ]
+        )
+        edgeLength = np.concatenate([network.edgeLength for network in networks])
+        edges = np.unique(
+            np.stack([edgeSource, edgeTarget, edgeLength], axis=1), axis=0
+        )
+
+        return cls(
+            uniqueIds,
+            np.concatenate([network.x for network in networks])[first],
+            np.concatenate([network.y for network in networks])[first],
+            np.concatenate([network.streetCount for network in networks])[first],
+            edges[:, 0].astype(np.int64),
+            edges[:, 1].astype(np.int64),
+            edges[:, 2],
+            crs,
+        )
+
+    def to_csr(self) -> sparse.csr_matrix:
+        """
+        Builds a directed adjacency matrix weighted by edge length for use with scipy.sparse.csgraph.
+        Parallel edges keep their shortest length and edges without a length use the straight line distance
+        between their nodes, so this should be called on a network in a projected CRS.
+        """
+        length = np.asarray(self.edgeLength, dtype=np.float64)
+        straightLine = np.hypot(
+            self.x[self.edgeTarget] - self.x[self.edgeSource],
+            self.y[self.edgeTarget] - self.y[self.edgeSource],
+        )
+        length = np.where(np.isnan(length), straightLine, length)
+        # csgraph drops zero weights from sparse matrices, keep zero length edges as tiny ones instead
+        length = np.maximum(length, 1e-6)
+
+        order = np.lexsort((length, self.edgeTarget, self.edgeSource))
+        source = self.edgeSource[order]
+        target = self.edgeTarget[order]
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = (source[1:] != source[:-1]) | (target[1:] != target[:-1])
+
+        noNodes = self.number_of_nodes
+        return sparse.csr_matrix(
+            (length[order][first], (source[first], target[first])),
+            shape=(noNodes, noNodes),
+        )
+
+    def save(self, directory: Path):
+        """
+        Saves each array as an uncompressed .npy file in the directory, along with the CRS
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        for name in NETWORK_ARRAYS:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+        with open(directory / "crs.json", "w") as file:
+            json.dump({"crs": self.crs}, file)
+
+    @classmethod
+    def load(cls, directory: Path, mmap: bool = True) -> "CompactNetwork":
+        """
+        Loads a saved network. With mmap the arrays are memory mapped so only the pages used are read from disk
+        """
+        with open(directory / "crs.json", "r") as file:
+            crs = json.load(file)["crs"]
+        arrays = [
+            np.load(directory / f"{name}.npy", mmap_mode="r" if mmap else None)
+            for name in NETWORK_ARRAYS
+        ]
+        return cls(*arrays, crs)
+
+
+class StreetSnapIndex:
+    """
+    Spatial index of the street intersections of a network, used to snap points to the street network
+    in a single vectorized query without holding on to the network itself
+    """
+
+    def __init__(self, coords: np.ndarray):
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64)
+        self.tree = cKDTree(self.coords)
+
+    @classmethod
+    def from_network(
+        cls, network: CompactNetwork, minStreetCount: int = 1
+    ) -> "StreetSnapIndex":
+        """
+        Builds the index from the nodes of the network with at least minStreetCount streets meeting at them.
+        Every node is indexed by default, set minStreetCount to 3 to snap to real intersections rather than
+        dead ends or bends. Falls back to every node when the network has no such intersections.
+
+        param CompactNetwork network: The network to index
+        param int minStreetCount: The minimum number of streets meeting at a node for it to be indexed
+        """
+        if network.number_of_nodes == 0:
+            raise Exception("Can't snap to an empty street network")
+        intersections = np.asarray(network.streetCount) >= minStreetCount
+        if not intersections.any():
+            intersections = np.ones(network.number_of_nodes, dtype=bool)
+        return cls(np.stack([network.x, network.y], axis=1)[intersections])
+
+    def snap(self, coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Snaps each point to its nearest indexed intersection
+
+        param ndarray coords: (n, 2) array of the points to snap
+        return (ndarray, ndarray): The (n, 2) snapped coordinates and the distance each point moved
+        """
+        distances, nearest = self.tree.query(coords)
+        return self.coords[nearest], distances
+
+    def save(self, filePath: Path):
+        filePath.parent.mkdir(parents=True, exist_ok=True)
+        np.save(filePath, self.coords)
+
+    @classmethod
+    def load(cls, filePath: Path) -> "StreetSnapIndex":
+        return cls(np.load(filePath))
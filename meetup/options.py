@@ -0,0 +1,158 @@
+"""
+The options of a run and their defaults. Kept free of heavy imports so the CLI can build its commands without
+loading the geospatial and machine learning libraries.
+"""
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+# Decimal places kept in exported lat lng coordinates, 6 is roughly 10cm
+DEFAULT_COORDINATE_PRECISION = 6
+
+# Default eviction policy applied at the end of each run
+DEFAULT_MAX_SIZE_MB = 2048
+DEFAULT_MAX_AGE_DAYS = 30
+
+DEFAULT_PORT = 8000
+
+# Jobs run at once by the service
+DEFAULT_JOB_WORKERS = 2
+
+# Jobs waiting for a worker beyond this are turned away until the queue drains
+DEFAULT_MAX_QUEUED_JOBS = 16
+
+# Finished jobs kept in memory along with their results, the oldest are forgotten first
+DEFAULT_MAX_KEPT_JOBS = 100
+
+
+class MeetingPointMethod(str, Enum):
+    """
+    Enum representing different strategies for generating a meeting point
+    CENTROID : Simply take the centroid of the group
+    CENTROID_SNAPED_TO_STREET: Calculate the centroid but then use the bike network graph to ensure that it's at a street intersection
+    NETWORK_MEDIAN: Use the street intersection with the lowest total cycling distance from the group members
+    NETWORK_MINIMAX: Use the street intersection with the lowest cycling distance for the member furthest away
+    LANDMARK: Try to find landmarks close the centroid to use as the meeting spot
+    """
+
+    CENTROID = ("centroid",)
+    CENTROID_SNAPED_TO_STREET = "centroid_snapped_to_street"
+    NETWORK_MEDIAN = "network_median"
+    NETWORK_MINIMAX = "network_minimax"
+
+
+class InitialClusteringMethod(str, Enum):
+    """
+    Enum representing the different algorithums used to generate the inital proposal clusters
+    KMEANS: MiniBatch KMeans with the number of clusters derived from the occupancy bounds. Memory grows linearly with the number of users
+    AFFINITY_PROPAGATION: Let AffinityPropagation decide the number of clusters. Builds a dense n x n similarity matrix so only suitable for a few thousand users
+    NETWORK_KMEANS: KMeans on cycling distances through the street network, so groups don't straddle rivers, rail lines or motorways. Downloads the street network for the area
+    """
+
+    KMEANS = "kmeans"
+    AFFINITY_PROPAGATION = "affinity_propagation"
+    NETWORK_KMEANS = "network_kmeans"
+
+
+class RefinementMethod(str, Enum):
+    """
+    Enum representing the different strategies for getting the groups within the occupancy bounds
+    ITERATIVE: Repeatedly split groups over the maximum and merge groups under the minimum. Not guarenteed to reach the bounds
+    BALANCED: Capacity constrained KMeans. Assigns users to groups by solving a min cost flow problem with the occupancy bounds as constraints
+    """
+
+    ITERATIVE = "iterative"
+    BALANCED = "balanced"
+
+
+class MailingListFormat(str, Enum):
+    """
+    Enum representing the layouts the mailing list can be written in
+    DENORMALIZED: A single mailingList.csv with the meeting point and every member of the group on each user's row
+    NORMALIZED: A groups.csv with one row per group and a user_groups.csv with the group of each user
+    BOTH: Write both layouts
+    """
+
+    DENORMALIZED = "denormalized"
+    NORMALIZED = "normalized"
+    BOTH = "both"
+
+
+class OutputFormat(str, Enum):
+    """
+    Enum representing the file formats the geographic outputs of a run can be written in
+    GEOJSON: Plain GeoJSON, as read by the visualization
+    GEOJSON_GZ: Gzip compressed GeoJSON
+    FLATGEOBUF: FlatGeobuf, a compact binary format with a spatial index
+    GEOPARQUET: GeoParquet, the most compact and fastest to write. Requires pyarrow
+    """
+
+    GEOJSON = "geojson"
+    GEOJSON_GZ = "geojson_gz"
+    FLATGEOBUF = "flatgeobuf"
+    GEOPARQUET = "geoparquet"
+
+
+@dataclass
+class RunParameters:
+    """
+    The parameters of a run, named as they are in runDetails.json and the job API
+    """
+
+    minOccupancy: Optional[int] = None
+    maxOccupancy: Optional[int] = None
+    maxIters: Optional[int] = None
+    meetingPointMethod: MeetingPointMethod = MeetingPointMethod.CENTROID
+    snapMinStreetCount: int = 1
+    initialMethod: InitialClusteringMethod = InitialClusteringMethod.KMEANS
+    refineMethod: RefinementMethod = RefinementMethod.ITERATIVE
+    aggregateResolution: Optional[float] = None
+    baseRun: Optional[str] = None
+    workers: Optional[int] = None
+    tileSizeKm: Optional[float] = None
+    restarts: int = 1
+    seed: Optional[int] = None
+    mailingListFormat: MailingListFormat = MailingListFormat.DENORMALIZED
+    outputFormat: OutputFormat = OutputFormat.GEOJSON
+    coordinatePrecision: Optional[int] = DEFAULT_COORDINATE_PRECISION
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "RunParameters":
+        """
+        Builds the parameters from a dict of their values, which may be strings as when they come from a query string
+
+        :param dict values: The values of the parameters to set, the rest keep their defaults
+        :raises ValueError: If a parameter is unknown or its value is invalid
+        """
+        unknown = set(values) - set(PARAMETER_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown parameters {', '.join(sorted(unknown))}")
+        parsed = {}
+        for name, value in values.items():
+            try:
+                parsed[name] = None if value is None else PARAMETER_TYPES[name](value)
+            except ValueError:
+                raise ValueError(f"Invalid value {value!r} for {name}")
+        return cls(**parsed)
+
+
+# How each parameter is parsed from the values of a job submission
+PARAMETER_TYPES = {
+    "minOccupancy": int,
+    "maxOccupancy": int,
+    "maxIters": int,
+    "meetingPointMethod": MeetingPointMethod,
+    "snapMinStreetCount": int,
+    "initialMethod": InitialClusteringMethod,
+    "refineMethod": RefinementMethod,
+    "aggregateResolution": float,
+    "baseRun": str,
+    "workers": int,
+    "tileSizeKm": float,
+    "restarts": int,
+    "seed": int,
+    "mailingListFormat": MailingListFormat,
+    "outputFormat": OutputFormat,
+    "coordinatePrecision": int,
+}
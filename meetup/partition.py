@@ -0,0 +1,263 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import geopandas as gp
+from scipy.spatial import cKDTree
+from .clustering import (
+    InitialClusteringMethod,
+    RefinementMethod,
+    cluster_users,
+    improve_clusters,
+    spawn_seeds,
+)
+from .geo import point_coordinates
+from .logging import logInfo
+from .caching import RunCache
+
+# Fraction of the tile size added around each tile so groups on the boundary see their neighbours
+DEFAULT_OVERLAP_FRACTION = 0.15
+
+
+@dataclass
+class Tile:
+    """
+    A spatial cell of the projected user set.
+    The core is the region the tile is responsible for, users in the margin around it are clustered
+    with the tile but only groups centered in the core are kept.
+    """
+
+    ix: int
+    iy: int
+    core: tuple[float, float, float, float]
+    userIndexes: np.ndarray
+
+
+def tile_users(coords: np.ndarray, tileSize: float, overlap: float) -> list[Tile]:
+    """
+    Splits the users into square tiles of the given size, each padded by the overlap margin
+
+    param ndarray coords: (n, 2) array of the projected user coordinates
+    param float tileSize: The side of each tile in the units of the projection
+    param float overlap: The margin added to each side of the tile
+
+    return [Tile]: The tiles which contain at least one user in their core
+    """
+    origin = coords.min(axis=0)
+    cells = np.floor((coords - origin) / tileSize).astype(np.int64)
+
+    tiles = []
+    for ix, iy in np.unique(cells, axis=0):
+        minX = origin[0] + ix * tileSize
+        minY = origin[1] + iy * tileSize
+        core = (minX, minY, minX + tileSize, minY + tileSize)
+        inTile = (
+            (coords[:, 0] >= minX - overlap)
+            & (coords[:, 0] < core[2] + overlap)
+            & (coords[:, 1] >= minY - overlap)
+            & (coords[:, 1] < core[3] + overlap)
+        )
+        tiles.append(Tile(int(ix), int(iy), core, np.flatnonzero(inTile)))
+    return tiles
+
+
+def _cluster_tile(
+    coords: np.ndarray,
+    crs,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int,
+    initialMethod: InitialClusteringMethod,
+    refineMethod: RefinementMethod,
+    aggregateResolution: Optional[float] = None,
+    seed: Optional[int] = None,
+) -> tuple[np.ndarray, float]:
+    """
+    Clusters the users of a single tile. Runs in a worker process so takes and returns plain arrays
+
+    return (ndarray, float): The label of each user in the tile and the time taken in seconds
+    """
+    start = time.perf_counter()
+    tileUsers = gp.GeoDataFrame(
+        geometry=gp.points_from_xy(coords[:, 0], coords[:, 1]), crs=crs
+    )
+    labels = cluster_users(
+        tileUsers,
+        minOccupancy,
+        maxOccupancy,
+        maxIters,
+        initialMethod,
+        refineMethod,
+        aggregateResolution,
+        seed,
+    )
+    return labels, time.perf_counter() - start
+
+
+def stitch_tiles(
+    coords: np.ndarray, tiles: list[Tile], tileLabels: list[np.ndarray]
+) -> np.ndarray:
+    """
+    Combines the per tile clusterings in to a single labeling of all the users.
+    Each tile keeps the groups whose centroid lies within its core. Users claimed by groups from more than one
+    tile join the group with the nearest centroid and users not claimed by any group join the nearest kept group.
+
+    param ndarray coords: (n, 2) array of the projected user coordinates
+    param [Tile] tiles: The tiles the users were split in to
+    param [ndarray] tileLabels: The labels generated for the users of each tile
+
+    return ndarray: The global label of each user
+    """
+    noUsers = coords.shape[0]
+    labels = np.full(noUsers, -1, dtype=np.int64)
+    bestDistance = np.full(noUsers, np.inf)
+    keptCentroids = []
+
+    for tile, localLabels in zip(tiles, tileLabels):
+        tileCoords = coords[tile.userIndexes]
+        _, localLabels = np.unique(localLabels, return_inverse=True)
+        sizes = np.bincount(localLabels)
+        centroids = np.stack(
+            [
+                np.bincount(localLabels, weights=tileCoords[:, 0]) / sizes,
+                np.bincount(localLabels, weights=tileCoords[:, 1]) / sizes,
+            ],
+            axis=1,
+        )
+        minX, minY, maxX, maxY = tile.core
+        keep = (
+            (centroids[:, 0] >= minX)
+            & (centroids[:, 0] < maxX)
+            & (centroids[:, 1] >= minY)
+            & (centroids[:, 1] < maxY)
+        )
+
+        # Map the kept local labels to global labels
+        globalLabels = np.full(centroids.shape[0], -1, dtype=np.int64)
+        globalLabels[keep] = np.arange(keep.sum()) + len(keptCentroids)
+        keptCentroids.extend(centroids[keep])
+
+        claimed = keep[localLabels]
+        users = tile.userIndexes[claimed]
+        distances = np.linalg.norm(
+            tileCoords[claimed] - centroids[localLabels[claimed]], axis=1
+        )
+        closer = distances < bestDistance[users]
+        labels[users[closer]] = globalLabels[localLabels[claimed][closer]]
+        bestDistance[users[closer]] = distances[closer]
+
+    unassigned = np.flatnonzero(labels == -1)
+    if unassigned.shape[0] > 0:
+        _, nearest = cKDTree(np.array(keptCentroids)).query(coords[unassigned])
+        labels[unassigned] = nearest
+
+    # Groups can lose all their users to closer groups so make the labels sequential again
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels
+
+
+def run_partitioned_clustering(
+    df: gp.GeoDataFrame,
+    minGroupOccupancy: Optional[int],
+    maxGroupOccupancy: Optional[int],
+    maxIters: Optional[int],
+    initialMethod: InitialClusteringMethod = InitialClusteringMethod.KMEANS,
+    refineMethod: RefinementMethod = RefinementMethod.ITERATIVE,
+    workers: Optional[int] = None,
+    tileSizeKm: float = 10,
+    aggregateResolution: Optional[float] = None,
+    seed: Optional[int] = None,
+) -> gp.GeoDataFrame:
+    """
+    Runs the clustering on spatial tiles of the input in a pool of processes and stitches the results
+    back together. Groups on the tile boundaries are then reconciled with a final refinement pass over
+    all the users.
+
+    param GeoDataFrame df: The cleaned users in a projected CRS with units of meters
+    param Optional[int] minGroupOccupancy: The minimum group occupancy to target
+    param Optional[int] maxGroupOccupancy: The maximum group occupancy to target
+    param Optional[int] maxIters: The maximum number of refinement iterations per tile
+    param InitialClusteringMethod initialMethod: The method used to generate the initial clusters in each tile
+    param RefinementMethod refineMethod: The method used to bring the groups in each tile within the occupancy bounds
+    param Optional[int] workers: The number of processes to use, defaults to the number of cores
+    param float tileSizeKm: The side length of each tile in km
+    param Optional[float] aggregateResolution: If specified, the users in each tile are aggregated in to weighted grid cells of this size in meters before clustering
+    param Optional[int] seed: If specified, each tile and the reconciliation pass are seeded from it so the groups can be reproduced
+
+    return GeoDataFrame: The input DataFrame with the clustering labels attached
+    """
+    iterations = maxIters if maxIters is not None else 10
+    partitionedKey = RunCache.key(
+        RunCache.frame_key(df),
+        minGroupOccupancy,
+        maxGroupOccupancy,
+        iterations,
+        initialMethod,
+        refineMethod,
+        tileSizeKm,
+        aggregateResolution,
+        seed,
+    )
+    partitionedClusters = RunCache.get_cached_geo_data_frame(
+        "refined_clusters", partitionedKey
+    )
+    if partitionedClusters is not None:
+        logInfo("Loaded partitioned clusters from cache")
+        return partitionedClusters
+
+    coords = point_coordinates(df)
+    tileSize = tileSizeKm * 1000
+    tiles = tile_users(coords, tileSize, tileSize * DEFAULT_OVERLAP_FRACTION)
+
+    logInfo(
+        f"[bold yellow]🧩[/bold yellow] Split [bold white]{df.shape[0]}[/bold white] users in to [bold white]{len(tiles)}[/bold white] tiles of {tileSizeKm}km"
+    )
+
+    # The last seed is for the reconciliation pass
+    seeds = spawn_seeds(seed, len(tiles) + 1)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                _cluster_tile,
+                coords[tile.userIndexes],
+                df.crs,
+                minGroupOccupancy,
+                maxGroupOccupancy,
+                iterations,
+                initialMethod,
+                refineMethod,
+                aggregateResolution,
+                tileSeed,
+            )
+            for tile, tileSeed in zip(tiles, seeds)
+        ]
+        tileLabels = []
+        for tile, future in zip(tiles, futures):
+            labels, elapsed = future.result()
+            tileLabels.append(labels)
+            logInfo(
+                f"Tile ({tile.ix}, {tile.iy}): {tile.userIndexes.shape[0]} users in {len(np.unique(labels))} groups took {elapsed:.2f}s"
+            )
+
+    logInfo(f"Clustered all tiles in {time.perf_counter() - start:.2f}s")
+
+    stitched = gp.GeoDataFrame(df.assign(label=stitch_tiles(coords, tiles, tileLabels)))
+
+    logInfo(
+        f"Stitched tiles together in to [bold white]{stitched.label.max() + 1}[/bold white] groups"
+    )
+
+    if minGroupOccupancy is not None or maxGroupOccupancy is not None:
+        logInfo("Reconciling groups on the tile boundaries")
+        stitched = improve_clusters(
+            stitched,
+            minGroupOccupancy,
+            maxGroupOccupancy,
+            iterations,
+            seed=seeds[-1],
+        )
+
+    RunCache.cache_geo_data_frame("refined_clusters", partitionedKey, stitched)
+    return stitched
@@ -0,0 +1,161 @@
+"""
+The stages of a run, shared by the run command and the job service
+"""
+
+from dataclasses import asdict
+from pathlib import Path
+import json
+import geopandas as gp
+from .clustering import (
+    generate_group_meeting_points,
+    run_clustering,
+    update_clusters,
+)
+from .export import export_run, read_output
+from .geo import generate_cluster_convex_hull, load_user_locations
+from .options import RunParameters
+from .partition import run_partitioned_clustering
+from .profiling import span
+from .restarts import run_multistart_clustering
+
+# Side length of the spatial tiles when partitioning is enabled by --workers alone
+DEFAULT_TILE_SIZE_KM = 10
+
+
+def group_users(
+    locations: gp.GeoDataFrame, parameters: RunParameters
+) -> tuple[gp.GeoDataFrame, gp.GeoDataFrame, gp.GeoDataFrame]:
+    """
+    Groups the users and generates a meeting point and region for each group
+
+    :param GeoDataFrame locations: The cleaned and projected users
+    :param RunParameters parameters: The parameters of the run
+    :return (GeoDataFrame, GeoDataFrame, GeoDataFrame): The users with their group labels, the meeting point of each group and the region of each group
+    """
+    if parameters.restarts > 1 and (
+        parameters.baseRun is not None or parameters.tileSizeKm is not None
+    ):
+        raise Exception(
+            "Restarts can't be combined with a base run or partitioned clustering"
+        )
+
+    with span("clustering") as stage:
+        if parameters.baseRun is not None:
+            baseAssignments = read_output(Path(parameters.baseRun), "usersAssignments")
+            groupAssignments = update_clusters(
+                locations,
+                baseAssignments,
+                parameters.minOccupancy,
+                parameters.maxOccupancy,
+                parameters.maxIters,
+            )
+        elif parameters.restarts > 1:
+            groupAssignments = run_multistart_clustering(
+                locations,
+                parameters.minOccupancy,
+                parameters.maxOccupancy,
+                parameters.maxIters,
+                parameters.initialMethod,
+                parameters.refineMethod,
+                parameters.aggregateResolution,
+                parameters.restarts,
+                parameters.seed,
+                parameters.workers,
+            )
+        elif parameters.tileSizeKm is not None or (
+            parameters.workers is not None and parameters.workers > 1
+        ):
+            groupAssignments = run_partitioned_clustering(
+                locations,
+                parameters.minOccupancy,
+                parameters.maxOccupancy,
+                parameters.maxIters,
+                parameters.initialMethod,
+                parameters.refineMethod,
+                parameters.workers,
+                (
+                    parameters.tileSizeKm
+                    if parameters.tileSizeKm is not None
+                    else DEFAULT_TILE_SIZE_KM
+                ),
+                parameters.aggregateResolution,
+                parameters.seed,
+            )
+        else:
+            groupAssignments = run_clustering(
+                locations,
+                parameters.minOccupancy,
+                parameters.maxOccupancy,
+                parameters.maxIters,
+                parameters.initialMethod,
+                parameters.refineMethod,
+                parameters.aggregateResolution,
+                parameters.seed,
+            )
+        stage.counts["groups"] = int(groupAssignments.label.nunique())
+
+    with span("meeting_points", method=parameters.meetingPointMethod.value):
+        groupMeetingPoints = generate_group_meeting_points(
+            groupAssignments,
+            parameters.meetingPointMethod,
+            parameters.workers,
+            parameters.snapMinStreetCount,
+        )
+    with span("regions"):
+        groupRegions = generate_cluster_convex_hull(groupAssignments)
+    return groupAssignments, groupMeetingPoints, groupRegions
+
+
+def run_pipeline(
+    userLocations: str,
+    outputDir: Path,
+    parameters: RunParameters,
+    latCol: str = "latitude",
+    lngCol: str = "longitude",
+    userIdCol: str = "user_id",
+    float32: bool = False,
+):
+    """
+    Loads the users from a file, groups them and writes the outputs of the run
+
+    :param str userLocations: The file containing the user locations
+    :param Path outputDir: The run directory to write the outputs to
+    :param RunParameters parameters: The parameters of the run
+    :param str latCol: The column in the file that represents the latitude
+    :param str lngCol: The column in the file that represents the longitude
+    :param str userIdCol: The column in the file that represents the unique user id
+    :param bool float32: Read the coordinates as float32 to reduce peak memory
+    """
+    with span("load_user_locations") as stage:
+        locations = load_user_locations(
+            userLocations, latCol, lngCol, userIdCol, float32
+        )
+        stage.counts["users"] = locations.shape[0]
+
+    groupAssignments, groupMeetingPoints, groupRegions = group_users(
+        locations, parameters
+    )
+
+    with span("export", format=parameters.outputFormat.value):
+        export_run(
+            outputDir,
+            groupAssignments,
+            groupMeetingPoints,
+            groupRegions,
+            parameters.outputFormat,
+            parameters.coordinatePrecision,
+            parameters.mailingListFormat,
+        )
+
+
+def write_run_details(
+    outputDir: Path, runName: str, parameters: RunParameters, profile: list[dict]
+):
+    """
+    Records the parameters and stage timings of a run in runDetails.json
+    """
+    with open(outputDir / "runDetails.json", "w") as file:
+        json.dump(
+            {**asdict(parameters), "name": runName, "profile": profile},
+            file,
+        )
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import local
+import cProfile
+import resource
+import sys
+import time
+
+
+@dataclass
+class Span:
+    """
+    The timing of one stage of a run. peakRssMb is the peak resident memory of the process when the stage finished,
+    so a stage that raised it above the peak of the stages before it is the one that set it.
+    """
+
+    name: str
+    counts: dict = field(default_factory=dict)
+    wallSeconds: float = 0
+    cpuSeconds: float = 0
+    peakRssMb: float = 0
+    children: list["Span"] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "wallSeconds": round(self.wallSeconds, 4),
+            "cpuSeconds": round(self.cpuSeconds, 4),
+            "peakRssMb": round(self.peakRssMb, 1),
+            **({"counts": self.counts} if self.counts else {}),
+            **(
+                {"children": [child.to_dict() for child in self.children]}
+                if self.children
+                else {}
+            ),
+        }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in bytes on macOS and KB everywhere else
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+class Profiler:
+    """
+    Records a tree of timed spans over the stages of a run. Spans opened while another is open on the same thread
+    become its children.
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.threadState = local()
+
+    def reset(self):
+        self.spans = []
+        self.threadState = local()
+
+    @contextmanager
+    def collect(self):
+        """
+        Collects the spans opened on this thread inside the context in to their own list rather than the run's, so
+        jobs running side by side each get their own timings
+
+        :return [Span]: The spans opened inside the context, filled in as they finish
+        """
+        previous = self.threadState.__dict__.get("roots")
+        roots = self.threadState.roots = []
+        try:
+            yield roots
+        finally:
+            self.threadState.roots = previous
+
+    @contextmanager
+    def span(self, name: str, **counts):
+        """
+        Times the code run inside the context. Counts can be given up front or added to the yielded span's counts
+
+        :param str name: The name of the stage
+        :param counts: Sizes of the work done in the stage, such as the number of users
+        """
+        stack = self.threadState.__dict__.setdefault("stack", [])
+        roots = self.threadState.__dict__.get("roots")
+        span = Span(name, dict(counts))
+        if stack:
+            stack[-1].children.append(span)
+        else:
+            (self.spans if roots is None else roots).append(span)
+        stack.append(span)
+        wallStart = time.perf_counter()
+        cpuStart = time.process_time()
+        try:
+            yield span
+        finally:
+            span.wallSeconds = time.perf_counter() - wallStart
+            span.cpuSeconds = time.process_time() - cpuStart
+            span.peakRssMb = peak_rss_mb()
+            stack.pop()
+
+    def report(self) -> list[dict]:
+        return [span.to_dict() for span in self.spans]
+
+
+@contextmanager
+def cprofile(filePath: Path):
+    """
+    Runs the code inside the context under cProfile and saves the stats to a file, which can be viewed with
+    snakeviz or turned in to a flamegraph with flameprof
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filePath)
+
+
+RunProfiler = Profiler()
+span = RunProfiler.span
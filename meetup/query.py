@@ -0,0 +1,135 @@
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+import numpy as np
+import pandas as pd
+import shapely
+from .export import read_output
+
+
+class RunIndex:
+    """
+    In memory indexes over the outputs of a run for answering lookups without sending the whole run to the browser.
+    Users are held sorted by group so the members of a group are a contiguous slice, user ids are looked up through a
+    hash index and groups are found by location with an STRtree of their regions. Everything is loaded on first use.
+    """
+
+    def __init__(self, runDir: Path):
+        self.runDir = Path(runDir)
+        self.loaded = False
+        self.lock = Lock()
+
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            users = read_output(self.runDir, "usersAssignments").to_crs("epsg:4326")
+            regions = read_output(self.runDir, "groupRegions").to_crs("epsg:4326")
+            meetingPoints = read_output(self.runDir, "groupMeetingPoints").to_crs(
+                "epsg:4326"
+            )
+
+            coords = shapely.get_coordinates(np.asarray(users.geometry.values))
+            order = np.argsort(users["label"].to_numpy(), kind="stable")
+            self.userIds = users["user_id"].astype(str).to_numpy()[order]
+            self.userLabels = users["label"].to_numpy()[order]
+            self.userCoords = coords[order]
+            self.userIndex = pd.Index(self.userIds)
+
+            self.labels = meetingPoints["label"].to_numpy()
+            labelOrder = np.argsort(self.labels)
+            self.labels = self.labels[labelOrder]
+            self.meetingPoints = shapely.get_coordinates(
+                np.asarray(meetingPoints.geometry.values)
+            )[labelOrder]
+            self.memberStart = np.searchsorted(self.userLabels, self.labels, "left")
+            self.memberEnd = np.searchsorted(self.userLabels, self.labels, "right")
+
+            regionPosition = np.searchsorted(self.labels, regions["label"].to_numpy())
+            self.regions = np.empty(self.labels.shape[0], dtype=object)
+            self.regions[regionPosition] = np.asarray(regions.geometry.values)
+            self.regionBounds = shapely.bounds(self.regions)
+            self.regionTree = shapely.STRtree(self.regions)
+            self.loaded = True
+
+    def _group_summary(self, position: int) -> dict:
+        return {
+            "label": int(self.labels[position]),
+            "memberCount": int(self.memberEnd[position] - self.memberStart[position]),
+            "meetingPoint": {
+                "latitude": float(self.meetingPoints[position, 1]),
+                "longitude": float(self.meetingPoints[position, 0]),
+            },
+            "bounds": self.regionBounds[position].tolist(),
+        }
+
+    def _group_position(self, label: int) -> Optional[int]:
+        position = int(np.searchsorted(self.labels, label))
+        if position < self.labels.shape[0] and self.labels[position] == label:
+            return position
+        return None
+
+    def groups(
+        self, bbox: Optional[tuple[float, float, float, float]] = None
+    ) -> list[dict]:
+        """
+        Summarises the groups whose regions intersect a bounding box
+
+        :param (float, float, float, float) bbox: The box as min lng, min lat, max lng, max lat. Every group if None
+        :return [dict]: The label, member count, meeting point and bounds of each group
+        """
+        self._load()
+        if bbox is None:
+            positions = np.arange(self.labels.shape[0])
+        else:
+            positions = np.sort(
+                self.regionTree.query(shapely.box(*bbox), predicate="intersects")
+            )
+        return [self._group_summary(position) for position in positions]
+
+    def group(self, label: int) -> Optional[dict]:
+        """
+        Details of a group along with its members
+
+        :param int label: The group label
+        :return dict: The group summary with a list of members, or None if there is no such group
+        """
+        self._load()
+        position = self._group_position(label)
+        if position is None:
+            return None
+        members = slice(self.memberStart[position], self.memberEnd[position])
+        return {
+            **self._group_summary(position),
+            "members": [
+                {"user_id": userId, "latitude": lat, "longitude": lng}
+                for userId, (lng, lat) in zip(
+                    self.userIds[members].tolist(),
+                    self.userCoords[members].tolist(),
+                )
+            ],
+        }
+
+    def user(self, userId: str) -> Optional[dict]:
+        """
+        The location and group of a user
+
+        :param str userId: The user id
+        :return dict: The user's location and a summary of their group, or None if there is no such user
+        """
+        self._load()
+        positions = self.userIndex.get_indexer_for([userId])
+        if positions[0] < 0:
+            return None
+        position = positions[0]
+        label = self.userLabels[position]
+        groupPosition = self._group_position(label)
+        return {
+            "user_id": userId,
+            "latitude": float(self.userCoords[position, 1]),
+            "longitude": float(self.userCoords[position, 0]),
+            "label": int(label),
+            "group": (
+                None if groupPosition is None else self._group_summary(groupPosition)
+            ),
+        }
@@ -0,0 +1,148 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import numpy as np
+import geopandas as gp
+from .clustering import (
+    InitialClusteringMethod,
+    RefinementMethod,
+    cluster_users,
+    score_labels,
+    spawn_seeds,
+)
+from .geo import point_coordinates
+from .logging import logInfo
+from .caching import RunCache
+from .profiling import span
+
+
+def _cluster_restart(
+    coords: np.ndarray,
+    crs,
+    minOccupancy: Optional[int],
+    maxOccupancy: Optional[int],
+    maxIters: int,
+    initialMethod: InitialClusteringMethod,
+    refineMethod: RefinementMethod,
+    aggregateResolution: Optional[float],
+    seed: int,
+) -> tuple[np.ndarray, tuple[int, float], float]:
+    """
+    Clusters all the users with one seed and scores the result. Runs in a worker process so takes and returns
+    plain arrays
+
+    return (ndarray, (int, float), float): The label of each user, the score of the labels and the time taken in seconds
+    """
+    start = time.perf_counter()
+    users = gp.GeoDataFrame(
+        geometry=gp.points_from_xy(coords[:, 0], coords[:, 1]), crs=crs
+    )
+    labels = cluster_users(
+        users,
+        minOccupancy,
+        maxOccupancy,
+        maxIters,
+        initialMethod,
+        refineMethod,
+        aggregateResolution,
+        seed,
+    )
+    score = score_labels(coords, labels, minOccupancy, maxOccupancy)
+    return labels, score, time.perf_counter() - start
+
+
+def run_multistart_clustering(
+    df: gp.GeoDataFrame,
+    minGroupOccupancy: Optional[int],
+    maxGroupOccupancy: Optional[int],
+    maxIters: Optional[int],
+    initialMethod: InitialClusteringMethod = InitialClusteringMethod.KMEANS,
+    refineMethod: RefinementMethod = RefinementMethod.ITERATIVE,
+    aggregateResolution: Optional[float] = None,
+    restarts: int = 4,
+    seed: Optional[int] = None,
+    workers: Optional[int] = None,
+) -> gp.GeoDataFrame:
+    """
+    Clusters the users several times with independent seeds in a pool of processes and keeps the best result,
+    as scored by score_labels. The seed of each restart is derived from the given seed, so the same seed always
+    picks the same groups.
+
+    param GeoDataFrame df: The cleaned users in a projected CRS with units of meters
+    param Optional[int] minGroupOccupancy: The minimum group occupancy to target
+    param Optional[int] maxGroupOccupancy: The maximum group occupancy to target
+    param Optional[int] maxIters: The maximum number of refinement iterations of each restart
+    param InitialClusteringMethod initialMethod: The method used to generate the initial clusters
+    param RefinementMethod refineMethod: The method used to bring the groups within the occupancy bounds
+    param Optional[float] aggregateResolution: If specified, the users are aggregated in to weighted grid cells of this size in meters before clustering
+    param int restarts: The number of clusterings to run
+    param Optional[int] seed: The seed the restarts are seeded from. If None one is picked at random and logged
+    param Optional[int] workers: The number of processes to use, defaults to the number of cores
+
+    return GeoDataFrame: The input DataFrame with the labels of the best clustering attached
+    """
+    iterations = maxIters if maxIters is not None else 10
+    restartsKey = RunCache.key(
+        RunCache.frame_key(df),
+        minGroupOccupancy,
+        maxGroupOccupancy,
+        iterations,
+        initialMethod,
+        refineMethod,
+        aggregateResolution,
+        restarts,
+        seed,
+    )
+    bestClusters = RunCache.get_cached_geo_data_frame("refined_clusters", restartsKey)
+    if bestClusters is not None:
+        logInfo("Loaded the best of the restarts from cache")
+        return bestClusters
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        logInfo(f"Seeded the restarts with {seed}, pass it as --seed to reproduce them")
+
+    coords = point_coordinates(df)
+    logInfo(
+        f"[bold yellow]🎲[/bold yellow] Clustering [bold white]{df.shape[0]}[/bold white] users [bold white]{restarts}[/bold white] times to keep the best"
+    )
+
+    with span("restarts", restarts=restarts) as stage:
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    _cluster_restart,
+                    coords,
+                    df.crs,
+                    minGroupOccupancy,
+                    maxGroupOccupancy,
+                    iterations,
+                    initialMethod,
+                    refineMethod,
+                    aggregateResolution,
+                    restartSeed,
+                )
+                for restartSeed in spawn_seeds(seed, restarts)
+            ]
+            results = []
+            for restart, future in enumerate(futures):
+                labels, score, elapsed = future.result()
+                results.append((labels, score))
+                logInfo(
+                    f"Restart {restart + 1}: {score[0]} groups outside the bounds, users {score[1]:.0f}m from their group's centroid on average, took {elapsed:.2f}s"
+                )
+
+        # Ties go to the earliest restart so the choice doesn't depend on the order the restarts finish in
+        best = min(range(restarts), key=lambda restart: results[restart][1])
+        labels, (violations, meanDistance) = results[best]
+        stage.counts.update(
+            best=best + 1, outsideBounds=violations, meanDistance=meanDistance
+        )
+
+    logInfo(
+        f"Kept restart {best + 1} of {restarts}, clustering took {time.perf_counter() - start:.2f}s"
+    )
+    bestClusters = gp.GeoDataFrame(df.assign(label=labels))
+    RunCache.cache_geo_data_frame("refined_clusters", restartsKey, bestClusters)
+    return bestClusters
@@ -1,81 +1,713 @@
-import http.server
-import socketserver
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import mimetypes
 import re
+from .export import OutputFormat, find_output, read_output, write_geojson
+from .options import (
+    DEFAULT_JOB_WORKERS,
+    DEFAULT_MAX_KEPT_JOBS,
+    DEFAULT_MAX_QUEUED_JOBS,
+    DEFAULT_PORT,
+)
+from .query import RunIndex
+from .tiles import RunTiles
+
+if TYPE_CHECKING:
+    from .jobs import Job, JobQueue
 
 VIZ_DIR = Path(__file__).parent / "interactive_viz_template"
 
+# Total size of the responses kept in memory. Files bigger than a quarter of this are streamed from disk instead
+DEFAULT_MEMORY_CACHE_MB = 512
 
-class MeetupVizHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def __init__(self, runName: str, *args, **kwargs):
-        self.runDir = Path(runName)
+# Longest a request for a job's status can wait for it to finish
+MAX_JOB_WAIT_SECONDS = 60
+
+# Largest job submission accepted
+MAX_JOB_SIZE_MB = 100
+
+# How long clients are asked to wait before resubmitting when the job queue is full
+JOB_RETRY_AFTER_SECONDS = 5
+
+# Gap between the messages sent while streaming the events of a job that hasn't changed
+JOB_EVENT_KEEPALIVE_SECONDS = 15
+
+# Responses smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+# Brotli is optional, responses are only gzip compressed when it is not installed
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None
+
+CONTENT_TYPES = {
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".html": "text/html; charset=utf-8",
+    ".json": "application/json",
+    ".geojson": "application/geo+json",
+    ".csv": "text/csv; charset=utf-8",
+    ".mvt": "application/vnd.mapbox-vector-tile",
+    ".fgb": "application/octet-stream",
+    ".parquet": "application/vnd.apache.parquet",
+}
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/geo+json",
+    "application/vnd.mapbox-vector-tile",
+    "image/svg+xml",
+)
+
+# Built assets have a content hash in their name so never change, everything else is revalidated with its ETag
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def content_type(filePath: Path) -> str:
+    suffix = filePath.suffix.lower()
+    if suffix in CONTENT_TYPES:
+        return CONTENT_TYPES[suffix]
+    guessed, _ = mimetypes.guess_type(filePath.name)
+    return guessed or "application/octet-stream"
+
+
+@dataclass
+class Response:
+    """
+    A response body held in memory along with its precompressed variants, keyed by content encoding
+    """
+
+    body: bytes
+    contentType: str
+    etag: str
+    encodings: dict[str, bytes] = field(default_factory=dict)
+
+    @classmethod
+    def build(
+        cls, body: bytes, contentType: str, gzipBody: Optional[bytes] = None
+    ) -> "Response":
+        """
+        Builds a response, compressing the body with gzip and brotli when it is a compressible type
+
+        :param bytes body: The uncompressed body
+        :param str contentType: The MIME type of the body
+        :param bytes gzipBody: An already gzipped copy of the body, such as a .gz file, used rather than compressing again
+        """
+        response = cls(body, contentType, hashlib.sha1(body).hexdigest())
+        if gzipBody is not None:
+            response.encodings["gzip"] = gzipBody
+        if len(body) < MIN_COMPRESS_BYTES or not contentType.startswith(
+            COMPRESSIBLE_TYPES
+        ):
+            return response
+
+        if "gzip" not in response.encodings:
+            response.encodings["gzip"] = gzip.compress(body, compresslevel=6, mtime=0)
+        if HAS_BROTLI:
+            import brotli
+
+            response.encodings["br"] = brotli.compress(body, quality=5)
+        return response
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encodings.values())
+
+
+class ResponseCache:
+    """
+    LRU cache of responses bounded by their total size. Responses built from files are rebuilt when the file changes.
+    Shared by every request handler thread.
+    """
+
+    def __init__(self, maxSizeMb: float = DEFAULT_MEMORY_CACHE_MB):
+        self.maxSize = maxSizeMb * 1e6
+        self.entries: OrderedDict[str, tuple[object, Response]] = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(
+        self, key: str, build: Callable[[], Response], version: object = None
+    ) -> Response:
+        """
+        Gets a response from the cache, building it if it's missing or was built from an older version of its source
+
+        :param str key: The cache key, usually the request path
+        :param build: Builds the response when it isn't cached
+        :param version: Identifies the version of the source, such as a file's mtime and size
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        response = build()
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1].size
+            if response.size <= self.maxSize:
+                self.entries[key] = (version, response)
+                self.size += response.size
+            while self.size > self.maxSize:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted.size
+        return response
+
+
+def file_version(filePath: Path) -> tuple[int, int]:
+    stat = filePath.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def parse_range(rangeHeader: str, length: int) -> Optional[tuple[int, int]]:
+    """
+    Parses a single byte range request header
+
+    :param str rangeHeader: The value of the Range header, eg bytes=0-499
+    :param int length: The length of the full body
+    :return (int, int): The first and last byte of the range, inclusive, or None if the range can't be satisfied
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", rangeHeader.strip())
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # A suffix range, the last n bytes
+        start = max(length - int(match.group(2)), 0)
+        end = length - 1
+    else:
+        start = int(match.group(1))
+        end = (
+            length - 1 if match.group(2) == "" else min(int(match.group(2)), length - 1)
+        )
+    if start >= length or start > end:
+        return None
+    return start, end
+
+
+class ResponseHandler(SimpleHTTPRequestHandler, ABC):
+    """
+    Base for the request handlers, sends responses held in memory with support for conditional, range and
+    compressed requests. Subclasses dispatch GET and HEAD requests in route.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, *args, **kwargs):
+        self.sendBody = True
         super().__init__(*args, **kwargs)
 
+    def do_HEAD(self) -> None:
+        self.sendBody = False
+        self.route()
+
     def do_GET(self) -> None:
-        if self.path == "/":
-            self.handle_index()
-            return
+        self.sendBody = True
+        self.route()
+
+    @abstractmethod
+    def route(self):
+        """
+        Answers the current GET or HEAD request
+        """
 
-        if re.search("/data/*", self.path):
-            self.handle_data_request()
+    def send_json(
+        self,
+        contents: dict,
+        status: int = 200,
+        headers: Optional[dict[str, str]] = None,
+    ):
+        self.send_cached_response(
+            Response.build(bytes(json.dumps(contents), "utf8"), CONTENT_TYPES[".json"]),
+            REVALIDATE_CACHE_CONTROL,
+            status,
+            headers,
+        )
+
+    def send_cached_response(
+        self,
+        response: Response,
+        cacheControl: str,
+        status: int = 200,
+        headers: Optional[dict[str, str]] = None,
+    ):
+        """
+        Sends a response held in memory, honouring If-None-Match, Range and Accept-Encoding
+        """
+        rangeHeader = self.headers.get("Range")
+        # Ranges are always of the uncompressed body
+        encoding = (
+            None if rangeHeader is not None else self.negotiate_encoding(response)
+        )
+        etag = f'"{response.etag}{"-" + encoding if encoding else ""}"'
+        if status == 200 and self.not_modified(etag):
+            self.send_not_modified(etag, cacheControl)
             return
 
-        self.try_handle_viz_code_request()
+        body = response.encodings[encoding] if encoding else response.body
+        start, end = 0, len(body) - 1
+        if status == 200 and rangeHeader is not None:
+            byteRange = parse_range(rangeHeader, len(body))
+            if byteRange is None:
+                self.send_range_not_satisfiable(len(body))
+                return
+            start, end = byteRange
+            status = 206
 
-    def handle_404(self):
-        self.send_response(404)
-        self.send_header("Content-type", "text/html")
+        self.send_response(status)
+        self.send_header("Content-Type", response.contentType)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_caching_headers(etag, cacheControl)
         self.end_headers()
-        response = f"<html><head></head><body>Page not found</body></html>"
-        self.wfile.write(bytes(response, "utf8"))
+        if self.sendBody:
+            self.wfile.write(body[start : end + 1] if status == 206 else body)
 
-    def handle_data_request(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+    def negotiate_encoding(self, response: Response) -> Optional[str]:
+        accepted = [
+            part.split(";")[0].strip()
+            for part in self.headers.get("Accept-Encoding", "").split(",")
+        ]
+        for encoding in ["br", "gzip"]:
+            if encoding in accepted and encoding in response.encodings:
+                return encoding
+        return None
+
+    def not_modified(self, etag: str) -> bool:
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch is None:
+            return False
+        return ifNoneMatch.strip() == "*" or etag in [
+            tag.strip() for tag in ifNoneMatch.split(",")
+        ]
+
+    def send_not_modified(self, etag: str, cacheControl: str):
+        self.send_response(304)
+        self.send_caching_headers(etag, cacheControl)
         self.end_headers()
-        filePath = self.runDir / self.path.replace("/data/", "")
-        with open(filePath, "r") as file:
-            contents = file.read()
-            self.wfile.write(bytes(contents, "utf8"))
 
-    def handle_index(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
+    def send_range_not_satisfiable(self, length: int):
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{length}")
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        with open(VIZ_DIR / "index.html", "rb") as file:
-            self.wfile.write(file.read())
-
-    def try_handle_viz_code_request(self):
-        filePath = VIZ_DIR / Path(self.path[1:])
-        if filePath.exists():
-            self.send_response(200)
-            match filePath.suffix:
-                case ".js":
-                    self.send_header("Content-type", "application/javascript")
-                case ".html":
-                    self.send_header("Content-type", "text/html")
-                case ".css":
-                    self.send_header("Content-type", "text/css")
-                case _:
-                    self.send_header("Content-type", "text/html")
-
-            self.end_headers()
-            with open(filePath, "rb") as file:
-                self.wfile.write(file.read())
 
+    def send_caching_headers(self, etag: str, cacheControl: str):
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cacheControl)
+        self.send_header("Vary", "Accept-Encoding")
+
+
+class MeetupVizHTTPRequestHandler(ResponseHandler):
+    def __init__(
+        self,
+        runName: str,
+        tiles: RunTiles,
+        runIndex: RunIndex,
+        responseCache: ResponseCache,
+        *args,
+        **kwargs,
+    ):
+        self.runDir = Path(runName)
+        self.tiles = tiles
+        self.runIndex = runIndex
+        self.responseCache = responseCache
+        super().__init__(*args, **kwargs)
+
+    def route(self):
+        url = urlsplit(self.path)
+        path = url.path
+
+        if path == "/":
+            self.send_file(VIZ_DIR / "index.html", REVALIDATE_CACHE_CONTROL)
+            return
+
+        if path.startswith("/tiles/"):
+            self.handle_tile_request(path)
+            return
+
+        if path.startswith("/data/"):
+            self.handle_data_request(path)
+            return
+
+        if path.startswith("/api/"):
+            self.handle_api_request(path, parse_qs(url.query))
+            return
+
+        self.try_handle_viz_code_request(path)
+
+    def handle_404(self):
+        self.send_cached_response(
+            Response.build(
+                b"<html><head></head><body>Page not found</body></html>",
+                CONTENT_TYPES[".html"],
+            ),
+            REVALIDATE_CACHE_CONTROL,
+            status=404,
+        )
+
+    def handle_tile_request(self, path: str):
+        if path == "/tiles/tiles.json":
+            response = self.responseCache.get(
+                path,
+                lambda: Response.build(
+                    bytes(json.dumps(self.tiles.metadata()), "utf8"),
+                    CONTENT_TYPES[".json"],
+                ),
+            )
+            self.send_cached_response(response, REVALIDATE_CACHE_CONTROL)
+            return
+
+        match = re.fullmatch(r"/tiles/(\d+)/(\d+)/(\d+)\.mvt", path)
+        tile = None if match is None else self.tiles.tile(*map(int, match.groups()))
+        if tile is None:
+            self.handle_404()
+            return
+        # The response keeps the tile along with its compressed copies, so cached tiles count against the response
+        # cache's budget as well as being held in the tile cache
+        response = self.responseCache.get(
+            path, lambda: Response.build(tile, CONTENT_TYPES[".mvt"])
+        )
+        self.send_cached_response(response, REVALIDATE_CACHE_CONTROL)
+
+    def handle_api_request(self, path: str, query: dict[str, list[str]]):
+        if path == "/api/groups":
+            bbox = None
+            if "bbox" in query:
+                try:
+                    bbox = tuple(float(value) for value in query["bbox"][0].split(","))
+                except ValueError:
+                    bbox = ()
+                if len(bbox) != 4:
+                    self.send_json(
+                        {"error": "bbox should be minLng,minLat,maxLng,maxLat"}, 400
+                    )
+                    return
+            self.send_json({"groups": self.runIndex.groups(bbox)})
+            return
+
+        match = re.fullmatch(r"/api/(groups|users)/([^/]+)", path)
+        if match is None:
+            self.send_json({"error": "Unknown endpoint"}, 404)
+            return
+
+        kind, itemId = match.group(1), unquote(match.group(2))
+        if kind == "groups":
+            result = (
+                self.runIndex.group(int(itemId))
+                if re.fullmatch(r"-?\d+", itemId)
+                else None
+            )
         else:
+            result = self.runIndex.user(itemId)
+        if result is None:
+            self.send_json({"error": f"No {kind[:-1]} {itemId}"}, 404)
+            return
+        self.send_json(result)
+
+    def handle_data_request(self, path: str):
+        filePath = self.resolve(self.runDir, path.removeprefix("/data/"))
+        if filePath is None:
+            self.handle_404()
+            return
+        if filePath.is_file():
+            self.send_file(filePath, REVALIDATE_CACHE_CONTROL)
+            return
+        if filePath.suffix != ".geojson":
+            self.handle_404()
+            return
+
+        # The run may have been exported in another format, serve it as GeoJSON
+        found = find_output(self.runDir, filePath.stem)
+        if found is None:
+            self.handle_404()
+            return
+
+        def build() -> Response:
+            if found[1] == OutputFormat.GEOJSON_GZ:
+                gzipBody = found[0].read_bytes()
+                return Response.build(
+                    gzip.decompress(gzipBody), CONTENT_TYPES[".geojson"], gzipBody
+                )
+            contents = io.StringIO()
+            write_geojson(read_output(self.runDir, filePath.stem), contents)
+            return Response.build(
+                bytes(contents.getvalue(), "utf8"), CONTENT_TYPES[".geojson"]
+            )
+
+        response = self.responseCache.get(path, build, file_version(found[0]))
+        self.send_cached_response(response, REVALIDATE_CACHE_CONTROL)
+
+    def try_handle_viz_code_request(self, path: str):
+        filePath = self.resolve(VIZ_DIR, path.removeprefix("/"))
+        if filePath is None or not filePath.is_file():
             self.handle_404()
+            return
+        cacheControl = (
+            IMMUTABLE_CACHE_CONTROL
+            if filePath.parent.name == "assets"
+            else REVALIDATE_CACHE_CONTROL
+        )
+        self.send_file(filePath, cacheControl)
+
+    @staticmethod
+    def resolve(baseDir: Path, relativePath: str) -> Optional[Path]:
+        """
+        Resolves a requested path inside a directory, None if it points outside of it
+        """
+        baseDir = baseDir.resolve()
+        filePath = (baseDir / relativePath).resolve()
+        if filePath != baseDir and baseDir not in filePath.parents:
+            return None
+        return filePath
+
+    def send_file(self, filePath: Path, cacheControl: str):
+        """
+        Sends a file, from the in memory cache when it's small enough to be held there and from disk otherwise.
+        A .gz file next to it is used as its precompressed gzip variant.
+        """
+        version = file_version(filePath)
+        if version[1] > self.responseCache.maxSize / 4:
+            self.stream_file(filePath, version, cacheControl)
+            return
+
+        def build() -> Response:
+            gzipPath = filePath.with_name(filePath.name + ".gz")
+            gzipBody = gzipPath.read_bytes() if gzipPath.is_file() else None
+            return Response.build(
+                filePath.read_bytes(), content_type(filePath), gzipBody
+            )
 
+        response = self.responseCache.get(str(filePath), build, version)
+        self.send_cached_response(response, cacheControl)
 
-class MyServer(socketserver.TCPServer):
+    def stream_file(self, filePath: Path, version: tuple[int, int], cacheControl: str):
+        """
+        Sends a file too big to hold in memory straight from disk, uncompressed but with support for range requests
+        """
+        length = version[1]
+        etag = f'"{version[0]:x}-{length:x}"'
+        if self.not_modified(etag):
+            self.send_not_modified(etag, cacheControl)
+            return
+
+        start, end = 0, length - 1
+        status = 200
+        if self.headers.get("Range") is not None:
+            byteRange = parse_range(self.headers["Range"], length)
+            if byteRange is None:
+                self.send_range_not_satisfiable(length)
+                return
+            start, end = byteRange
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type(filePath))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{length}")
+        self.send_caching_headers(etag, cacheControl)
+        self.end_headers()
+        if not self.sendBody:
+            return
+        with open(filePath, "rb") as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = file.read(min(1 << 20, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class MyServer(ThreadingHTTPServer):
     allow_reuse_address = True
+    daemon_threads = True
+
 
+def create_server(runName: str, port: int = DEFAULT_PORT) -> MyServer:
+    """
+    Creates the visualization server for a run. Each request is handled in its own thread, the tiles, query
+    indexes and in memory response cache are shared between them.
 
-def start_server(runName: str):
-    handler_object = partial(MeetupVizHTTPRequestHandler, runName)
+    :param str runName: The run directory to serve
+    :param int port: The port to listen on, 0 picks a free port
+    """
+    tiles = RunTiles(Path(runName))
+    runIndex = RunIndex(Path(runName))
+    handler_object = partial(
+        MeetupVizHTTPRequestHandler, runName, tiles, runIndex, ResponseCache()
+    )
+    return MyServer(("", port), handler_object)
 
-    PORT = 8000
-    my_server = MyServer(("", PORT), handler_object)
 
+def start_server(runName: str, port: int = DEFAULT_PORT):
+    my_server = create_server(runName, port)
     my_server.serve_forever()
+
+
+class MeetupServiceHTTPRequestHandler(ResponseHandler):
+    """
+    The job API of the service. Jobs are submitted by POSTing users to /api/jobs and their progress polled at
+    /api/jobs/{id}, optionally waiting for them to finish, or streamed as server sent events from
+    /api/jobs/{id}/events. The groups are fetched from /api/jobs/{id}/result.
+    """
+
+    def __init__(self, jobQueue: "JobQueue", *args, **kwargs):
+        self.jobQueue = jobQueue
+        super().__init__(*args, **kwargs)
+
+    def route(self):
+        url = urlsplit(self.path)
+        if url.path == "/api/jobs":
+            self.send_json({"jobs": self.jobQueue.summaries()})
+            return
+
+        match = re.fullmatch(r"/api/jobs/([0-9a-f]+)(/result|/events)?", url.path)
+        job = None if match is None else self.jobQueue.get(match.group(1))
+        if job is None:
+            self.send_json({"error": "No such job"}, 404)
+            return
+
+        if match.group(2) == "/events":
+            self.stream_job_events(job)
+        elif match.group(2) == "/result":
+            if job.result is None:
+                self.send_json({"error": f"The job is {job.status.value}"}, 409)
+                return
+            self.send_json({"id": job.id, "groups": job.result})
+        else:
+            wait = parse_qs(url.query).get("wait", ["0"])[-1]
+            try:
+                wait = min(max(float(wait), 0), MAX_JOB_WAIT_SECONDS)
+            except ValueError:
+                self.send_json({"error": "wait should be a number of seconds"}, 400)
+                return
+            if wait > 0:
+                self.jobQueue.wait_until_finished(job, wait)
+            self.send_json(job.summary())
+
+    def do_POST(self) -> None:
+        from .jobs import parse_job
+
+        self.sendBody = True
+        url = urlsplit(self.path)
+        if url.path != "/api/jobs":
+            self.send_json({"error": "Unknown endpoint"}, 404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_JOB_SIZE_MB * 1e6:
+            # The body is left unread so the connection can't be reused
+            self.close_connection = True
+            self.send_json(
+                {"error": f"Submissions are limited to {MAX_JOB_SIZE_MB}MB"}, 413
+            )
+            return
+        body = self.rfile.read(length)
+
+        try:
+            users, parameters = parse_job(
+                body,
+                self.headers.get("Content-Type", ""),
+                {name: values[-1] for name, values in parse_qs(url.query).items()},
+            )
+        except ValueError as error:
+            self.send_json({"error": str(error)}, 400)
+            return
+
+        job = self.jobQueue.submit(users, parameters)
+        if job is None:
+            self.send_json(
+                {"error": "Too many jobs are queued, try again later"},
+                503,
+                {"Retry-After": str(JOB_RETRY_AFTER_SECONDS)},
+            )
+            return
+        self.send_json(job.summary(), 202, {"Location": f"/api/jobs/{job.id}"})
+
+    def stream_job_events(self, job: "Job"):
+        """
+        Sends the job's state as a server sent event each time its status changes, until it finishes
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        if not self.sendBody:
+            return
+
+        status = None
+        try:
+            while True:
+                if job.status != status:
+                    status = job.status
+                    event = f"event: status\ndata: {json.dumps(job.summary())}\n\n"
+                    self.wfile.write(bytes(event, "utf8"))
+                else:
+                    # A comment keeps proxies from closing an idle connection
+                    self.wfile.write(b": waiting\n\n")
+                self.wfile.flush()
+                if status.finished:
+                    return
+                self.jobQueue.wait_for_change(job, status, JOB_EVENT_KEEPALIVE_SECONDS)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+def create_service(
+    port: int = DEFAULT_PORT,
+    workers: int = DEFAULT_JOB_WORKERS,
+    maxQueued: int = DEFAULT_MAX_QUEUED_JOBS,
+    maxKeptJobs: int = DEFAULT_MAX_KEPT_JOBS,
+) -> tuple[MyServer, "JobQueue"]:
+    """
+    Creates the job service. Requests are handled in their own threads and the jobs are run by the workers of
+    a shared queue.
+
+    :param int port: The port to listen on, 0 picks a free port
+    :param int workers: The number of jobs run at once
+    :param int maxQueued: The number of jobs that can wait for a worker before new ones are turned away
+    :param int maxKeptJobs: The number of finished jobs whose results are kept in memory
+    :return (MyServer, JobQueue): The server and its job queue
+    """
+    # Imported here as it loads the clustering libraries, which the visualization server doesn't need
+    from .jobs import JobQueue
+
+    jobQueue = JobQueue(workers, maxQueued, maxKeptJobs)
+    handler_object = partial(MeetupServiceHTTPRequestHandler, jobQueue)
+    return MyServer(("", port), handler_object), jobQueue
+
+
+def start_service(
+    port: int = DEFAULT_PORT,
+    workers: int = DEFAULT_JOB_WORKERS,
+    maxQueued: int = DEFAULT_MAX_QUEUED_JOBS,
+    maxKeptJobs: int = DEFAULT_MAX_KEPT_JOBS,
+):
+    service, _ = create_service(port, workers, maxQueued, maxKeptJobs)
+    service.serve_forever()
@@ -0,0 +1,359 @@
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+import numpy as np
+import shapely
+from pyproj import Transformer
+from .export import read_output
+
+# Half the width of the web mercator plane in meters
+MERCATOR_HALF_WIDTH = 20037508.342789244
+
+# Resolution of the tile coordinates
+TILE_EXTENT = 4096
+
+# Margin around each tile, in tile coordinates, that clipped geometries extend in to so edges don't show at tile seams
+TILE_BUFFER = 64
+
+# Below this zoom users are thinned to one point per cell of a coarse grid so overview tiles stay small
+USER_DETAIL_ZOOM = 13
+USER_OVERVIEW_CELLS = 512
+
+MIN_ZOOM = 0
+MAX_ZOOM = 16
+
+# Number of encoded tiles kept in memory
+DEFAULT_TILE_CACHE_SIZE = 2048
+
+# The run outputs served as tile layers and the properties carried by their features
+TILE_LAYERS = {
+    "usersAssignments": ["label", "user_id"],
+    "groupRegions": ["label"],
+    "groupMeetingPoints": ["label"],
+}
+
+# Mapbox vector tile geometry types and commands
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _field(number: int, wireType: int) -> bytes:
+    return _varint((number << 3) | wireType)
+
+
+def _length_delimited(number: int, payload: bytes) -> bytes:
+    return _field(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number: int, values) -> bytes:
+    return _length_delimited(number, b"".join(_varint(int(value)) for value in values))
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    return (values << 1) ^ (values >> 63)
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def encode_geometry(geometry, cursor: np.ndarray) -> tuple[int, list[int]]:
+    """
+    Encodes a geometry already in integer tile coordinates as vector tile commands
+
+    :param geometry: A shapely geometry in tile coordinates
+    :param ndarray cursor: The current cursor position, updated in place
+    :return (int, [int]): The vector tile geometry type and command integers, or (0, []) for empty geometries
+    """
+    commands = []
+
+    def add_path(coords: np.ndarray, command: int, closed: bool):
+        deltas = np.diff(np.vstack([cursor, coords]), axis=0).astype(np.int64)
+        cursor[:] = coords[-1]
+        zigzagged = _zigzag(deltas)
+        commands.append(_command(MOVE_TO, 1))
+        commands.extend(zigzagged[0].tolist())
+        if coords.shape[0] > 1:
+            commands.append(_command(command, coords.shape[0] - 1))
+            commands.extend(zigzagged[1:].ravel().tolist())
+        if closed:
+            commands.append(_command(CLOSE_PATH, 1))
+
+    parts = getattr(geometry, "geoms", [geometry])
+    geometryType = shapely.get_type_id(geometry)
+    if geometryType in (0, 4):
+        points = shapely.get_coordinates(geometry).astype(np.int64)
+        if points.shape[0] == 0:
+            return 0, []
+        deltas = np.diff(np.vstack([cursor, points]), axis=0)
+        cursor[:] = points[-1]
+        return (
+            GEOM_POINT,
+            [_command(MOVE_TO, points.shape[0])] + _zigzag(deltas).ravel().tolist(),
+        )
+
+    if geometryType in (1, 5):
+        for line in parts:
+            coords = _dedupe_consecutive(shapely.get_coordinates(line))
+            if coords.shape[0] >= 2:
+                add_path(coords, LINE_TO, False)
+        return (GEOM_LINESTRING, commands) if commands else (0, [])
+
+    if geometryType in (3, 6):
+        for polygon in parts:
+            rings = [polygon.exterior] + list(polygon.interiors)
+            for ringIndex, ring in enumerate(rings):
+                coords = _dedupe_consecutive(shapely.get_coordinates(ring)[:-1])
+                if coords.shape[0] < 3:
+                    if ringIndex == 0:
+                        break
+                    continue
+                # Exterior rings are clockwise in tile coordinates (y down), which is positive area, interiors the opposite
+                clockwise = _signed_area(coords) > 0
+                if clockwise != (ringIndex == 0):
+                    coords = coords[::-1]
+                add_path(coords, LINE_TO, True)
+        return (GEOM_POLYGON, commands) if commands else (0, [])
+
+    return 0, []
+
+
+def _dedupe_consecutive(coords: np.ndarray) -> np.ndarray:
+    coords = coords.astype(np.int64)
+    if coords.shape[0] < 2:
+        return coords
+    keep = np.ones(coords.shape[0], dtype=bool)
+    keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+    return coords[keep]
+
+
+def _signed_area(coords: np.ndarray) -> float:
+    x, y = coords[:, 0], coords[:, 1]
+    return float(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)) / 2
+
+
+def _encode_value(value) -> bytes:
+    if isinstance(value, (bool, np.bool_)):
+        return _field(7, 0) + _varint(int(value))
+    if isinstance(value, (int, np.integer)):
+        if value >= 0:
+            return _field(5, 0) + _varint(int(value))
+        return _field(6, 0) + _varint(int(_zigzag(np.int64(value))))
+    if isinstance(value, (float, np.floating)):
+        return _field(3, 1) + np.float64(value).tobytes()
+    return _length_delimited(1, str(value).encode("utf8"))
+
+
+def encode_layer(
+    name: str, geometries, properties: dict[str, np.ndarray], extent: int
+) -> bytes:
+    """
+    Encodes a layer of a vector tile
+
+    :param str name: The layer name
+    :param geometries: The geometries of the features in integer tile coordinates
+    :param dict properties: Arrays of the property values of each feature, keyed by property name
+    :param int extent: The tile extent
+    :return bytes: The encoded layer, or empty bytes if no feature has a geometry in the tile
+    """
+    keys = list(properties)
+    values = []
+    valueIndex = {}
+    features = []
+    for featureIndex, geometry in enumerate(geometries):
+        geometryType, commands = encode_geometry(geometry, np.zeros(2, dtype=np.int64))
+        if geometryType == 0:
+            continue
+        tags = []
+        for keyIndex, key in enumerate(keys):
+            value = properties[key][featureIndex]
+            valueKey = (type(value).__name__, value)
+            if valueKey not in valueIndex:
+                valueIndex[valueKey] = len(values)
+                values.append(value)
+            tags.extend([keyIndex, valueIndex[valueKey]])
+        features.append(
+            _packed(2, tags)
+            + _field(3, 0)
+            + _varint(geometryType)
+            + _packed(4, commands)
+        )
+
+    if not features:
+        return b""
+    return (
+        _field(15, 0)
+        + _varint(2)
+        + _length_delimited(1, name.encode("utf8"))
+        + b"".join(_length_delimited(2, feature) for feature in features)
+        + b"".join(_length_delimited(3, key.encode("utf8")) for key in keys)
+        + b"".join(_length_delimited(4, _encode_value(value)) for value in values)
+        + _field(5, 0)
+        + _varint(extent)
+    )
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    The bounds of a tile in web mercator meters
+    """
+    size = 2 * MERCATOR_HALF_WIDTH / 2**z
+    minX = -MERCATOR_HALF_WIDTH + x * size
+    maxY = MERCATOR_HALF_WIDTH - y * size
+    return minX, maxY - size, minX + size, maxY
+
+
+class RunTiles:
+    """
+    Generates Mapbox Vector Tiles from the outputs of a run. The layers are loaded and projected to web mercator
+    once, on the first request, and each tile is built when it is first requested and then kept in an LRU cache.
+    """
+
+    def __init__(self, runDir: Path, cacheSize: int = DEFAULT_TILE_CACHE_SIZE):
+        self.runDir = Path(runDir)
+        self.cacheSize = cacheSize
+        self.layers = None
+        self.cache: OrderedDict[tuple[int, int, int], bytes] = OrderedDict()
+        self.lock = Lock()
+
+    def _load(self):
+        with self.lock:
+            if self.layers is not None:
+                return
+            transformer = Transformer.from_crs("epsg:4326", "epsg:3857", always_xy=True)
+
+            def project(coords: np.ndarray) -> np.ndarray:
+                return np.stack(
+                    transformer.transform(coords[:, 0], coords[:, 1]), axis=1
+                )
+
+            layers = {}
+            for name, columns in TILE_LAYERS.items():
+                df = read_output(self.runDir, name).to_crs("epsg:4326")
+                geometries = shapely.transform(np.asarray(df.geometry.values), project)
+                layers[name] = (
+                    geometries,
+                    shapely.STRtree(geometries),
+                    {
+                        column: df[column].to_numpy()
+                        for column in columns
+                        if column in df.columns
+                    },
+                )
+            self.layers = layers
+
+    def metadata(self) -> dict:
+        """
+        TileJSON describing the tiles, along with the size of each group so the viewer doesn't need every user
+        """
+        self._load()
+        users = self.layers["usersAssignments"]
+        bounds = shapely.total_bounds(users[0])
+        transformer = Transformer.from_crs("epsg:3857", "epsg:4326", always_xy=True)
+        west, south = transformer.transform(bounds[0], bounds[1])
+        east, north = transformer.transform(bounds[2], bounds[3])
+        labels, counts = np.unique(users[2]["label"], return_counts=True)
+        return {
+            "tilejson": "3.0.0",
+            "tiles": ["/tiles/{z}/{x}/{y}.mvt"],
+            "minzoom": MIN_ZOOM,
+            "maxzoom": MAX_ZOOM,
+            "bounds": [west, south, east, north],
+            "vector_layers": [
+                {"id": name, "fields": {column: "" for column in columns}}
+                for name, columns in TILE_LAYERS.items()
+            ],
+            "groupSizes": {
+                str(label): int(count) for label, count in zip(labels, counts)
+            },
+        }
+
+    def tile(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """
+        Gets an encoded tile, building it if it is not already cached
+
+        :return bytes: The tile or None if the tile address is invalid
+        """
+        if z < 0 or z > 24 or not (0 <= x < 2**z and 0 <= y < 2**z):
+            return None
+        key = (z, x, y)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        self._load()
+        encoded = self._build_tile(z, x, y)
+        with self.lock:
+            self.cache[key] = encoded
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return encoded
+
+    def _build_tile(self, z: int, x: int, y: int) -> bytes:
+        minX, minY, maxX, maxY = tile_bounds(z, x, y)
+        scale = TILE_EXTENT / (maxX - minX)
+        buffer = TILE_BUFFER / scale
+        clipBounds = (minX - buffer, minY - buffer, maxX + buffer, maxY + buffer)
+
+        def to_tile(coords: np.ndarray) -> np.ndarray:
+            return np.round(
+                np.stack(
+                    [(coords[:, 0] - minX) * scale, (maxY - coords[:, 1]) * scale],
+                    axis=1,
+                )
+            )
+
+        encodedLayers = []
+        for name, (geometries, tree, properties) in self.layers.items():
+            indexes = np.sort(tree.query(shapely.box(*clipBounds)))
+            if indexes.shape[0] == 0:
+                continue
+            tileGeometries = shapely.clip_by_rect(geometries[indexes], *clipBounds)
+            # Points on the edge of the clip bounds are matched by the tree but clipped to empty geometries
+            notEmpty = ~shapely.is_empty(tileGeometries)
+            indexes = indexes[notEmpty]
+            if indexes.shape[0] == 0:
+                continue
+            tileGeometries = shapely.transform(tileGeometries[notEmpty], to_tile)
+            tileProperties = {
+                key: values[indexes] for key, values in properties.items()
+            }
+
+            if name == "usersAssignments" and z < USER_DETAIL_ZOOM:
+                # Keep one user per cell of a coarse grid, overview tiles only need to show where users are
+                cellSize = TILE_EXTENT / USER_OVERVIEW_CELLS
+                cells = np.floor(shapely.get_coordinates(tileGeometries) / cellSize)
+                _, first = np.unique(cells, axis=0, return_index=True)
+                first = np.sort(first)
+                tileGeometries = tileGeometries[first]
+                tileProperties = {
+                    key: values[first] for key, values in tileProperties.items()
+                }
+
+            encodedLayers.append(
+                _length_delimited(
+                    3, encode_layer(name, tileGeometries, tileProperties, TILE_EXTENT)
+                )
+                if len(tileGeometries) > 0
+                else b""
+            )
+        return b"".join(layer for layer in encodedLayers if len(layer) > 2)
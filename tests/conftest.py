@@ -0,0 +1,12 @@
+from meetup.caching import RunCache
+from tests.helpers import use_cache_dir
+import pytest
+
+
+@pytest.fixture
+def tmp_cache(tmp_path, monkeypatch):
+    # Records the shared cache locations so they are put back after the test
+    for name in ["baseDir", "entriesDir", "runName", "runDir"]:
+        monkeypatch.setattr(RunCache, name, getattr(RunCache, name, None), raising=False)
+    use_cache_dir(tmp_path, "test")
+    return tmp_path
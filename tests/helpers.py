@@ -1,6 +1,8 @@
 import math 
 import geopandas as gp
+from pathlib import Path
 from sklearn.datasets import make_blobs
+from meetup.caching import RunCache
 
 def circle_cluster(centerX:float, centerY:float, radius:float, points:int, label:int):
     radi = [ 2.0*math.pi*i/points for i in  range(points)]
@@ -20,5 +22,14 @@ def blob_cluster(centerX:float, centerY:float, points:int, stdDev:float,label:in
     points, _ = make_blobs(n_samples=points, n_features=2,centers=[[centerX,centerY]], cluster_std=stdDev)
     geometry = gp.points_from_xy(points[:,0], points[:,1])
 
-    return gp.GeoDataFrame( geometry=geometry, crs="epsg:4326").assign(label=label) 
+    return gp.GeoDataFrame( geometry=geometry, crs="epsg:4326").assign(label=label)
 
+
+def use_cache_dir(cacheDir:Path, runName:str):
+    """
+    Points the run cache at an empty directory so nothing is read from or left in the shared cache
+    """
+    RunCache.baseDir = cacheDir
+    RunCache.entriesDir = cacheDir / "entries"
+    RunCache.runName = None
+    RunCache.set_run_name(runName)
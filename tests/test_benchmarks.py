@@ -0,0 +1,11 @@
+from benchmarks.pipeline import synthetic_city
+from numpy.testing import assert_equal
+
+
+def test_synthetic_city():
+    users = synthetic_city(5000)
+
+    assert_equal(users.shape[0], 5000)
+    assert_equal(users.user_id.nunique(), 5000, "User ids should be unique")
+    assert users.latitude.between(51.5, 53.5).all() and users.longitude.between(12.4, 14.4).all(), "Users should be around Berlin"
+    assert_equal(synthetic_city(5000).to_numpy(), users.to_numpy(), "Should be reproducible")
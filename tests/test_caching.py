@@ -0,0 +1,51 @@
+from meetup.caching import Cache
+from numpy.testing import assert_equal
+from geopandas.testing import assert_geodataframe_equal
+from .helpers import square_cluster
+import os
+
+
+def test_cache_keys():
+    group1 = square_cluster(10, 10, 10, 0)
+    group2 = square_cluster(10, 10, 20, 0)
+
+    assert_equal(Cache.key("a", 1, None), Cache.key("a", 1, None), "Keys should be deterministic")
+    assert Cache.key("a", 1) != Cache.key("a", 2), "Different parameters should give different keys"
+    assert_equal(Cache.frame_key(group1), Cache.frame_key(group1.copy()), "Frame keys should only depend on the contents")
+    assert Cache.frame_key(group1) != Cache.frame_key(group2), "Different geometries should give different keys"
+    assert Cache.frame_key(group1) != Cache.frame_key(group1.assign(label=1)), "Different attributes should give different keys"
+
+
+def test_cache_prune_and_clear(tmp_path):
+    cache = Cache(str(tmp_path / "cache"))
+    cache.set_run_name("run1")
+    cache.cache_geo_data_frame("inital_clusters", "old", square_cluster(10, 10, 10, 0))
+    cache.cache_geo_data_frame("inital_clusters", "new", square_cluster(10, 10, 20, 0))
+    cache.set_run_name("run2")
+    cache.cache_geo_data_frame("refined_clusters", "shared", square_cluster(10, 10, 30, 0))
+
+    # Make the first entry look like it was last used 60 days ago
+    oldEntry = next((tmp_path / "cache" / "entries" / "inital_clusters").glob("old.*"))
+    os.utime(oldEntry, (oldEntry.stat().st_atime - 60 * 86400, oldEntry.stat().st_mtime - 60 * 86400))
+    evicted, _ = cache.prune(maxAgeDays=30)
+
+    assert_equal(evicted, 1, "Only the old entry should be evicted")
+    assert cache.get_cached_geo_data_frame("inital_clusters", "old") is None, "Old entry should be gone"
+    assert cache.get_cached_geo_data_frame("inital_clusters", "new") is not None, "New entry should be kept"
+
+    # run2 has now used the "new" entry as well so clearing run1 should keep it
+    cache.set_run_name("run1")
+    cache.clear_cache()
+    cache.set_run_name("run2")
+    assert cache.get_cached_geo_data_frame("inital_clusters", "new") is not None, "Entries used by other runs should be kept"
+    assert_equal(cache.stats().entries.sum(), 2, "Should have two entries left")
+
+
+def test_cache_round_trip(tmp_path):
+    cache = Cache(str(tmp_path / "cache"))
+    cache.set_run_name("run")
+    clusters = square_cluster(10, 10, 10, 3).to_crs("epsg:32633").assign(user_id=["a", "b", "c", "d"])
+    cache.cache_geo_data_frame("inital_clusters", "key", clusters)
+
+    assert_geodataframe_equal(cache.get_cached_geo_data_frame("inital_clusters", "key"), clusters, check_less_precise=True)
+
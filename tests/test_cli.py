@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+HEAVY_MODULES = ["geopandas", "pandas", "sklearn", "osmnx", "networkx", "shapely", "scipy"]
+
+# Importing the CLI took around 1.4s when it loaded everything up front and takes under 0.1s without
+IMPORT_BUDGET_SECONDS = 0.5
+
+
+def import_times(module: str, cwd: Path) -> dict[str, int]:
+    """Imports a module in a fresh interpreter under -X importtime and returns the cumulative microseconds of each module imported"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, capture_output=True, text=True, env={**os.environ, "PYTHONPATH": str(ROOT)}, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_starts_without_heavy_imports(tmp_path):
+    times = import_times("meetup.cli", tmp_path)
+
+    for module in HEAVY_MODULES:
+        assert module not in times, f"Importing the CLI should not import {module}"
+    assert times["meetup.cli"] / 1e6 < IMPORT_BUDGET_SECONDS, f"Importing the CLI took {times['meetup.cli'] / 1e6:.2f}s"
+    assert not (tmp_path / ".data_cache").exists(), "Importing the CLI should not create the cache folder"
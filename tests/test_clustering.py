@@ -1,8 +1,12 @@
-from meetup.clustering import split_clusters, merge_clusters
+from meetup.clustering import NetworkKMeans, run_clustering, split_clusters, merge_clusters, balance_clusters, update_clusters, cluster, initial_clustering_algorithm, InitialClusteringMethod, format_results, write_mailing_list, MailingListFormat
 from numpy.testing import assert_equal
 from .helpers import blob_cluster
 import pandas as pd 
 import geopandas as gp
+import numpy as np
+import meetup.clustering
+from meetup.geo import network_knn_graph
+from meetup.network import CompactNetwork
 
 def test_split_clusters():
     cluster1 = blob_cluster(10, 10 ,10,0.02, 0)
@@ -13,6 +17,16 @@ def test_split_clusters():
     assert_equal(splitClusters.label.max(), 2, "Should have 3 clusters after spliting")
     assert_equal(splitClusters[splitClusters.label== 0].shape[0], 10, "Cluster 0 should remain intact" )
 
+def test_split_clusters_honours_max_occupancy():
+    cluster1 = blob_cluster(10, 10 ,30,0.02, 0)
+    cluster2 = blob_cluster(20, 20 ,15,0.02, 1)
+    allClusters = gp.GeoDataFrame(pd.concat([cluster1, cluster2]))
+    splitClusters = split_clusters(allClusters, 20, workers=2)
+
+    assert_equal(splitClusters.label.nunique(), 3, "Cluster 0 should be split in two")
+    assert_equal(splitClusters.iloc[30:].label.nunique(), 1, "Cluster 1 should remain intact" )
+    assert_equal(splitClusters.iloc[:30].label.nunique(), 2, "Cluster 0 should be split in two" )
+
 def test_merge_clusters():
     cluster3 = blob_cluster(15, 10 ,200,0.02, 0)
     cluster1 = blob_cluster(10, 10 ,10,0.02, 1)
@@ -27,5 +41,159 @@ def test_merge_clusters():
     assert_equal(splitClusters[splitClusters.label== 2].shape[0], 50, "Cluster 1 should have been absorbed in to cluster 2" )
     assert_equal(splitClusters[splitClusters.label== 1].shape[0], 0, "Cluster 1 should have been absorbed in to cluster 2" )
 
+def test_weighted_split_and_merge():
+    # Points standing for several users, as produced by aggregating users in to cells
+    heavy = gp.GeoDataFrame({"label": [0, 0], "weight": [30, 30]}, geometry=gp.points_from_xy([10, 10.01], [10, 10]), crs="epsg:4326")
+    light = gp.GeoDataFrame({"label": [1], "weight": [5]}, geometry=gp.points_from_xy([20], [20]), crs="epsg:4326")
+    few = gp.GeoDataFrame({"label": [2, 2, 2], "weight": [10, 10, 10]}, geometry=gp.points_from_xy([20.01, 20.02, 20.03], [20, 20, 20]), crs="epsg:4326")
+    allClusters = gp.GeoDataFrame(pd.concat([heavy, light, few], ignore_index=True))
+
+    splitClusters = split_clusters(allClusters, 40)
+    assert_equal(splitClusters.label.nunique(), 4, "Cluster 0 stands for 60 users so should be split in two")
+    assert_equal(splitClusters.iloc[:2].label.nunique(), 2, "Cluster 0 should be split in two")
+
+    mergedClusters = merge_clusters(allClusters, 10)
+    assert_equal(mergedClusters.iloc[3:].label.nunique(), 1, "Cluster 2 stands for 30 users so should be kept")
+    assert_equal(mergedClusters.label.tolist(), [0, 0, 2, 2, 2, 2], "Cluster 1 stands for 5 users so should be merged")
+
+
+def test_aggregated_run_clustering(tmp_cache):
+    # Users stacked on a few shared locations, as in an export of tour start points
+    x = np.repeat(np.arange(20) * 200 + 390000.0, 15)
+    y = np.repeat(np.arange(20) % 4 * 200 + 5820000.0, 15)
+    users = gp.GeoDataFrame({"user_id": np.arange(300)}, geometry=gp.points_from_xy(x, y), crs="epsg:32633")
+
+    clusters = run_clustering(users, 10, 40, 10, aggregateResolution=50)
+    sizes = clusters.label.value_counts()
+    assert_equal(clusters.shape[0], 300, "Every user should get a label")
+    assert_equal(clusters.user_id.tolist(), list(range(300)), "Users should keep their order")
+    assert sizes.min() >= 10 and sizes.max() <= 40, "Groups should be within the occupancy bounds"
+    assert "weight" not in clusters.columns
+
+
+def test_aggregated_stacked_users(tmp_cache):
+    # 1000 users on 5 locations make fewer cells than the number of groups aimed for
+    x = np.repeat(np.arange(5) * 1000 + 390000.0, 200)
+    y = np.full(1000, 5820000.0)
+    users = gp.GeoDataFrame({"user_id": np.arange(1000)}, geometry=gp.points_from_xy(x, y), crs="epsg:32633")
+
+    clusters = run_clustering(users, None, 200, 10, aggregateResolution=50)
+    assert_equal(clusters.shape[0], 1000, "Every user should get a label")
+    assert clusters.label.value_counts().max() <= 200, "Groups should be under the max occupancy"
+
+
+def test_kmeans_initial_clustering():
+    cluster1 = blob_cluster(10, 10 ,100,0.02, 0)
+    cluster2 = blob_cluster(20, 20 ,100,0.02, 0)
+    allClusters = gp.GeoDataFrame(pd.concat([cluster1, cluster2]))
+    algorithm = initial_clustering_algorithm(InitialClusteringMethod.KMEANS, allClusters.shape[0], 10, 30)
+    initialClusters = cluster(algorithm, allClusters)
+
+    assert_equal(initialClusters.label.nunique(), 10, "Should aim for groups in the middle of the occupancy range")
+    assert_equal(initialClusters.shape[0], 200, "Every user should be assigned a group")
+
+def test_balance_clusters():
+    cluster1 = blob_cluster(10, 10 ,5,0.02, 0)
+    cluster2 = blob_cluster(10, 15 ,90,0.02, 1)
+    cluster3 = blob_cluster(15, 10 ,25,0.02, 2)
+    allClusters = gp.GeoDataFrame(pd.concat([cluster1, cluster2, cluster3]))
+    balancedClusters = balance_clusters(allClusters, 10, 20)
+    clusterCounts = balancedClusters.label.value_counts()
+
+    assert (clusterCounts >= 10).all(), "Every cluster should be over the min occupancy"
+    assert (clusterCounts <= 20).all(), "Every cluster should be under the max occupancy"
+    assert_equal(balancedClusters.shape[0], 120, "Every user should be assigned a group")
+
+def test_update_clusters():
+    cluster1 = blob_cluster(10, 10 ,20,0.02, 0)
+    cluster2 = blob_cluster(20, 20 ,20,0.02, 1)
+    previousRun = gp.GeoDataFrame(pd.concat([cluster1, cluster2]).assign(user_id=[f"user{i}" for i in range(40)]))
+    # Drop the first 5 users and add a new user close to the second cluster
+    newUser = blob_cluster(20, 20, 1, 0.02, -1).assign(user_id="newUser")
+    users = gp.GeoDataFrame(pd.concat([previousRun.iloc[5:], newUser]).drop("label", axis=1))
+    updatedClusters = update_clusters(users, previousRun, 10, 40, 10)
+
+    assert_equal(updatedClusters.shape[0], 36, "Departed users should be removed")
+    assert_equal(updatedClusters[updatedClusters.user_id == "newUser"].label.iloc[0], 1, "New user should join the nearest group")
+    assert_equal(updatedClusters.label.value_counts().to_dict(), {0: 15, 1: 21}, "Existing users should keep their groups")
+
+    # Push the middle of 5 groups over the max occupancy with 30 new users
+    groups = [blob_cluster(10 * i, 10 * i, 20, 0.02, i) for i in range(5)]
+    previousRun = gp.GeoDataFrame(pd.concat(groups).assign(user_id=[f"user{i}" for i in range(100)]))
+    newUsers = blob_cluster(20, 20, 30, 0.02, -1).assign(user_id=[f"newUser{i}" for i in range(30)])
+    users = gp.GeoDataFrame(pd.concat([previousRun, newUsers]).drop("label", axis=1))
+    updatedClusters = update_clusters(users, previousRun, 10, 40, 10)
+    counts = updatedClusters.label.value_counts()
+
+    assert (counts <= 40).all(), "The overfull group should be split"
+    untouched = previousRun.label != 2
+    assert_equal(updatedClusters.iloc[:100][untouched.to_numpy()].label.to_numpy(), previousRun[untouched].label.to_numpy(), "Groups which weren't split should keep their labels")
+    assert_equal(sorted(counts.index), [0, 1, 2, 3, 4, 5], "The largest part of the split group should keep its label and the other a new one")
+
+
+def test_mailing_list():
+    users = gp.GeoDataFrame({"user_id": ["a", "b", "c"], "label": [1, 0, 1]}, geometry=gp.points_from_xy([0, 1, 2], [0, 1, 2]), crs="epsg:4326")
+    meetingPoints = gp.GeoDataFrame({"label": [0, 1]}, geometry=gp.points_from_xy([10, 20], [30, 40]), crs="epsg:4326")
+
+    results = format_results(users, meetingPoints)
+    assert_equal(results.columns.to_list(), ["user_id", "start_point_id", "start_point_latitude", "start_point_longitude", "potential_group_members"])
+    assert_equal(results.start_point_id.to_list(), [1, 0, 1], "Users should keep their order")
+    assert_equal(results.start_point_latitude.to_list(), [40, 30, 40])
+    assert_equal(results.potential_group_members.to_list(), ["a,c", "b", "a,c"])
+
+
+def test_write_mailing_list(tmp_path):
+    users = gp.GeoDataFrame({"user_id": ["a", "b", "c"], "label": [1, 0, 1]}, geometry=gp.points_from_xy([0, 1, 2], [0, 1, 2]), crs="epsg:4326")
+    meetingPoints = gp.GeoDataFrame({"label": [0, 1]}, geometry=gp.points_from_xy([10, 20], [30, 40]), crs="epsg:4326")
+
+    write_mailing_list(users, meetingPoints, tmp_path, MailingListFormat.BOTH, chunkSize=2)
+
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "mailingList.csv"), format_results(users, meetingPoints))
+    groups = pd.read_csv(tmp_path / "groups.csv")
+    assert_equal(groups.member_count.to_list(), [1, 2])
+    userGroups = pd.read_csv(tmp_path / "user_groups.csv")
+    assert_equal(userGroups.start_point_id.to_list(), [1, 0, 1])
+
+
+
+def river_network():
+    """A street along y=0 cut by a river between x=500 and x=550, with the only bridge 1km up the bank"""
+    bottom = [(x, 0) for x in range(0, 1050, 50)]
+    detour = [(500, y) for y in range(50, 1050, 50)] + [(550, y) for y in range(1000, 0, -50)]
+    coords = np.array(bottom + detour, dtype=float) + [390000, 5820000]
+    path = [bottom.index((500, 0))] + list(range(len(bottom), len(coords))) + [bottom.index((550, 0))]
+    edges = [(i, i + 1) for i in range(len(bottom) - 1) if bottom[i] != (500, 0)] + list(zip(path[:-1], path[1:]))
+    source = np.array([u for u, v in edges] + [v for u, v in edges])
+    target = np.array([v for u, v in edges] + [u for u, v in edges])
+    length = np.hypot(*(coords[source] - coords[target]).T)
+    return CompactNetwork(np.arange(len(coords)), coords[:, 0], coords[:, 1], np.full(len(coords), 2), source, target, length, "EPSG:32633")
+
+
+def test_network_knn_graph_users_off_the_street():
+    """Users set back from the street further than the search reaches still join it at their nearest node"""
+    street = np.array([(x, 0) for x in range(0, 2050, 50)], dtype=float) + [390000, 5820000]
+    edges = np.arange(street.shape[0] - 1)
+    source = np.concatenate([edges, edges + 1])
+    target = np.concatenate([edges + 1, edges])
+    network = CompactNetwork(np.arange(street.shape[0]), street[:, 0], street[:, 1], np.full(street.shape[0], 2), source, target, np.full(source.shape[0], 50.0), "EPSG:32633")
+    coords = np.array([(0, 5000), (200, 5000), (400, 5000), (600, 5000)], dtype=float) + [390000, 5820000]
+
+    graph = network_knn_graph(coords, network, 1)
+    assert np.isclose(graph[0, 1], 10200), "Users should be linked through the nodes they snapped to"
+    assert np.isclose(graph[2, 3], 10200)
+
+
+def test_network_kmeans_respects_rivers(monkeypatch):
+    network = river_network()
+    monkeypatch.setattr(meetup.clustering, "get_compact_network", lambda *args: network)
+    x = np.concatenate([np.linspace(300, 500, 20), np.linspace(550, 1000, 60)])
+    coords = np.stack([x + 390000, np.full(x.shape[0], 5820000.0)], axis=1)
 
+    graph = network_knn_graph(coords, network, 5)
+    assert_equal(graph[19, 20], 0, "Neighbours across the river should not be linked")
+    assert np.isclose(graph[20, 21], 450 / 59), "Neighbours on the same bank should be linked by their network distance"
 
+    labels = NetworkKMeans(2, "epsg:32633", neighbours=5, random_state=0).fit(coords).labels_
+    assert_equal(np.unique(labels[:20]).shape[0], 1, "Each bank should be its own group")
+    assert_equal(np.unique(labels[20:]).shape[0], 1, "Each bank should be its own group")
+    assert labels[0] != labels[-1]
@@ -0,0 +1,51 @@
+from meetup.export import OutputFormat, export_run, read_output, to_lat_lng
+from meetup.geo import generate_cluster_convex_hull, generate_group_centroids
+from numpy.testing import assert_equal
+from .helpers import square_cluster
+import pandas as pd
+import geopandas as gp
+import json
+
+
+def test_to_lat_lng_rounds_coordinates():
+    users = square_cluster(13.4, 52.5, 0.01, 0).to_crs("epsg:32633")
+    hulls = generate_cluster_convex_hull(users)
+
+    latLngUsers, latLngHulls = to_lat_lng([users, hulls], 3)
+
+    assert_equal(latLngUsers.crs.to_epsg(), 4326)
+    assert_equal(latLngUsers.get_coordinates().round(3).to_numpy(), latLngUsers.get_coordinates().to_numpy(), "Coordinates should be rounded")
+    assert_equal(latLngUsers.get_coordinates().to_numpy(), square_cluster(13.4, 52.5, 0.01, 0).get_coordinates().round(3).to_numpy())
+    assert_equal(latLngHulls.index.to_list(), [0], "Should keep the index of each DataFrame")
+
+
+def test_export_formats(tmp_path):
+    users = gp.GeoDataFrame(pd.concat([square_cluster(13.4, 52.5, 0.01, 0), square_cluster(13.5, 52.6, 0.01, 1)], ignore_index=True)).to_crs("epsg:32633")
+    users = users.assign(user_id=[f"user{i}" for i in range(users.shape[0])])
+    meetingPoints = generate_group_centroids(users)
+    regions = generate_cluster_convex_hull(users)
+
+    for outputFormat in OutputFormat:
+        outputDir = tmp_path / outputFormat.value
+        outputDir.mkdir()
+        export_run(outputDir, users, meetingPoints, regions, outputFormat)
+
+        exported = read_output(outputDir, "usersAssignments")
+        assert_equal(exported.shape[0], users.shape[0], f"Should read back every user from {outputFormat.value}")
+        assert_equal(sorted(exported.user_id), sorted(users.user_id))
+        assert_equal(sorted(read_output(outputDir, "groupRegions").label), [0, 1], "Regions should keep their labels")
+        assert (outputDir / "mailingList.csv").exists()
+
+    with open(tmp_path / "geojson" / "groupMeetingPoints.geojson") as file:
+        assert_equal(len(json.load(file)["features"]), 2, "Should write valid GeoJSON")
+
+
+def test_mailing_list_matches_exported_meeting_points(tmp_path):
+    users = gp.GeoDataFrame(pd.concat([square_cluster(13.4, 52.5, 0.01, 0), square_cluster(13.5, 52.6, 0.01, 1)], ignore_index=True)).to_crs("epsg:32633")
+    users = users.assign(user_id=[f"user{i}" for i in range(users.shape[0])])
+    export_run(tmp_path, users, generate_group_centroids(users), generate_cluster_convex_hull(users), OutputFormat.GEOJSON, 3)
+
+    meetingPoints = read_output(tmp_path, "groupMeetingPoints").sort_values("label")
+    mailingList = pd.read_csv(tmp_path / "mailingList.csv").drop_duplicates("start_point_id").sort_values("start_point_id")
+    assert_equal(mailingList.start_point_latitude.to_numpy(), meetingPoints.geometry.y.to_numpy(), "Should use the rounded meeting points")
+    assert_equal(mailingList.start_point_longitude.to_numpy(), meetingPoints.geometry.x.to_numpy())
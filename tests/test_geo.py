@@ -1,5 +1,8 @@
 from numpy.testing import assert_equal
-from meetup.geo import generate_group_centroids, generate_cluster_convex_hull
+from meetup.geo import aggregate_user_locations, read_user_locations, point_coordinates, group_centroids, generate_group_centroids, generate_cluster_convex_hull, import_network, get_network_graph, get_snap_index, network_meeting_points, network_tiles, snap_points_to_street_network
+from meetup.caching import NetworkCache
+from meetup.network import CompactNetwork
+import numpy as np
 import pandas as pd 
 import geopandas as gp
 from .helpers import square_cluster, circle_cluster
@@ -25,6 +28,32 @@ def test_group_centroids():
     assert isclose(centroids.iloc[1].geometry.y, 20), "Cluster 2 should be centered on 20, 20"
 
 
+def test_group_centroids_from_arrays():
+    allPoints = gp.GeoDataFrame(pd.concat([square_cluster(10,10,10,3), square_cluster(20,20,20,1)]))
+    coords = point_coordinates(allPoints)
+    assert_equal(coords.shape, (allPoints.shape[0], 2))
+    assert coords.flags["C_CONTIGUOUS"], "Coordinates should be a contiguous array"
+
+    labels, centroids = group_centroids(coords, allPoints.label.to_numpy())
+    assert_equal(labels, [1, 3], "Groups should be sorted by label")
+    assert_equal(centroids, [[20, 20], [10, 10]])
+
+
+def test_aggregate_user_locations():
+    # 30 users in one 50m cell and 5 in another, 1km away
+    x = np.concatenate([np.linspace(390010, 390040, 30), np.full(5, 391010)])
+    y = np.concatenate([np.full(30, 5820010), np.linspace(5821010, 5821040, 5)])
+    users = gp.GeoDataFrame(geometry=gp.points_from_xy(x, y), crs="epsg:32633")
+    cells, cellOfUser = aggregate_user_locations(users, 50, maxWeight=10)
+
+    assert_equal(sorted(cells.weight.tolist()), [5, 10, 10, 10], "The crowded cell should be broken in to points of at most 10 users")
+    assert_equal(cells.weight.sum(), 35, "Every user should be counted once")
+    assert_equal(np.bincount(cellOfUser), cells.weight.to_numpy(), "Each user should map to a point standing for them")
+    assert_equal(np.unique(cellOfUser[30:]).shape[0], 1, "The quiet cell should be a single point")
+    assert_equal(point_coordinates(cells)[cellOfUser[30]], [391010, 5821025], "Points should sit at the centroid of their users")
+    assert cells.crs == users.crs
+
+
 def test_generate_convex_hulls():
     group1 = square_cluster(10,10,10,0)
     group2 = square_cluster(20,20,20,1)
@@ -41,3 +70,86 @@ def test_generate_convex_hulls():
     assert isclose(hulls.iloc[1].geometry.length, 20*4)
 
     print(hulls)
+
+TEST_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="52.45" lon="13.35"/>
+  <node id="2" lat="52.45" lon="13.38"/>
+  <node id="3" lat="52.45" lon="13.42"/>
+  <node id="4" lat="52.48" lon="13.42"/>
+  <node id="5" lat="52.42" lon="13.42"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="cycleway"/></way>
+  <way id="11"><nd ref="4"/><nd ref="3"/><nd ref="5"/><tag k="highway" v="residential"/></way>
+</osm>
+"""
+
+
+def test_network_tiles():
+    assert_equal(network_tiles((13.34, 52.44, 13.43, 52.46)), [(133, 524), (134, 524)], "Should cover the bounds with two tiles")
+
+
+def test_offline_network_from_imported_tiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(NetworkCache, "baseDir", tmp_path / "networks")
+    monkeypatch.setattr(NetworkCache, "offline", True)
+    osmFile = tmp_path / "network.osm"
+    osmFile.write_text(TEST_OSM)
+
+    assert_equal(import_network(str(osmFile)), 2, "The network spans two tiles")
+    network = get_network_graph((13.34, 52.44, 13.43, 52.46), crs="epsg:32633")
+
+    assert_equal(network.number_of_nodes(), 4, "Tiles should be stitched back together on their shared nodes")
+    assert_equal(network.graph["crs"], "epsg:32633", "Network should be projected to the requested crs")
+
+
+
+def test_snap_to_intersections(tmp_path, monkeypatch):
+    monkeypatch.setattr(NetworkCache, "baseDir", tmp_path / "networks")
+    monkeypatch.setattr(NetworkCache, "offline", True)
+    osmFile = tmp_path / "network.osm"
+    osmFile.write_text(TEST_OSM)
+    import_network(str(osmFile))
+
+    assert_equal(len(get_snap_index((13.34, 52.44, 13.43, 52.46)).coords), 4, "Every node should be a snapping target by default")
+    snapIndex = get_snap_index((13.34, 52.44, 13.43, 52.46), minStreetCount=3)
+    assert_equal(snapIndex.coords, [[13.42, 52.45]], "Only the junction of the two ways should be a snapping target")
+
+    points = gp.GeoDataFrame({"label": [0, 1]}, geometry=gp.points_from_xy([13.36, 13.41], [52.451, 52.47]), crs="epsg:4326")
+    snapped = snap_points_to_street_network(points, snapIndex)
+    assert_equal(snapped.get_coordinates().to_numpy(), [[13.42, 52.45], [13.42, 52.45]], "Points should snap to the junction")
+    assert_equal(snapped.label.to_list(), [0, 1], "Labels should be kept")
+
+
+def line_network(noNodes, spacing):
+    """A straight street of evenly spaced nodes, in both directions"""
+    ids = np.arange(noNodes)
+    source = np.concatenate([ids[:-1], ids[1:]])
+    target = np.concatenate([ids[1:], ids[:-1]])
+    return CompactNetwork(ids, ids * float(spacing), np.zeros(noNodes), np.full(noNodes, 2), source, target, np.full(source.shape[0], float(spacing)), "EPSG:32633")
+
+
+def test_network_meeting_points():
+    network = line_network(5, 100)
+    users = gp.GeoDataFrame({"label": [0, 0, 0, 0, 1, 1, 1]}, geometry=gp.points_from_xy([0, 5, 10, 400, 190, 205, 320], [0, 0, 0, 0, 5, 5, 5]), crs="epsg:32633")
+
+    median = network_meeting_points(users, network, workers=1)
+    assert_equal(median.label.to_list(), [0, 1])
+    assert_equal(median.geometry.x.to_list(), [0, 200], "Should meet where the total distance is smallest")
+
+    minimax = network_meeting_points(users, network, minimax=True, workers=2)
+    assert_equal(minimax.geometry.x.to_list(), [200, 300], "Should meet where the longest distance is smallest")
+
+
+def test_read_user_locations(tmp_path):
+    csvFile = tmp_path / "users.csv"
+    csvFile.write_text("id,lat,lng,extra\nb,52.0,13.0,x\na,52.1,13.1,x\nb,52.2,13.2,x\nb,52.9,13.9,x\nc,95.0,13.0,x\n,52.0,13.0,x\nd,,13.0,x\n")
+
+    users = read_user_locations(str(csvFile), "lat", "lng", "id", chunkSize=2)
+    assert_equal(users.columns.to_list(), ["user_id", "latitude", "longitude"], "Should only keep the standardized columns")
+    assert_equal(list(users.user_id), ["a", "b"], "Should drop invalid rows and deduplicate users")
+    assert isclose(users.latitude.iloc[1], 52.2), "Should take the median location of repeated users"
+
+    parquetFile = tmp_path / "users.parquet"
+    pd.read_csv(csvFile).to_parquet(parquetFile)
+    fromParquet = read_user_locations(str(parquetFile), "lat", "lng", "id", float32=True)
+    assert_equal(list(fromParquet.user_id), ["a", "b"])
+    assert_equal(fromParquet.latitude.dtype, np.float32)
@@ -0,0 +1,34 @@
+from meetup.partition import tile_users, stitch_tiles, run_partitioned_clustering
+from numpy.testing import assert_equal
+import geopandas as gp
+import numpy as np
+
+
+def test_tile_users():
+    coords = np.array([[0, 0], [5, 5], [12, 1], [25, 25]], dtype=float)
+    tiles = tile_users(coords, 10, 3)
+
+    assert_equal(len(tiles), 3, "Should only generate tiles which contain users")
+    assert_equal(list(tiles[0].userIndexes), [0, 1, 2], "First tile should contain the first two users and the third in its margin")
+    assert_equal(list(tiles[1].userIndexes), [2], "Second tile should contain the third user")
+
+def test_stitch_tiles():
+    coords = np.array([[0, 0], [2, 2], [9, 9], [11, 11], [18, 18], [19, 19]], dtype=float)
+    tiles = tile_users(coords, 10, 3)
+    # The users on the boundary are present in both tiles and clustered with the right hand group in the first tile
+    tileLabels = [np.array([0, 0, 1, 1]), np.array([0, 1, 1, 1])]
+    labels = stitch_tiles(coords, tiles, tileLabels)
+
+    assert_equal(list(labels), [0, 0, 1, 1, 1, 1], "Boundary users should end up in the group kept by the second tile")
+
+
+def test_run_partitioned_clustering(tmp_cache):
+    rng = np.random.default_rng(0)
+    coords = rng.uniform(0, 4000, size=(400, 2)) + [390000, 5820000]
+    users = gp.GeoDataFrame({"user_id": np.arange(400)}, geometry=gp.points_from_xy(coords[:, 0], coords[:, 1]), crs="epsg:32633")
+
+    clusters = run_partitioned_clustering(users, 10, 40, 10, workers=2, tileSizeKm=2, seed=0)
+    sizes = clusters.label.value_counts()
+    assert_equal(clusters.user_id.tolist(), list(range(400)), "Every user should be labelled and keep their order")
+    assert not clusters.label.isna().any()
+    assert sizes.min() >= 10 and sizes.max() <= 40, "Groups should be within the occupancy bounds after reconciliation"
@@ -0,0 +1,32 @@
+from meetup.profiling import Profiler, cprofile
+from numpy.testing import assert_equal
+import pstats
+
+
+def test_spans_nest():
+    profiler = Profiler()
+    with profiler.span("run", users=10):
+        with profiler.span("iteration") as stage:
+            stage.counts["groups"] = 2
+        with profiler.span("iteration"):
+            pass
+    with profiler.span("export"):
+        pass
+
+    report = profiler.report()
+    assert_equal([span["name"] for span in report], ["run", "export"])
+    assert_equal(report[0]["counts"], {"users": 10})
+    assert_equal([child["counts"] for child in report[0]["children"][:1]], [{"groups": 2}])
+    assert_equal(len(report[0]["children"]), 2, "Spans opened inside another should be its children")
+    assert report[0]["wallSeconds"] >= report[0]["children"][0]["wallSeconds"]
+    assert report[0]["peakRssMb"] > 0
+
+    profiler.reset()
+    assert_equal(profiler.report(), [])
+
+
+def test_cprofile(tmp_path):
+    with cprofile(tmp_path / "profile.prof"):
+        sum(range(1000))
+
+    assert pstats.Stats(str(tmp_path / "profile.prof")).total_calls > 0
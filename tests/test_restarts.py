@@ -0,0 +1,42 @@
+from meetup.clustering import cluster_users, score_labels, spawn_seeds
+from meetup.restarts import run_multistart_clustering
+from meetup.geo import point_coordinates
+from numpy.testing import assert_equal
+import geopandas as gp
+import numpy as np
+
+
+def random_users(noUsers):
+    rng = np.random.default_rng(0)
+    coords = rng.normal(size=(noUsers, 2)) * 2000 + [390000, 5820000]
+    return gp.GeoDataFrame({"user_id": np.arange(noUsers)}, geometry=gp.points_from_xy(coords[:, 0], coords[:, 1]), crs="epsg:32633")
+
+
+def test_score_labels():
+    coords = np.array([[0, 0], [2, 0], [10, 0], [12, 0], [14, 0]], dtype=float)
+    violations, meanDistance = score_labels(coords, np.array([0, 0, 1, 1, 1]), 2, 2)
+    assert_equal(violations, 1, "The group of 3 is over the max occupancy")
+    assert_equal(meanDistance, (1 + 1 + 2 + 0 + 2) / 5)
+
+    violations, _ = score_labels(coords, np.array([0, 0, 1, 1, 1]), None, None)
+    assert_equal(violations, 0, "Without bounds no group is outside them")
+
+
+def test_seeded_clustering_is_reproducible():
+    users = random_users(300)
+    first = cluster_users(users, 10, 30, 10, seed=42)
+    second = cluster_users(users, 10, 30, 10, seed=42)
+    assert_equal(first, second, "The same seed should give the same groups")
+    assert_equal(spawn_seeds(None, 3), [None, None, None])
+    assert_equal(spawn_seeds(7, 3), spawn_seeds(7, 3))
+
+
+def test_multistart_keeps_best_restart(tmp_cache):
+    users = random_users(300)
+    coords = point_coordinates(users)
+
+    best = run_multistart_clustering(users, 10, 30, 10, restarts=3, seed=42, workers=2)
+    assert_equal(best.user_id.tolist(), list(range(300)), "Users should keep their order")
+
+    scores = [score_labels(coords, cluster_users(users, 10, 30, 10, seed=seed), 10, 30) for seed in spawn_seeds(42, 3)]
+    assert_equal(score_labels(coords, best.label.to_numpy(), 10, 30), min(scores), "Should keep the best scoring restart")
@@ -0,0 +1,183 @@
+from meetup.export import OutputFormat, export_run
+from meetup.geo import generate_cluster_convex_hull, generate_group_centroids
+from meetup.jobs import MAX_AFFINITY_PROPAGATION_USERS, parse_job
+from meetup.server import create_server, create_service, parse_range
+from numpy.testing import assert_equal
+from threading import Thread
+from .helpers import square_cluster
+import http.client
+import gzip
+import json
+import pandas as pd
+import geopandas as gp
+import pytest
+
+
+@pytest.fixture
+def server(tmp_path):
+    users = gp.GeoDataFrame(pd.concat([square_cluster(13.4, 52.5, 0.01, 0), square_cluster(13.5, 52.6, 0.01, 1)], ignore_index=True)).to_crs("epsg:32633")
+    users = users.assign(user_id=[f"user{i}" for i in range(users.shape[0])])
+    export_run(tmp_path, users, generate_group_centroids(users), generate_cluster_convex_hull(users), OutputFormat.GEOPARQUET)
+    with open(tmp_path / "runDetails.json", "w") as file:
+        json.dump({"details": "x" * 2000}, file)
+
+    server = create_server(str(tmp_path), port=0)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def service(tmp_cache):
+    services = []
+
+    def start(workers=1, maxQueued=4):
+        service, jobQueue = create_service(0, workers, maxQueued)
+        Thread(target=service.serve_forever, daemon=True).start()
+        services.append(service)
+        return service.server_address[1]
+
+    yield start
+    for service in services:
+        service.shutdown()
+        service.server_close()
+
+
+def request(port, path, headers={}, method="GET", body=None):
+    connection = http.client.HTTPConnection("localhost", port)
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+
+def test_parse_range():
+    assert_equal(parse_range("bytes=0-9", 100), (0, 9))
+    assert_equal(parse_range("bytes=90-", 100), (90, 99))
+    assert_equal(parse_range("bytes=-10", 100), (90, 99))
+    assert_equal(parse_range("bytes=50-500", 100), (50, 99))
+    assert parse_range("bytes=100-", 100) is None
+    assert parse_range("items=0-1", 100) is None
+
+
+def test_server_caching_and_compression(server):
+    response, body = request(server, "/data/runDetails.json")
+    assert_equal(response.status, 200)
+    assert_equal(response.getheader("Content-Type"), "application/json")
+    etag = response.getheader("ETag")
+
+    response, _ = request(server, "/data/runDetails.json", {"If-None-Match": etag})
+    assert_equal(response.status, 304, "Should tell the client its copy is current")
+
+    response, compressed = request(server, "/data/runDetails.json", {"Accept-Encoding": "gzip"})
+    assert_equal(response.getheader("Content-Encoding"), "gzip")
+    assert_equal(gzip.decompress(compressed), body)
+
+    response, part = request(server, "/data/runDetails.json", {"Range": "bytes=2-11"})
+    assert_equal(response.status, 206)
+    assert_equal(response.getheader("Content-Range"), f"bytes 2-11/{len(body)}")
+    assert_equal(part, body[2:12])
+
+    response, converted = request(server, "/data/usersAssignments.geojson")
+    assert_equal(response.getheader("Content-Type"), "application/geo+json")
+    assert_equal(len(json.loads(converted)["features"]), 8, "Should convert other output formats to GeoJSON")
+
+    response, _ = request(server, "/tiles/9/275/167.mvt")
+    assert_equal(response.getheader("Content-Type"), "application/vnd.mapbox-vector-tile")
+
+    response, _ = request(server, "/data/../../etc/passwd")
+    assert_equal(response.status, 404, "Should not serve files outside the run")
+
+
+def test_query_api(server):
+    response, body = request(server, "/api/groups?bbox=13.45,52.55,13.6,52.7")
+    assert_equal(response.status, 200)
+    assert_equal([group["label"] for group in json.loads(body)["groups"]], [1], "Should only return groups in the box")
+
+    _, body = request(server, "/api/groups")
+    assert_equal([group["memberCount"] for group in json.loads(body)["groups"]], [4, 4])
+
+    _, body = request(server, "/api/groups/0")
+    group = json.loads(body)
+    assert_equal(sorted(member["user_id"] for member in group["members"]), ["user0", "user1", "user2", "user3"])
+
+    _, body = request(server, "/api/users/user5")
+    user = json.loads(body)
+    assert_equal(user["label"], 1)
+    assert_equal(user["group"]["memberCount"], 4)
+
+    response, _ = request(server, "/api/users/missing")
+    assert_equal(response.status, 404)
+    response, _ = request(server, "/api/groups?bbox=1,2")
+    assert_equal(response.status, 400)
+
+
+def test_job_service(service):
+    port = service()
+    users = pd.concat([square_cluster(13.4, 52.5, 0.01, 0), square_cluster(13.5, 52.6, 0.01, 1)], ignore_index=True)
+    submission = {
+        "users": [{"user_id": f"user{i}", "latitude": point.y, "longitude": point.x} for i, point in enumerate(users.geometry)],
+        "parameters": {"minOccupancy": 2, "maxOccupancy": 4},
+    }
+    response, body = request(port, "/api/jobs", {"Content-Type": "application/json"}, "POST", json.dumps(submission))
+    assert_equal(response.status, 202)
+    job = json.loads(body)
+    assert_equal(response.getheader("Location"), f"/api/jobs/{job['id']}")
+
+    _, body = request(port, f"/api/jobs/{job['id']}?wait=30")
+    job = json.loads(body)
+    assert_equal(job["status"], "done", job["error"])
+    assert_equal(job["users"], 8)
+    assert "job" in [stage["name"] for stage in job["profile"]], "Should report the timings of the job"
+
+    _, body = request(port, f"/api/jobs/{job['id']}/result")
+    groups = json.loads(body)["groups"]
+    assert_equal(sum(group["memberCount"] for group in groups), 8)
+    assert all(2 <= group["memberCount"] <= 4 for group in groups)
+
+    response, body = request(port, f"/api/jobs/{job['id']}/events")
+    assert_equal(response.getheader("Content-Type"), "text/event-stream")
+    assert b'"status": "done"' in body
+
+    csv = "user_id,latitude,longitude\n" + "".join(f"user{i},{point.y},{point.x}\n" for i, point in enumerate(users.geometry))
+    response, body = request(port, "/api/jobs?maxOccupancy=4", {"Content-Type": "text/csv"}, "POST", csv)
+    assert_equal(response.status, 202)
+    assert_equal(json.loads(body)["parameters"]["maxOccupancy"], 4)
+
+    _, body = request(port, "/api/jobs")
+    assert_equal(len(json.loads(body)["jobs"]), 2)
+
+
+def test_job_service_rejections(service):
+    # Without workers the jobs stay queued
+    port = service(workers=0, maxQueued=1)
+    headers = {"Content-Type": "application/json"}
+    users = [{"user_id": "a", "latitude": 52.5, "longitude": 13.4}]
+
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": [{"user_id": "a", "latitude": 91, "longitude": 13.4}]}))
+    assert_equal(response.status, 400, "Should reject invalid locations")
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": users, "parameters": {"baseRun": "/etc"}}))
+    assert_equal(response.status, 400, "Should reject parameters that reach the filesystem")
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": users, "parameters": {"maxOccupancy": "many"}}))
+    assert_equal(response.status, 400)
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": users, "parameters": {"tileSizeKm": 5}}))
+    assert_equal(response.status, 400, "Should reject parameters that start a pool of processes")
+    _, parameters = parse_job(json.dumps({"users": users, "parameters": {"meetingPointMethod": "network_median"}}).encode(), "application/json", {})
+    assert_equal(parameters.workers, 1, "Network meeting points should be solved in the job's thread")
+    manyUsers = [{"user_id": str(i), "latitude": 52.5, "longitude": 13.4} for i in range(MAX_AFFINITY_PROPAGATION_USERS + 1)]
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": manyUsers, "parameters": {"initialMethod": "affinity_propagation"}}))
+    assert_equal(response.status, 400, "Should reject affinity propagation on more users than fit in memory")
+
+    response, body = request(port, "/api/jobs", headers, "POST", json.dumps({"users": users}))
+    assert_equal(response.status, 202)
+    jobId = json.loads(body)["id"]
+    response, _ = request(port, f"/api/jobs/{jobId}/result")
+    assert_equal(response.status, 409, "Should not return results before the job is done")
+
+    response, _ = request(port, "/api/jobs", headers, "POST", json.dumps({"users": users}))
+    assert_equal(response.status, 503, "Should turn jobs away when the queue is full")
+    assert_equal(response.getheader("Retry-After"), "5")
+    response, _ = request(port, "/api/jobs/0123")
+    assert_equal(response.status, 404)
@@ -0,0 +1,92 @@
+from meetup.export import OutputFormat, export_run
+from meetup.geo import generate_cluster_convex_hull, generate_group_centroids
+from meetup.tiles import RunTiles, encode_geometry, tile_bounds, TILE_BUFFER, TILE_EXTENT
+from numpy.testing import assert_equal
+from .helpers import square_cluster
+import numpy as np
+import pandas as pd
+import geopandas as gp
+import shapely
+
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def read_message(data):
+    """Minimal protobuf reader returning (field, value) pairs, enough to check the tile structure"""
+    fields = []
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        field, wireType = key >> 3, key & 0x7
+        if wireType == 0:
+            value, position = read_varint(data, position)
+        elif wireType == 1:
+            value, position = data[position:position + 8], position + 8
+        else:
+            length, position = read_varint(data, position)
+            value, position = data[position:position + length], position + length
+        fields.append((field, value))
+    return fields
+
+
+def test_encode_polygon_geometry():
+    square = shapely.Polygon([(0, 0), (0, 10), (10, 10), (10, 0)])
+
+    geometryType, commands = encode_geometry(square, np.zeros(2, dtype=np.int64))
+
+    assert_equal(geometryType, 3)
+    # The ring is anticlockwise with y pointing down so it is reversed: MoveTo(1) to 10,0, LineTo(3), ClosePath
+    assert_equal(commands, [9, 20, 0, 26, 0, 20, 19, 0, 0, 19, 15])
+
+
+def test_run_tiles(tmp_path):
+    users = gp.GeoDataFrame(pd.concat([square_cluster(13.4, 52.5, 0.01, 0), square_cluster(13.5, 52.6, 0.01, 1)], ignore_index=True)).to_crs("epsg:32633")
+    users = users.assign(user_id=[f"user{i}" for i in range(users.shape[0])])
+    export_run(tmp_path, users, generate_group_centroids(users), generate_cluster_convex_hull(users), OutputFormat.GEOPARQUET)
+    tiles = RunTiles(tmp_path, cacheSize=2)
+
+    metadata = tiles.metadata()
+    assert_equal(metadata["groupSizes"], {"0": 4, "1": 4})
+    assert_equal(np.round(metadata["bounds"], 2), [13.4, 52.5, 13.5, 52.6])
+
+    # The tile at zoom 9 covering both groups
+    tile = tiles.tile(9, 275, 167)
+    layers = {}
+    for field, layer in read_message(tile):
+        assert_equal(field, 3)
+        layerFields = read_message(layer)
+        name = next(value for field, value in layerFields if field == 1).decode("utf8")
+        layers[name] = layerFields
+    assert_equal(sorted(layers), ["groupMeetingPoints", "groupRegions", "usersAssignments"])
+    assert_equal(dict(layers["usersAssignments"])[5], TILE_EXTENT)
+    assert_equal(sum(field == 2 for field, _ in layers["groupRegions"]), 2, "Should have a region for each group")
+
+    assert tiles.tile(9, 275, 167) is tile, "Should serve the tile from the cache"
+    assert_equal(tiles.tile(18, 0, 0), b"", "Tiles away from the run should be empty")
+    assert tiles.tile(1, 2, 0) is None, "Should reject tiles outside the zoom level"
+    tiles.tile(1, 1, 0)
+    assert_equal(len(tiles.cache), 2, "Should evict the least recently used tiles")
+
+
+def test_overview_tile_skips_users_on_the_clip_edge(tmp_path):
+    minX, minY, maxX, maxY = tile_bounds(1, 0, 0)
+    edge = maxX + TILE_BUFFER * (maxX - minX) / TILE_EXTENT
+    # The first user lies exactly on the edge of the clipped area, so is found by the tree but clipped away
+    geometries = shapely.points([[edge, maxY / 2], [maxX / 2, maxY / 2]])
+    tiles = RunTiles(tmp_path)
+    tiles.layers = {"usersAssignments": (geometries, shapely.STRtree(geometries), {"label": np.array([3, 7])})}
+
+    layer = read_message(read_message(tiles.tile(1, 0, 0))[0][1])
+    assert_equal(sum(field == 2 for field, _ in layer), 1, "Should only draw the user inside the tile")
+    assert_equal([read_message(value) for field, value in layer if field == 4], [[(5, 7)]], "Should keep the label of the user drawn")
+
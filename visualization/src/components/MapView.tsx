@@ -1,18 +1,18 @@
-import React, { useEffect } from 'react'
+import React, { useEffect, useRef } from 'react'
 import { Map, NavigationControl } from 'react-map-gl'
 import { DeckGL, FlyToInterpolator, GeoJsonLayer, WebMercatorViewport } from "deck.gl/typed"
 import { DataFilterExtension } from '@deck.gl/extensions/typed';
 import 'maplibre-gl/dist/maplibre-gl.css';
 
 import maplibregl from 'maplibre-gl';
-import { boundsSelector, convexHullSelector, maxMinLabelsSelector, meetingPointsSelector, selectedGroupDetailsSelector, usersSelector } from '../stores/DataStore';
+import { boundsSelector, convexHullSelector, maxMinLabelsSelector, meetingPointsSelector, selectedGroupDetailsSelector, tileMetadataSelector } from '../stores/DataStore';
 import { mapViewport, selectedGroupAtom } from '../stores/InterfaceStore';
 import { useRecoilValue, useRecoilState } from 'recoil';
 import { colors } from '../utils/colors'
 
 export const MapView: React.FC = () => {
   const convexHulls = useRecoilValue(convexHullSelector)
-  const users = useRecoilValue(usersSelector)
+  const tileMetadata = useRecoilValue(tileMetadataSelector)
   const meetingPlaces = useRecoilValue(meetingPointsSelector)
   const [selectedGroup, setSelectedGroup] = useRecoilState(selectedGroupAtom)
   const selectedGroupDetails = useRecoilValue(selectedGroupDetailsSelector)
@@ -38,19 +38,40 @@ export const MapView: React.FC = () => {
     }
   })
 
-  const userLayer = new GeoJsonLayer({
-    id: "users",
-    data: users,
-    getRadius: 50,
-    getFillColor: colors.user,
-    pointRadiusUnits: "meters",
-    getFilterValue: (f: any) => f.properties.label,
-    filterRange: selectedGroup ? [selectedGroup - 0.1, selectedGroup + 0.1] : minMaxLabels,
-    extensions: [new DataFilterExtension({ filterSize: 1 })],
-  })
+  // Users are drawn by maplibre from vector tiles built by the server so only the visible ones are loaded
+  const mapRef = useRef<maplibregl.Map | null>(null)
+  const userFilter = selectedGroup ? ["==", ["get", "label"], selectedGroup] : null
+
+  const addUserLayer = (map: maplibregl.Map) => {
+    mapRef.current = map
+    map.addSource("users", {
+      type: "vector",
+      // Tiles are fetched from a worker, which needs absolute urls
+      tiles: [window.location.origin + tileMetadata.tiles[0]],
+      minzoom: tileMetadata.minzoom,
+      maxzoom: tileMetadata.maxzoom,
+    })
+    map.addLayer({
+      id: "users",
+      type: "circle",
+      source: "users",
+      "source-layer": "usersAssignments",
+      paint: {
+        "circle-color": `rgb(${colors.user.join(",")})`,
+        // Roughly 50m across at Berlin's latitude
+        "circle-radius": ["interpolate", ["exponential", 2], ["zoom"], 12, 2, 18, 128],
+      },
+    })
+    map.setFilter("users", userFilter as any)
+  }
+
+  useEffect(() => {
+    const map = mapRef.current
+    if (map && map.getLayer("users")) map.setFilter("users", userFilter as any)
+  }, [selectedGroup])
 
   const meetingPointLayer = new GeoJsonLayer({
-    id: "users",
+    id: "meetingPoints",
     data: meetingPlaces,
     getRadius: 50,
     getFillColor: colors.meetingPoint,
@@ -82,7 +103,7 @@ export const MapView: React.FC = () => {
 
   return (
     <DeckGL
-      layers={[convexHullLayer, userLayer, meetingPointLayer]}
+      layers={[convexHullLayer, meetingPointLayer]}
       initialViewState={localViewport}
       onViewStateChange={({ viewState }) => {
         setMapView(viewState)
@@ -92,6 +113,7 @@ export const MapView: React.FC = () => {
     >
       <Map
         mapLib={maplibregl}
+        onLoad={(e) => addUserLayer(e.target as unknown as maplibregl.Map)}
         mapStyle={"https://api.maptiler.com/maps/topo-v2/style.json?key=32rtUQVfWVrA5316PfSR"}
       >
         <NavigationControl position="top-right" />
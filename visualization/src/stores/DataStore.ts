@@ -1,7 +1,5 @@
 import { selector } from "recoil";
 import { selectedGroupAtom } from "./InterfaceStore";
-//@ts-ignore
-import bbox from '@turf/bbox'
 
 
 export const convexHullSelector = selector({
@@ -11,10 +9,11 @@ export const convexHullSelector = selector({
   }
 })
 
-export const usersSelector = selector({
-  key: "users",
+// Description of the vector tiles served for the run, along with the size of each group
+export const tileMetadataSelector = selector({
+  key: "tileMetadata",
   get: async () => {
-    return await fetch("/data/usersAssignments.geojson").then(resp => resp.json())
+    return await fetch("/tiles/tiles.json").then(resp => resp.json())
   }
 })
 
@@ -28,12 +27,8 @@ export const meetingPointsSelector = selector({
 export const clusterSizesSelector = selector({
   key: "clusterSizesSelector",
   get: ({ get }) => {
-    let users = get(usersSelector)
-    return users.features.reduce((counts: Record<number, number>, user: any) => {
-      let label = user.properties.label
-      counts[label] = label in counts ? counts[label] + 1 : 1
-      return counts
-    }, {})
+    let metadata = get(tileMetadataSelector)
+    return metadata.groupSizes as Record<number, number>
   }
 })
 
@@ -48,8 +43,8 @@ export const runDetailsSelector = selector({
 export const boundsSelector = selector<[[number, number], [number, number]]>({
   key: "bounds",
   get: async ({ get }) => {
-    let users = get(usersSelector)
-    return bbox(users)
+    let metadata = get(tileMetadataSelector)
+    return metadata.bounds
   }
 })
 
@@ -71,22 +66,22 @@ export const maxMinLabelsSelector = selector<[number, number]>({
 
 export const selectedGroupDetailsSelector = selector({
   key: 'selectedGroupDetails',
-  get: ({ get }) => {
+  get: async ({ get }) => {
     const selectedGroupId = get(selectedGroupAtom)
+    if (selectedGroupId === null) return null
+
     const groups = get(convexHullSelector)
-    const users = get(usersSelector)
     const meetingPoints = get(meetingPointsSelector)
+    // Only the members of the selected group are fetched, from the server's query API
+    const groupDetails = await fetch(`/api/groups/${selectedGroupId}`).then(resp => resp.json())
 
-    if (selectedGroupId === null) return null
     const selectedGroup = groups.features.find((f: any) => f.properties.label === selectedGroupId)
-    const selectedUsers = users.features.filter((f: any) => f.properties.label === selectedGroupId)
     const selectedMeetingPoint = meetingPoints.features.find((f: any) => f.properties.label === selectedGroupId)
     return {
-      users: selectedUsers.map((u: any) => u.properties),
+      users: groupDetails.members,
       selectedGroup: selectedGroup.properties,
       selectedMeetingPoint: selectedMeetingPoint.properties,
-      bounds: bbox(selectedGroup)
+      bounds: groupDetails.bounds
     }
   }
 })
-